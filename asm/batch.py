@@ -0,0 +1,137 @@
+#! /usr/bin/env python3
+
+### @file batch.py
+### @brief 命令列をまとめて符号化する NumPy 版エンコーダ
+###
+### Inst の静的メソッドと同じ LAYOUT/ENCODE_TABLE を用いて，
+### 列ごとの配列(ニーモニック番号, rd, rs1, rs2, imm)から
+### numpy.uint32 の機械語の配列を一度に作る．
+
+import numpy as np
+
+from inst import INST_TABLE, LAYOUT, ENCODE_TABLE
+
+### @brief ニーモニックから番号(INST_TABLE 中の位置)への辞書
+OP_ID = { entry[0] : i for i, entry in enumerate(INST_TABLE) }
+
+# 1命令あたりの即値フィールドの最大数(B-type, J-type の 4)
+_NFIELDS = max(len(layout.fields) for layout in LAYOUT.values())
+
+
+### @brief ニーモニック番号ごとの符号化パラメータの配列を作る．
+def _make_tables() :
+    n = len(INST_TABLE)
+    base = np.zeros(n, dtype=np.int64)
+    imm_mask = np.zeros(n, dtype=np.int64)
+    rd_mask = np.zeros(n, dtype=np.int64)
+    rs1_mask = np.zeros(n, dtype=np.int64)
+    rs2_mask = np.zeros(n, dtype=np.int64)
+    f_lsb = np.zeros((_NFIELDS, n), dtype=np.int64)
+    f_mask = np.zeros((_NFIELDS, n), dtype=np.int64)
+    f_pos = np.zeros((_NFIELDS, n), dtype=np.int64)
+    for i, (name, fmt, _, _, _) in enumerate(INST_TABLE) :
+        layout, code = ENCODE_TABLE[name]
+        base[i] = code
+        imm_mask[i] = layout.mask
+        # 形式ごとに使わないレジスタフィールドは 0 にする．
+        rd_mask[i] = 0 if fmt in ('S', 'B') else 0x1F
+        rs1_mask[i] = 0 if fmt in ('U', 'J') else 0x1F
+        rs2_mask[i] = 0x1F if fmt in ('R', 'S', 'B') else 0
+        for k, (lsb, mask, pos) in enumerate(layout.fields) :
+            f_lsb[k, i] = lsb
+            f_mask[k, i] = mask
+            f_pos[k, i] = pos
+    return base, imm_mask, rd_mask, rs1_mask, rs2_mask, f_lsb, f_mask, f_pos
+
+_BASE, _IMM_MASK, _RD_MASK, _RS1_MASK, _RS2_MASK, _F_LSB, _F_MASK, _F_POS = _make_tables()
+
+
+### @brief ニーモニックの列を番号の配列に変換する．
+### @param[in] names ニーモニックの文字列の列
+def op_ids(names) :
+    return np.fromiter((OP_ID[name] for name in names), dtype=np.intp)
+
+
+### @brief 列ごとの配列から機械語の配列を作る．
+### @param[in] ops ニーモニック番号の配列(またはニーモニックの文字列の列)
+### @param[in] rd, rs1, rs2 レジスタ番号の配列(省略時は 0)
+### @param[in] imm 即値の配列(省略時は 0)
+### @return numpy.uint32 の配列
+###
+### 使わないフィールド(例えば S-type の rd)の値は無視される．
+### 結果は Inst の各命令の gen_code() と一致する．
+def encode(ops, rd=None, rs1=None, rs2=None, imm=None) :
+    ops = np.asarray(ops)
+    if ops.dtype.kind in 'UO' :
+        ops = op_ids(ops)
+    n = len(ops)
+
+    def column(a) :
+        if a is None :
+            return np.zeros(n, dtype=np.int64)
+        return np.asarray(a, dtype=np.int64)
+
+    code = _BASE[ops]
+    code |= (column(rd) & _RD_MASK[ops]) << 7
+    code |= (column(rs1) & _RS1_MASK[ops]) << 15
+    code |= (column(rs2) & _RS2_MASK[ops]) << 20
+    # 2の補数表現への変換は int64 のままマスクをとればよい．
+    p_imm = column(imm) & _IMM_MASK[ops]
+    for k in range(_NFIELDS) :
+        code |= ((p_imm >> _F_LSB[k][ops]) & _F_MASK[k][ops]) << _F_POS[k][ops]
+    return code.astype(np.uint32)
+
+
+if __name__ == '__main__' :
+
+    import time
+    from inst import Inst
+
+    # 全命令について Inst による符号化と一致することを確かめる．
+    rng = np.random.default_rng(1)
+    n = 1000000
+    ops = rng.integers(0, len(INST_TABLE), n)
+    rd = rng.integers(0, 32, n)
+    rs1 = rng.integers(0, 32, n)
+    rs2 = rng.integers(0, 32, n)
+    imm = np.empty(n, dtype=np.int64)
+    for i, (name, fmt, _, _, _) in enumerate(INST_TABLE) :
+        sel = ops == i
+        cnt = int(sel.sum())
+        if fmt == 'I' or fmt == 'S' :
+            imm[sel] = rng.integers(-2048, 2048, cnt)
+        elif fmt == 'I2' :
+            imm[sel] = rng.integers(0, 32, cnt)
+        elif fmt == 'B' :
+            imm[sel] = rng.integers(-2048, 2048, cnt) * 2
+        elif fmt == 'U' :
+            imm[sel] = rng.integers(0, 1 << 20, cnt) << 12
+        elif fmt == 'J' :
+            imm[sel] = rng.integers(-(1 << 19), 1 << 19, cnt) * 2
+        else :
+            imm[sel] = 0
+
+    start = time.perf_counter()
+    codes = encode(ops, rd, rs1, rs2, imm)
+    elapsed = time.perf_counter() - start
+    print('batch : {:.0f} inst/s'.format(n / elapsed))
+
+    m = 100000
+    start = time.perf_counter()
+    ref = []
+    for i in range(m) :
+        name, fmt = INST_TABLE[ops[i]][:2]
+        if fmt == 'R' :
+            inst = getattr(Inst, name)(int(rd[i]), int(rs1[i]), int(rs2[i]))
+        elif fmt == 'S' or fmt == 'B' :
+            inst = getattr(Inst, name)(int(rs1[i]), int(rs2[i]), int(imm[i]))
+        elif fmt == 'U' or fmt == 'J' :
+            inst = getattr(Inst, name)(int(rd[i]), int(imm[i]))
+        else :
+            inst = getattr(Inst, name)(int(rd[i]), int(rs1[i]), int(imm[i]))
+        ref.append(inst.gen_code())
+    elapsed = time.perf_counter() - start
+    print('Inst  : {:.0f} inst/s'.format(m / elapsed))
+
+    assert codes[:m].tolist() == ref
+    print('OK')
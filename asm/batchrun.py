@@ -0,0 +1,324 @@
+#! /usr/bin/env python3
+
+### @file batchrun.py
+### @brief 多数の (プログラム, スイッチの設定) をまとめて実行するランナー
+###
+### 使い方: batchrun.py [-j workers] [-n settings] [-c max_cycles]
+###   例のプログラムをスイッチの設定を変えながら実行し，ワーカー数ごとの速さを表示する．
+###
+###   programs = [ asm(p) for p in sources ]
+###   jobs = [ (i, { 'dip_a' : a, 'dip_b' : b }) for i in range(len(programs)) for a, b in settings ]
+###   for result in run_batch(programs, jobs, max_cycles=8000000) :
+###       ...
+###
+### プログラムは array('I') の機械語として，ProcessPoolExecutor の initializer で
+### 各ワーカーに一度だけ送る．ジョブはプログラムの番号と入力だけを送り，
+### 同じプログラムのジョブが同じチャンクに入るように並べる．
+### ワーカーはプログラムごとにシミュレータを作って再利用し，ジョブの間は
+### snapshot.History で読み込んだ直後の状態に戻す(書き換えられたページだけを戻す)．
+###
+### プログラムは 'JAL x0, 0' (その場での無限ループ)に達するか，クロック数の上限で終わる．
+### 無限ループの検出は slice 命令ごとに行い，達した区間は命令ごとに実行し直して，
+### 初めて JAL x0, 0 に達した時点の steps と cycles を求める．
+### クロック数は cost.CostModel で求める．命令の種類によらないモデル(既定のもの)では
+### steps に比例するので BlockSimulator のまま実行し，種類によるモデルでは
+### cost.CycleCounter で数える(命令ごとの実行となるので遅い)．
+### 結果は終わったチャンクから順に返す(ジョブの順ではない)．
+
+import hashlib
+import os
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cost import CostModel, CycleCounter, CLASS_NAMES, JAL, UNKNOWN
+from sim import RAM_BASE, SimulationError
+
+# JAL x0, 0
+_SELF_LOOP = 0x0000006F
+
+### @brief ジョブの結果
+###
+### job はジョブの番号，program はプログラムの番号，status は次のいずれか．
+###   'done'  : JAL x0, 0 に達した
+###   'limit' : クロック数の上限に達した
+###   'error' : SimulationError (error にメッセージ)
+### reg は x0 - x31 のタプル，digest は RAM 64KB の BLAKE2b(16バイト)の16進文字列，
+### seg7 は 7セグ LED の内容(64バイト)．
+Result = namedtuple('Result', 'job program inputs status steps cycles pc reg digest seg7 error')
+
+
+### @brief プログラムを送る形(array('I'))にする．
+### @param[in] program asm() の出力(Inst のリスト)または機械語の列
+def encode_program(program) :
+    if type(program) is array and program.typecode == 'I' :
+        return program
+    return array('I', [ x if type(x) is int else x.gen_code() for x in program ])
+
+
+# ワーカーの状態
+_PROGRAMS = None
+_BASE = RAM_BASE
+_BLOCK = True
+_MODEL = CostModel()
+# 命令の種類によらない場合の1命令のクロック数(種類による場合は None)
+_STEP_CYCLES = None
+# プログラムの番号をキーにして (シミュレータ, History, 最初のスナップショット) を持つ辞書
+_MACHINES = {}
+# 残しておくシミュレータの数
+_MAX_MACHINES = 8
+
+
+### @brief 命令の種類によらない場合の1命令のクロック数を返す．
+### @param[in] model CostModel
+### @return 種類によってクロック数が違う場合は None を返す．
+def step_cycles(model) :
+    cycles = { model.cycles(cls) for cls in range(len(CLASS_NAMES)) if cls != UNKNOWN }
+    return cycles.pop() if len(cycles) == 1 else None
+
+
+def _init_worker(programs, base, block, model) :
+    global _PROGRAMS, _BASE, _BLOCK, _MODEL, _STEP_CYCLES
+    _PROGRAMS = programs
+    _BASE = base
+    _BLOCK = block
+    _MODEL = model
+    _STEP_CYCLES = step_cycles(model)
+    _MACHINES.clear()
+
+
+# 読み込んだ直後の状態のシミュレータとその History を返す．
+def _machine(pid) :
+    entry = _MACHINES.pop(pid, None)
+    if entry is None :
+        from snapshot import History
+        if _BLOCK :
+            from block import BlockSimulator as cls
+        else :
+            from sim import Simulator as cls
+        sim = cls(base=_BASE)
+        words = _PROGRAMS[pid]
+        sim.load_image(memoryview(words).cast('B'), _BASE)
+        hist = History(sim, interval=1 << 62, limit=1)
+        entry = (sim, hist, hist.checkpoint())
+        if len(_MACHINES) >= _MAX_MACHINES :
+            del _MACHINES[next(iter(_MACHINES))]
+    else :
+        entry[1].restore(entry[2])
+        entry[0].seg7_log.clear()
+    # 最近使ったものを後ろに置く．
+    _MACHINES[pid] = entry
+    return entry[0], entry[1]
+
+
+# 区間の前の状態 start に戻してその区間を実行し直し，ワード位置 index の
+# JAL x0, 0 を実行した回数を返す．その命令だけを包むので，ほかの命令は数えない．
+def _loop_count(sim, hist, start, index) :
+    end = sim.steps
+    hist.restore(start)
+    count = [ 0 ]
+    def wrap(i, code, f) :
+        if i != index :
+            return f
+        def g() :
+            count[0] += 1
+            return f()
+        return g
+    sim.instrument(wrap)
+    try :
+        sim.run(end - start.steps)
+    finally :
+        sim.instrument(None)
+    return count[0]
+
+
+### @brief ジョブを1つ実行する(ワーカーで実行される)．
+### @param[in] job ジョブの番号
+### @param[in] pid プログラムの番号
+### @param[in] inputs Simulator.set_inputs() の引数の辞書
+### @param[in] max_cycles クロック数の上限
+### @param[in] slice 無限ループを調べる間隔(命令数)
+### @return Result を返す．
+###
+### 種類によるモデルでは上限を slice 命令ごとに調べるので，'limit' の steps は上限を越えうる．
+def run_job(job, pid, inputs, max_cycles, slice=4096) :
+    sim, hist = _machine(pid)
+    if inputs :
+        sim.set_inputs(**inputs)
+    model = _MODEL
+    per_step = _STEP_CYCLES
+    counter = None if per_step is not None else CycleCounter(sim, model)
+    def cycles() :
+        return sim.steps * per_step if counter is None else counter.cycles()
+
+    status = 'limit'
+    error = None
+    steps = None
+    wv = sim.wv
+    try :
+        while True :
+            if counter is None :
+                left = max_cycles // per_step - sim.steps
+                # 無限ループに達した区間を実行し直せるよう，区間の前の状態を残す．
+                start = hist.checkpoint()
+            else :
+                left = slice if counter.cycles() < max_cycles else 0
+            index = (sim.pc & 0xFFFF) >> 2
+            if wv[index] != _SELF_LOOP and left <= 0 :
+                break
+            n = sim.run(min(slice, max(left, 0)))
+            index = (sim.pc & 0xFFFF) >> 2
+            if wv[index] == _SELF_LOOP :
+                status = 'done'
+                extra = _loop_count(sim, hist, start, index) if counter is None else counter.counts[index]
+                steps = sim.steps - extra
+                total = cycles() - extra * model.cycles(JAL)
+                break
+            if n == 0 :
+                break
+    except SimulationError as e :
+        status = 'error'
+        error = str(e)
+    finally :
+        if counter is not None :
+            counter.detach()
+    if steps is None :
+        steps = sim.steps
+        total = cycles()
+    digest = hashlib.blake2b(sim.mem, digest_size=16).hexdigest()
+    return Result(job, pid, inputs, status, steps, total, sim.pc,
+                  tuple(sim.reg[:32]), digest, sim.seg7(), error)
+
+
+def _run_chunk(chunk) :
+    return [ run_job(*args) for args in chunk ]
+
+
+### @brief ジョブをまとめて実行する．
+### @param[in] programs プログラム(asm() の出力，機械語の列または array('I'))のリスト
+### @param[in] jobs (プログラムの番号, 入力の辞書) の列
+### @param[in] max_cycles ジョブごとのクロック数の上限
+### @param[in] workers ワーカーのプロセス数(None の場合は CPU 数，1 の場合はこのプロセスで実行する)
+### @param[in] chunksize 1回に送るジョブの数(None の場合はワーカーごとに 4チャンク程度)
+### @param[in] base プログラムの先頭アドレス
+### @param[in] block True の場合は BlockSimulator を用いる
+### @param[in] slice 無限ループを調べる間隔(命令数)
+### @param[in] model クロック数を求める cost.CostModel (省略時は既定のもの)
+### @return Result を終わった順に返すジェネレータ
+def run_batch(programs, jobs, max_cycles=8000000, workers=None, chunksize=None, base=RAM_BASE, block=True, slice=4096,
+              model=None) :
+    images = [ encode_program(p) for p in programs ]
+    if model is None :
+        model = CostModel()
+    tasks = [ (i, pid, inputs, max_cycles, slice) for i, (pid, inputs) in enumerate(jobs) ]
+    for i, pid, _, _, _ in tasks :
+        if not 0 <= pid < len(images) :
+            raise ValueError('job {} refers to program {} of {}'.format(i, pid, len(images)))
+    # 同じプログラムのジョブを続けて実行する．
+    tasks.sort(key=lambda t: t[1])
+    if workers is None :
+        workers = os.cpu_count() or 1
+    if chunksize is None :
+        chunksize = max(1, min(256, len(tasks) // (workers * 4)))
+    chunks = [ tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize) ]
+
+    if workers == 1 :
+        _init_worker(images, base, block, model)
+        try :
+            for chunk in chunks :
+                yield from _run_chunk(chunk)
+        finally :
+            _MACHINES.clear()
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(images, base, block, model)) as pool :
+        futures = [ pool.submit(_run_chunk, chunk) for chunk in chunks ]
+        try :
+            for future in as_completed(futures) :
+                yield from future.result()
+        finally :
+            for future in futures :
+                future.cancel()
+
+
+if __name__ == '__main__' :
+
+    import sys
+    import time
+    from argparse import ArgumentParser
+    import cost
+    from inst import Inst, asm
+
+    parser = ArgumentParser(description='run programs over many switch settings in parallel')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('-n', '--settings', type=int, default=256, help='switch settings per program')
+    parser.add_argument('-c', '--max-cycles', type=int, default=800000)
+    args = parser.parse_args()
+
+    # dip_a * dip_b を足し算の繰り返しで求めて HEX0-HEX3 に16進で表示し，止まる．
+    def multiply(display) :
+        return [
+            Inst.LUI(5, 0x04000000),
+            Inst.LBU(6, 5, 0x4E),
+            Inst.LBU(7, 5, 0x4F),
+            Inst.ADDI(8, 0, 0),
+            'mul',
+            Inst.LBEQ(7, 0, 'show'),
+            Inst.ADD(8, 8, 6),
+            Inst.ADDI(7, 7, -1),
+            Inst.LJAL(0, 'mul'),
+            'show',
+        ] + display + [ 'end', Inst.LJAL(0, 'end') ]
+    # 値の下位 4桁を 1桁ずつそのまま(0 - 15)表示する．
+    digits = [
+        Inst.ADDI(9, 0, 4),
+        Inst.ADDI(10, 5, 0),
+        'digit',
+        Inst.ANDI(11, 8, 0xF),
+        Inst.SB(10, 11, 0),
+        Inst.SRLI(8, 8, 4),
+        Inst.ADDI(10, 10, 1),
+        Inst.ADDI(9, 9, -1),
+        Inst.LBNE(9, 0, 'digit'),
+    ]
+    # 同じ値を RAM にも残す．
+    saved = [ Inst.LUI(12, 0x10008000), Inst.SW(12, 8, 0) ] + digits
+    # 表示を繰り返して止まらない(命令数の上限で終わる)．
+    refresh = [ Inst.ADDI(13, 8, 0), 'refresh', Inst.ADDI(8, 13, 0) ] + digits + [ Inst.LJAL(0, 'refresh') ]
+    programs = [ asm(multiply(digits)), asm(multiply(saved)), asm(multiply(refresh)) ]
+    settings = [ { 'dip_a' : (k * 37) & 0xFF, 'dip_b' : k & 0xFF } for k in range(args.settings) ]
+    jobs = [ (p, s) for p in range(len(programs)) for s in settings ]
+
+    # 1命令だけ実行して止まるプログラムの steps と cycles は slice によらない．
+    # 種類によるモデルでは JAL x0, 0 に達するまでの命令のクロック数を足す．
+    model = CostModel({ 'alu' : 3 })
+    stop = [ Inst.ADDI(5, 0, 1), 'end', Inst.LJAL(0, 'end') ]
+    for m in (None, model) :
+        r, = run_batch([ asm(stop) ], [ (0, {}) ], workers=1, model=m)
+        assert (r.status, r.steps, r.cycles, r.reg[5]) == ('done', 1, (m or CostModel()).cycles(cost.ALU), 1), r
+
+    reference = None
+    for workers in sorted({ 1, args.workers }) :
+        start = time.perf_counter()
+        results = sorted(run_batch(programs, jobs, args.max_cycles, workers), key=lambda r: r.job)
+        elapsed = time.perf_counter() - start
+        counts = {}
+        for r in results :
+            counts[r.status] = counts.get(r.status, 0) + 1
+        print('{} workers: {} jobs in {:.3f} s ({:.0f} jobs/s) {}'.format(
+            workers, len(results), elapsed, len(results) / elapsed, counts))
+        for r in results[:len(settings)] :
+            a, b = r.inputs['dip_a'], r.inputs['dip_b']
+            value = sum(v << (4 * i) for i, v in enumerate(r.seg7[:4]))
+            assert r.status == 'done' and value == (a * b) & 0xFFFF, r
+        per_step = step_cycles(CostModel())
+        assert all(r.status == 'limit' and r.steps == args.max_cycles // per_step for r in results[2 * len(settings):])
+        # 終わったジョブの steps は初めて JAL x0, 0 に達した時点のもの
+        # (4命令 + dip_b 回の繰り返し 4命令 + 表示)．
+        for r in results[:2 * len(settings)] :
+            shown = 2 + 6 * 4 if r.program == 0 else 4 + 6 * 4
+            assert r.steps == 4 + 4 * r.inputs['dip_b'] + 1 + shown and r.cycles == r.steps * per_step, r
+        if reference is None :
+            reference = results
+        elif [ r[:10] for r in results ] != [ r[:10] for r in reference ] :
+            sys.exit('results differ from the sequential run')
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+### @file bench_asm.py
+### @brief inst.py のアセンブラの各段階のベンチマーク
+###
+### 使い方: bench_asm.py [-s sizes] [-r repeat] [-o result.json] [-c baseline.json] [-t threshold] [-i result.json]
+###   すべての形式の命令，ラベル参照と疑似命令を含むプログラムを乱数で作り，
+###   次の段階ごとの時間を測る．
+###     construct : Inst の静的メソッドで命令を作る(Inst.encode() の memo は毎回別の命令になる)
+###     pass1     : Assembler.extend() (アドレスとラベルの決定)
+###     pass2     : Assembler.assemble() (ラベルの解決)
+###     encode    : gen_code()
+###     fields    : get_rd()/get_rs1()/get_rs2() (part() を用いる)と get_imm()
+###     listing   : inst.write_listing() によるラベル付きのリスト
+###     hex       : ihex.write_ihex() による Intel HEX
+###     gen_hex   : 命令ごとの gen_HEX()
+###   各段階は乱数の種を変えた repeat 回(小さいプログラムではもっと多く)の最小値をとる．
+###
+###   -o で結果を JSON で保存する．-c で以前の結果と比べ，threshold(割合)を越えて
+###   遅くなった段階があれば終了コード 1 で終わる．
+###   -i を与えると測定せずにそのファイルの結果を -c の結果と比べる．
+
+import io
+import json
+import platform
+import random
+import sys
+import time
+from argparse import ArgumentParser
+
+from ihex import write_ihex
+from inst import Inst, Assembler, INST_TABLE, write_listing
+
+### @brief 既定のプログラムの大きさ(命令数)
+SIZES = (1000, 100000, 1000000)
+
+### @brief 測定する段階
+STAGES = ('construct', 'pass1', 'pass2', 'encode', 'fields', 'listing', 'hex', 'gen_hex')
+
+# 結果のファイルの形式の版
+_FORMAT_VERSION = 1
+
+# ラベルの間隔(命令数)
+_BLOCK = 16
+
+_BRANCHES = ('LBEQ', 'LBNE', 'LBLT', 'LBGE', 'LBLTU', 'LBGEU')
+
+
+# 形式ごとの即値を作る．
+def _imm(rnd, fmt) :
+    if fmt == 'I' or fmt == 'S' :
+        return rnd.randrange(-0x800, 0x800)
+    if fmt == 'I2' :
+        return rnd.randrange(32)
+    if fmt == 'B' :
+        return rnd.randrange(-0x800, 0x800) * 2
+    if fmt == 'U' :
+        return rnd.randrange(0x100000) << 12
+    if fmt == 'J' :
+        return rnd.randrange(-0x80000, 0x80000) * 2
+    return rnd.randrange(32)
+
+
+### @brief 命令を作る関数と引数の列を作る．
+### @param[in] seed 乱数の種
+### @param[in] length 命令数(疑似命令は1つと数える)
+### @return ラベル(文字列)または (関数, 引数のタプル) のリストを返す．
+###
+### INST_TABLE のすべての命令を順に使い，その間にラベル参照の分岐/JAL と
+### LI/LA/CALL を混ぜる．分岐先は前後 3ブロック以内のラベルとする．
+def make_specs(seed, length) :
+    rnd = random.Random(seed)
+    nlabels = (length + _BLOCK - 1) // _BLOCK
+    specs = []
+    k = 0
+    for i in range(length) :
+        if i % _BLOCK == 0 :
+            specs.append('L{}'.format(i // _BLOCK))
+        near = i // _BLOCK
+        label = 'L{}'.format(rnd.randrange(max(0, near - 3), min(nlabels, near + 4)))
+        r = rnd.random()
+        if r < 0.08 :
+            specs.append((getattr(Inst, rnd.choice(_BRANCHES)), (rnd.randrange(32), rnd.randrange(32), label)))
+        elif r < 0.1 :
+            specs.append((Inst.LJAL, (rnd.randrange(32), label)))
+        elif r < 0.11 :
+            specs.append((Inst.CALL, (label, )))
+        elif r < 0.12 :
+            specs.append((Inst.LA, (rnd.randrange(32), label)))
+        elif r < 0.14 :
+            specs.append((Inst.LI, (rnd.randrange(32), rnd.randrange(-0x80000000, 0x80000000))))
+        else :
+            name, fmt = INST_TABLE[k][:2]
+            k = (k + 1) % len(INST_TABLE)
+            if fmt == 'R' :
+                args = (rnd.randrange(32), rnd.randrange(32), rnd.randrange(32))
+            elif fmt == 'U' or fmt == 'J' :
+                args = (rnd.randrange(32), _imm(rnd, fmt))
+            else :
+                args = (rnd.randrange(32), rnd.randrange(32), _imm(rnd, fmt))
+            specs.append((getattr(Inst, name), args))
+    return specs
+
+
+# 各段階を1回ずつ実行して時間のリストを返す．
+def _run_once(specs) :
+    times = []
+    start = time.perf_counter()
+    program = [ x if type(x) is str else x[0](*x[1]) for x in specs ]
+    times.append(time.perf_counter() - start)
+
+    a = Assembler()
+    start = time.perf_counter()
+    a.extend(program)
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    insts = a.assemble()
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    words = [ inst.gen_code() for inst in insts ]
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for inst in insts :
+        inst.get_rd(); inst.get_rs1(); inst.get_rs2(); inst.get_imm()
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    write_listing(io.StringIO(), insts, labels=a.labels)
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    write_ihex(io.StringIO(), words)
+    times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    lines = [ inst.gen_HEX(i & 0xFFFF) for i, inst in enumerate(insts) ]
+    times.append(time.perf_counter() - start)
+    return times, len(insts)
+
+
+### @brief 1つの大きさのプログラムについて各段階の時間を測る．
+### @param[in] size 命令数
+### @param[in] repeat 繰り返しの回数
+### @return (段階をキーにして秒数(最小値)を持つ辞書, 命令数(疑似命令を展開した後)) を返す．
+def measure(size, repeat) :
+    best = None
+    count = 0
+    for seed in range(repeat) :
+        times, count = _run_once(make_specs(seed, size))
+        best = times if best is None else [ min(x, y) for x, y in zip(best, times) ]
+    return dict(zip(STAGES, best)), count
+
+
+### @brief 2つの結果を比べる．
+### @param[in] old 基準の結果
+### @param[in] new 新しい結果
+### @param[in] threshold 遅くなったとみなす割合
+### @return (表示する行のリスト, 遅くなった (大きさ, 段階) のリスト) を返す．
+def compare(old, new, threshold) :
+    lines = []
+    regressions = []
+    for size, stages in new['results'].items() :
+        base = old['results'].get(size)
+        if base is None :
+            continue
+        for stage in STAGES :
+            if stage not in stages or stage not in base :
+                continue
+            ratio = stages[stage] / base[stage] if base[stage] > 0 else 1.0
+            flag = ''
+            if ratio > 1 + threshold :
+                flag = '  REGRESSION'
+                regressions.append((size, stage))
+            elif ratio < 1 - threshold :
+                flag = '  faster'
+            lines.append('{:>8} {:10} {:10.4f} s -> {:10.4f} s  {:+7.1%}{}'.format(
+                size, stage, base[stage], stages[stage], ratio - 1, flag))
+    return lines, regressions
+
+
+if __name__ == '__main__' :
+
+    parser = ArgumentParser(description='assembler benchmark suite')
+    parser.add_argument('-s', '--sizes', type=lambda s: [ int(x) for x in s.split(',') ], default=list(SIZES),
+                        help='comma-separated program sizes (default: 1000,100000,1000000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('-c', '--compare', help='compare with results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='slowdown ratio reported as a regression (default: 0.1)')
+    parser.add_argument('-i', '--input', help='compare results from this file instead of measuring')
+    args = parser.parse_args()
+
+    if args.input :
+        with open(args.input) as f :
+            result = json.load(f)
+    else :
+        result = {
+            'version' : _FORMAT_VERSION,
+            'python' : platform.python_version(),
+            'machine' : platform.machine(),
+            'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results' : {},
+        }
+        for size in args.sizes :
+            # 小さいプログラムは測定の誤差が大きいので回数を増やす．
+            repeat = max(args.repeat, min(50, 100000 // size))
+            stages, count = measure(size, repeat)
+            result['results'][str(size)] = stages
+            print('{} instructions ({} words), best of {}'.format(size, count, repeat))
+            for stage in STAGES :
+                print('  {:10} {:10.4f} s  {:8.3f} M inst/s'.format(stage, stages[stage], size / stages[stage] / 1e6))
+        if args.output :
+            with open(args.output, 'w') as f :
+                json.dump(result, f, indent=2)
+                f.write('\n')
+
+    if args.compare :
+        with open(args.compare) as f :
+            baseline = json.load(f)
+        lines, regressions = compare(baseline, result, args.threshold)
+        print('\n'.join(lines))
+        if regressions :
+            print('{} regressions beyond {:.0%}'.format(len(regressions), args.threshold))
+            sys.exit(1)
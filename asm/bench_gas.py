@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+
+### @file bench_gas.py
+### @brief gas.py のベンチマーク
+###
+### 使い方: bench_gas.py [-n lines] [-k]
+###   コンパイラの出力に似せた .s ファイルを乱数で作り，
+###   gas.assemble() の1秒あたりの行数を表示する．
+###   -k を指定すると作ったファイルを残し，その名前を表示する．
+
+import os
+import random
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from gas import assemble
+
+# よく使われるレジスタ
+_REGS = ('a0', 'a1', 'a2', 'a3', 'a4', 'a5', 't0', 't1', 't2', 's0', 's1', 's2', 'ra', 'sp')
+_ALU = ('add', 'sub', 'and', 'or', 'xor', 'slt', 'sltu', 'sll', 'srl', 'sra')
+_ALUI = ('addi', 'andi', 'ori', 'xori', 'slti')
+_BRANCH = ('beq', 'bne', 'blt', 'bge', 'bltu', 'bgeu')
+
+
+### @brief 関数の並びからなる .s ファイルの行を作る．
+### @param[in] seed 乱数の種
+### @param[in] nlines 行数
+def make_source(seed, nlines) :
+    rnd = random.Random(seed)
+    lines = [ '\t.text' ]
+    fn = 0
+    # 関数の途中で切れないよう，最後は何もしない命令で埋める．
+    while len(lines) < nlines - 120 :
+        name = 'f{}'.format(fn)
+        fn += 1
+        lines.append('\t.globl\t{}'.format(name))
+        lines.append('{}:'.format(name))
+        lines.append('\taddi\tsp, sp, -32')
+        lines.append('\tsw\tra, 28(sp)')
+        nblocks = rnd.randrange(2, 8)
+        for b in range(nblocks) :
+            lines.append('.L{}_{}:'.format(name, b))
+            for _ in range(rnd.randrange(3, 12)) :
+                k = rnd.random()
+                rd, rs1, rs2 = rnd.choice(_REGS), rnd.choice(_REGS), rnd.choice(_REGS)
+                if k < 0.3 :
+                    lines.append('\t{}\t{}, {}, {}'.format(rnd.choice(_ALU), rd, rs1, rs2))
+                elif k < 0.55 :
+                    lines.append('\t{}\t{}, {}, {}'.format(rnd.choice(_ALUI), rd, rs1, rnd.randrange(-64, 64)))
+                elif k < 0.75 :
+                    lines.append('\tlw\t{}, {}(sp)'.format(rd, rnd.randrange(8) * 4))
+                elif k < 0.9 :
+                    lines.append('\tsw\t{}, {}(sp)'.format(rs2, rnd.randrange(8) * 4))
+                elif k < 0.95 :
+                    lines.append('\tlui\t{}, %hi(data)'.format(rd))
+                    lines.append('\taddi\t{}, {}, %lo(data)'.format(rd, rd))
+                else :
+                    lines.append('\tslli\t{}, {}, {}\t# scale'.format(rd, rs1, rnd.randrange(1, 5)))
+            target = rnd.randrange(nblocks)
+            lines.append('\t{}\t{}, {}, .L{}_{}'.format(rnd.choice(_BRANCH), rnd.choice(_REGS), rnd.choice(_REGS), name, target))
+        if fn > 1 :
+            lines.append('\tcall_{}:\tjal\tra, f{}'.format(fn, rnd.randrange(max(0, fn - 50), fn - 1)))
+        lines.append('\tlw\tra, 28(sp)')
+        lines.append('\taddi\tsp, sp, 32')
+        lines.append('\tjalr\tx0, ra, 0')
+    lines.extend([ '\taddi\tzero, zero, 0' ] * (nlines - 2 - len(lines)))
+    lines.append('\t.align\t2')
+    lines.append('data:\t.word\t0')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__' :
+
+    parser = ArgumentParser(description='GNU-style assembler benchmark')
+    parser.add_argument('-n', '--lines', type=int, default=1000000)
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the generated file')
+    args = parser.parse_args()
+
+    text = make_source(0, args.lines)
+    fd, filename = tempfile.mkstemp(suffix='.s')
+    with os.fdopen(fd, 'w') as f :
+        f.write(text)
+
+    try :
+        runs = []
+        for _ in range(3) :
+            start = time.perf_counter()
+            with open(filename) as f :
+                program = assemble(f.read(), filename=filename)
+            runs.append(time.perf_counter() - start)
+    finally :
+        if not args.keep :
+            os.remove(filename)
+
+    elapsed = min(runs)
+    if args.keep :
+        print('source: {}'.format(filename))
+    print('{} lines, {} bytes, {} labels'.format(args.lines, len(program.image), len(program.labels)))
+    print('assemble: {:7.3f} s  {:9.0f} lines/s'.format(elapsed, args.lines / elapsed))
@@ -0,0 +1,52 @@
+#! /usr/bin/env python3
+
+### @file bench_incremental.py
+### @brief IncrementalAssembler のベンチマーク
+###
+### 使い方: bench_incremental.py [-l length]
+###   乱数で作ったプログラムを asm() で全体をアセンブルし直す時間と，
+###   1行の置き換え/挿入/削除の後に IncrementalAssembler で解決し直す時間を比べる．
+
+import random
+import time
+from argparse import ArgumentParser
+
+from inst import Inst, asm, IncrementalAssembler
+from bench_parallel import make_program
+
+
+if __name__ == '__main__' :
+
+    parser = ArgumentParser(description='incremental assembly benchmark')
+    parser.add_argument('-l', '--length', type=int, default=100000)
+    parser.add_argument('-n', '--edits', type=int, default=100)
+    args = parser.parse_args()
+
+    program = make_program(0, args.length)
+
+    start = time.perf_counter()
+    expected = asm(program)
+    print('asm()        : {:8.2f} ms'.format((time.perf_counter() - start) * 1e3))
+
+    start = time.perf_counter()
+    a = IncrementalAssembler(program)
+    print('initial      : {:8.2f} ms'.format((time.perf_counter() - start) * 1e3))
+    assert a.insts() == expected
+
+    rnd = random.Random(1)
+    edits = [
+        ('replace', lambda i : a.replace(i, i + 1, [ Inst.ADDI(1, 1, 1) ])),
+        ('insert', lambda i : a.insert(i, [ Inst.ADDI(2, 2, 2) ])),
+        ('delete', lambda i : a.delete(i, i + 1)),
+    ]
+    for name, edit in edits :
+        elapsed = 0
+        count = 0
+        for _ in range(args.edits) :
+            i = rnd.randrange(len(a))
+            start = time.perf_counter()
+            edit(i)
+            elapsed += time.perf_counter() - start
+            count += a.reresolved
+        print('{:13}: {:8.2f} ms/edit, {:.0f} fix-ups/edit'.format(
+            name, elapsed / args.edits * 1e3, count / args.edits))
@@ -0,0 +1,89 @@
+#! /usr/bin/env python3
+
+### @file bench_parallel.py
+### @brief 複数のプログラムを並列にアセンブルするベンチマーク
+###
+### 使い方: bench_parallel.py [-n programs] [-l length] [-j max_workers]
+###   乱数で作った独立なプログラムをワーカー数 1 から max_workers まで変えて
+###   ProcessPoolExecutor でアセンブルし，逐次実行に対する速度を表示する．
+###   ThreadPoolExecutor でも同じ結果になることを確かめる．
+
+import os
+import random
+import time
+from array import array
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from inst import Inst, Assembler
+
+_BRANCHES = ('LBEQ', 'LBNE', 'LBLT', 'LBGE', 'LBLTU', 'LBGEU')
+_ALU = ('ADD', 'SUB', 'XOR', 'OR', 'AND', 'SLT', 'SLTU')
+
+
+### @brief 乱数でラベルを含むプログラムを作る．
+### @param[in] seed 乱数の種
+### @param[in] length 命令数
+###
+### ラベル名はプログラムごとに同じものを使うので，ラベルの表が
+### 共有されていると結果が変わる．
+def make_program(seed, length) :
+    rnd = random.Random(seed)
+    program = []
+    nlabels = max(1, length // 16)
+    for i in range(length) :
+        if i % 16 == 0 :
+            program.append('L{}'.format(i // 16))
+        k = rnd.random()
+        if k < 0.1 :
+            # 分岐先は近くのラベル，呼び出し先はどこでもよい．
+            near = i // 16
+            label = 'L{}'.format(rnd.randrange(max(0, near - 4), min(nlabels, near + 5)))
+            program.append(getattr(Inst, rnd.choice(_BRANCHES))(rnd.randrange(32), rnd.randrange(32), label))
+        elif k < 0.15 :
+            program.append(Inst.LJAL(1, 'L{}'.format(rnd.randrange(nlabels))))
+        elif k < 0.6 :
+            program.append(Inst.ADDI(rnd.randrange(32), rnd.randrange(32), rnd.randrange(-2048, 2048)))
+        else :
+            program.append(getattr(Inst, rnd.choice(_ALU))(rnd.randrange(32), rnd.randrange(32), rnd.randrange(32)))
+    return program
+
+
+### @brief プログラムを作ってアセンブルし，機械語の配列を返す．
+def build(seed, length) :
+    a = Assembler()
+    a.extend(make_program(seed, length))
+    return array('I', [ inst.gen_code() for inst in a.assemble() ])
+
+
+def _build_args(args) :
+    return build(*args)
+
+
+if __name__ == '__main__' :
+
+    parser = ArgumentParser(description='parallel assembly benchmark')
+    parser.add_argument('-n', '--programs', type=int, default=200)
+    parser.add_argument('-l', '--length', type=int, default=5000)
+    parser.add_argument('-j', '--max-workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    jobs = [ (seed, args.length) for seed in range(args.programs) ]
+    total = args.programs * args.length
+
+    start = time.perf_counter()
+    expected = [ build(*job) for job in jobs ]
+    serial = time.perf_counter() - start
+    print('serial     : {:7.3f} s  {:9.0f} inst/s'.format(serial, total / serial))
+
+    with ThreadPoolExecutor(max_workers=4) as pool :
+        assert list(pool.map(_build_args, jobs)) == expected
+
+    for workers in range(1, args.max_workers + 1) :
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool :
+            results = list(pool.map(_build_args, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+        elapsed = time.perf_counter() - start
+        assert results == expected
+        print('process x{:<2}: {:7.3f} s  {:9.0f} inst/s  (x{:.2f})'.format(
+            workers, elapsed, total / elapsed, serial / elapsed))
@@ -0,0 +1,586 @@
+#! /usr/bin/env python3
+
+### @file block.py
+### @brief 基本ブロック単位で変換する KAPPA3-RV32I の命令セットシミュレータ
+###
+### 基本ブロック(分岐命令までの命令の並び)を一つの Python の関数に変換して実行する．
+### 入口に戻らない分岐命令の後も分岐しない側の命令を続けて含め，分岐する時はブロックの途中で抜ける．
+### 分岐を含まない短い範囲(GUARD_LIMIT 命令まで)を飛び越す前向きの分岐は，ブロックの中の if 文にする．
+### ブロックの関数は入口の RAM 上のワード位置ごとにキャッシュされ，
+### 次に実行するブロックの関数を返す．
+### ブロックの中ではレジスタをローカル変数に置くので，1命令ごとの呼び出しが不要になる．
+### 自分自身に戻るブロック(ループ)は関数の中で繰り返し実行される．
+###
+### 状態を変えない自己ループ(例えば sample1_7seg.py の最後の JAL による無限ループ)は
+### 一回目の実行の後に検出され，残りの実行命令数を一度に消費する．
+###
+### 変換済みのワードへの書き込みがあると，そのワードを含むブロックは破棄される．
+### 残りの命令数がブロックの長さに満たない場合は Simulator の命令ごとの実行に切り替える．
+### instrument() で命令の関数を包んでいる間も命令ごとの実行となる．
+
+from sim import Simulator, RAM_BASE, _NWORDS
+from inst import decode
+
+### @brief 1ブロックの命令数の上限
+BLOCK_LIMIT = 64
+
+### @brief ブロックの中の if 文にする前向きの分岐が飛び越す命令数の上限
+GUARD_LIMIT = 8
+
+# 分岐命令の条件式
+_BRANCH_COND = {
+    'BEQ'  : '{a} == {b}',
+    'BNE'  : '{a} != {b}',
+    'BLT'  : '({a} ^ 0x80000000) < ({b} ^ 0x80000000)',
+    'BGE'  : '({a} ^ 0x80000000) >= ({b} ^ 0x80000000)',
+    'BLTU' : '{a} < {b}',
+    'BGEU' : '{a} >= {b}',
+}
+
+# 演算命令の式({a}, {b} はレジスタ, {imm} は即値)
+_ALU_EXPR = {
+    'ADDI'  : '({a} + {imm}) & 0xFFFFFFFF',
+    'SLTI'  : '1 if ({a} ^ 0x80000000) < {simm} else 0',
+    'SLTIU' : '1 if {a} < {uimm} else 0',
+    'XORI'  : '{a} ^ {uimm}',
+    'ORI'   : '{a} | {uimm}',
+    'ANDI'  : '{a} & {uimm}',
+    'SLLI'  : '({a} << {imm}) & 0xFFFFFFFF',
+    'SRLI'  : '{a} >> {imm}',
+    'SRAI'  : '((({a} ^ 0x80000000) - 0x80000000) >> {imm}) & 0xFFFFFFFF',
+    'ADD'   : '({a} + {b}) & 0xFFFFFFFF',
+    'SUB'   : '({a} - {b}) & 0xFFFFFFFF',
+    'SLL'   : '({a} << ({b} & 0x1F)) & 0xFFFFFFFF',
+    'SLT'   : '1 if ({a} ^ 0x80000000) < ({b} ^ 0x80000000) else 0',
+    'SLTU'  : '1 if {a} < {b} else 0',
+    'XOR'   : '{a} ^ {b}',
+    'SRL'   : '{a} >> ({b} & 0x1F)',
+    'SRA'   : '((({a} ^ 0x80000000) - 0x80000000) >> ({b} & 0x1F)) & 0xFFFFFFFF',
+    'OR'    : '{a} | {b}',
+    'AND'   : '{a} & {b}',
+}
+
+# ロード命令: (RAM からの読み出し, MU500 からの読み出し, 符号拡張)
+_LOAD = {
+    'LB'  : ('mem[a & 0xFFFF]', 'load_io(a, 1)', 0x80),
+    'LH'  : ('hv[(a & 0xFFFF) >> 1]', 'load_io(a & ~1, 2)', 0x8000),
+    'LW'  : ('wv[(a & 0xFFFF) >> 2]', 'load_io(a & ~3, 4)', 0),
+    'LBU' : ('mem[a & 0xFFFF]', 'load_io(a, 1)', 0),
+    'LHU' : ('hv[(a & 0xFFFF) >> 1]', 'load_io(a & ~1, 2)', 0),
+}
+
+# ストア命令: (RAM への書き込み, 書き込んだワード位置, MU500 への書き込み)
+_STORE = {
+    'SB' : ('a &= 0xFFFF\nmem[a] = {b} & 0xFF\ndirty[a >> 8] = 1', 'a >> 2', 'store_io(a, {b} & 0xFF, 1)'),
+    'SH' : ('a &= 0xFFFF\nhv[a >> 1] = {b} & 0xFFFF\ndirty[a >> 8] = 1', 'a >> 2', 'store_io(a & ~1, {b} & 0xFFFF, 2)'),
+    'SW' : ('a = (a & 0xFFFF) >> 2\nwv[a] = {b}\ndirty[a >> 6] = 1', 'a', 'store_io(a & ~3, {b}, 4)'),
+}
+
+
+### @brief レジスタを表すローカル変数名を返す．
+def _reg(n) :
+    return 'x{}'.format(n) if n else '0'
+
+
+### @brief 命令が読むレジスタを返す．
+def _sources(name, rs1, rs2) :
+    if name in ('LUI', 'AUIPC', 'JAL') :
+        return ()
+    if name in _BRANCH_COND or name in _STORE or name in _ALU_EXPR and not name.endswith('I') :
+        return (rs1, rs2)
+    return (rs1,)
+
+
+### @brief 命令が rd に書き込むかどうか
+def _writes(name, rd) :
+    return rd != 0 and name not in _BRANCH_COND and name not in _STORE
+
+
+### @brief 自己ループの1回の実行が冪等かどうか調べる．
+### @param[in] insts ブロックの命令のリスト
+### @param[in] pure_io 入出力の読み書きが回数によらない時 True
+###
+### 各命令の読むレジスタがその命令以降で書き換えられず，
+### ロードとストアが混在しなければ，2回目の実行は1回目と同じ状態を作る．
+### (入力の値は run() の間は変化しないものとする．)
+### pure_io が False の場合はロードかストアを含むループは冪等としない．
+def _is_idle(insts, pure_io=True) :
+    has_load = False
+    has_store = False
+    later = set()
+    for _, name, rd, rs1, rs2, _ in reversed(insts) :
+        if name in _LOAD :
+            has_load = True
+        elif name in _STORE :
+            has_store = True
+        if _writes(name, rd) :
+            later.add(rd)
+        if any(r in later for r in _sources(name, rs1, rs2)) :
+            return False
+    if not pure_io and (has_load or has_store) :
+        return False
+    return not (has_load and has_store)
+
+
+### @brief 基本ブロック単位で変換する命令セットシミュレータ
+###
+### 使い方は Simulator と同じ．
+class BlockSimulator(Simulator) :
+
+    ### @brief 初期化
+    ### @param[in] program asm() の出力(Inst のリスト)
+    ### @param[in] base プログラムの先頭アドレス
+    def __init__(self, program=None, base=RAM_BASE) :
+        ## @brief 入口のワード位置ごとのブロックの関数
+        self.blocks = [ self.__make_miss(i) for i in range(_NWORDS) ]
+        self.__misses = list(self.blocks)
+        # ワード位置ごとにそのワードを含むブロックの入口のリスト
+        self.__cover = [ None ] * _NWORDS
+        ## @brief 状態を変えない自己ループを早送りするかどうか
+        ##
+        ## 変更はその後に変換されるブロックから有効になる．
+        self.skip_idle = True
+        ## @brief load_io/store_io の読み書きが回数によらない時 True
+        ##
+        ## False の場合はロードやストアを含む自己ループを早送りしない．
+        ## set_io() で関数を設定すると False になる(DeviceBus は装置に従って設定し直す)．
+        self.pure_io = True
+        ## @brief 早送りで消費した命令数
+        self.skipped = 0
+        ## @brief 変換したブロックの数
+        self.translated = 0
+        # instrument() で命令の関数を包んでいる時 True
+        self.__instrumented = False
+        super().__init__(program, base)
+        # 生成したコードの大域変数
+        self.__env = {
+            'm' : self, 'r' : self.reg, 'mem' : self.mem, 'wv' : self.wv, 'hv' : self.hv, 'dirty' : self.dirty,
+            'load_io' : self.load_io, 'store_io' : self.store_io,
+            'code' : self.code, 'invalidate' : self.invalidate, 'blocks' : self.blocks,
+        }
+
+    ### @brief RAM のワードの変換結果を破棄する．
+    ### @param[in] index ワード位置
+    ###
+    ### そのワードを含むブロックもすべて破棄する．
+    def invalidate(self, index) :
+        super().invalidate(index)
+        entries = self.__cover[index]
+        if entries is not None :
+            self.__cover[index] = None
+            blocks = self.blocks
+            misses = self.__misses
+            for entry in entries :
+                blocks[entry] = misses[entry]
+
+    ### @brief MU500 の読み書きを行う関数を設定する．
+    ###
+    ### 生成するコードの大域変数も置き換える．
+    def set_io(self, load_io=None, store_io=None) :
+        self.pure_io = load_io is None and store_io is None
+        super().set_io(load_io, store_io)
+        self.__env['load_io'] = self.load_io
+        self.__env['store_io'] = self.store_io
+
+    ### @brief 命令の関数を包む関数を設定する．
+    ### @param[in] wrap wrap(index, code, f) の形の関数(None で解除)
+    ###
+    ### 包んだ命令はブロックの中では実行できないので，設定している間は
+    ### Simulator の命令ごとの実行に切り替える(CycleCounter, Profiler, TraceRecorder が使える)．
+    def instrument(self, wrap) :
+        super().instrument(wrap)
+        self.__instrumented = wrap is not None
+
+    ### @brief 指定された命令数だけ実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    def run(self, max_steps) :
+        if self.__instrumented :
+            return super().run(max_steps)
+        f = self.blocks[(self.pc >> 2) & 0x3FFF]
+        left = max_steps
+        try :
+            while True :
+                g, left = f(left)
+                if g is None :
+                    break
+                f = g
+        finally :
+            self.steps += max_steps - left
+            self.pc = RAM_BASE + f.index * 4
+        if left :
+            left -= super().run(left)
+        return max_steps - left
+
+    ### @brief 指定された入口のブロックを変換する．
+    ###
+    ### 無条件分岐(JAL)の先がまだブロックに含まれていなければ，その先も同じブロックに含める．
+    ### JALR もブロック内で値の決まるレジスタ(JAL の戻り番地など)による場合は同様に扱う．
+    def __translate(self, entry) :
+        insts = []
+        visited = set()
+        # ブロック内で値の決まったレジスタ
+        consts = { 0 : 0 }
+        # 飛び先の決まった JALR のワード位置と飛び先
+        jumps = {}
+        # if 文にする分岐の命令の番号(1から)と飛び越す命令数
+        guards = {}
+        # 飛び越されうる命令の終わり(この位置の手前まで)
+        guard_end = entry
+        index = entry
+        while len(insts) < BLOCK_LIMIT :
+            code = self.wv[index]
+            decoded = decode(code)
+            if decoded is None :
+                break
+            name, layout = decoded
+            imm = layout.gather(code)
+            rd = (code >> 7) & 0x1F
+            rs1 = (code >> 15) & 0x1F
+            insts.append((index, name, rd, rs1, (code >> 20) & 0x1F, imm))
+            visited.add(index)
+            if name in _BRANCH_COND :
+                # 入口に戻る分岐(ループ)はブロックの最後とする．
+                # それ以外は分岐しない側を続けて含め，分岐する側はブロックを抜ける．
+                t = (index + (imm >> 2)) & 0x3FFF
+                if t == entry or index + 1 in visited :
+                    break
+                # 分岐や未定義の命令を含まない短い範囲を飛び越す分岐は if 文にする．
+                if (index + 1 < t <= index + 1 + GUARD_LIMIT and len(insts) + t - index <= BLOCK_LIMIT and
+                    self.__straight(index + 1, t)) :
+                    guards[len(insts)] = t - index - 1
+                    guard_end = max(guard_end, t)
+            if name == 'JALR' :
+                if rs1 not in consts :
+                    break
+                jumps[index] = ((consts[rs1] + imm) >> 2) & 0x3FFF
+            if _writes(name, rd) :
+                if index < guard_end :
+                    # 実行されないことがあるので値は決まらない．
+                    consts.pop(rd, None)
+                elif name == 'LUI' :
+                    consts[rd] = imm & 0xFFFFFFFF
+                elif name == 'AUIPC' :
+                    consts[rd] = (RAM_BASE + index * 4 + imm) & 0xFFFFFFFF
+                elif name == 'JAL' or name == 'JALR' :
+                    consts[rd] = RAM_BASE + index * 4 + 4
+                elif name == 'ADDI' and rs1 in consts :
+                    consts[rd] = (consts[rs1] + imm) & 0xFFFFFFFF
+                else :
+                    consts.pop(rd, None)
+            if name == 'JAL' or name == 'JALR' :
+                index = jumps[index] if name == 'JALR' else (index + (imm >> 2)) & 0x3FFF
+                if index in visited :
+                    break
+            else :
+                index += 1
+                if index == _NWORDS :
+                    break
+
+        if insts :
+            name = 'b_{:04x}'.format(entry)
+            exec(self.__gen_source(name, entry, insts, jumps, guards), self.__env)
+            f = self.__env.pop(name)
+        else :
+            # 先頭が未定義の命令なので命令ごとの実行に任せる．
+            def f(left) :
+                return None, left
+            visited.add(entry)
+        f.index = entry
+
+        cover = self.__cover
+        code = self.code
+        for i in visited :
+            if cover[i] is None :
+                cover[i] = [ entry ]
+            else :
+                cover[i].append(entry)
+            code[i] = 1
+        self.blocks[entry] = f
+        self.translated += 1
+        return f
+
+    ### @brief ワード位置 start から stop の手前までが分岐を含まない定義済みの命令の並びか調べる．
+    def __straight(self, start, stop) :
+        wv = self.wv
+        for i in range(start, stop) :
+            decoded = decode(wv[i])
+            if decoded is None or decoded[0] in _BRANCH_COND or decoded[0] in ('JAL', 'JALR') :
+                return False
+        return True
+
+    ### @brief ブロックの関数のソースを作る．
+    ### @param[in] name 関数名
+    ### @param[in] entry 入口のワード位置
+    ### @param[in] insts (ワード位置, ニーモニック, rd, rs1, rs2, imm) のリスト
+    ### @param[in] jumps 飛び先の決まった JALR のワード位置と飛び先の辞書
+    ### @param[in] guards if 文にする分岐の命令の番号(1から)と飛び越す命令数の辞書
+    def __gen_source(self, name, entry, insts, jumps, guards) :
+        n = len(insts)
+        last_index, last_name, _, _, _, last_imm = insts[-1]
+        fallthrough = (last_index + 1) & 0x3FFF
+        target = None
+        if last_name in _BRANCH_COND or last_name == 'JAL' :
+            target = (last_index + (last_imm >> 2)) & 0x3FFF
+        elif last_index in jumps :
+            target = jumps[last_index]
+        loop = target == entry
+
+        # 書き込む前に読むレジスタと書き込むレジスタ
+        live = set()
+        written = set()
+        # 飛び越されうる命令の番号
+        guarded = set()
+        for k, m in guards.items() :
+            guarded.update(range(k + 1, k + m + 1))
+        for k, (_, iname, rd, rs1, rs2, _) in enumerate(insts, 1) :
+            live.update(r for r in _sources(iname, rs1, rs2) if r not in written)
+            if _writes(iname, rd) :
+                # 飛び越された時は元の値を書き戻すので読み込んでおく．
+                if k in guarded and rd not in written :
+                    live.add(rd)
+                written.add(rd)
+        # ループでは前の回で書き込んだレジスタも書き戻すので，すべて読み込んでおく．
+        if loop :
+            live |= written
+        live.discard(0)
+
+        lines = []
+        indent = ''
+        def emit(text) :
+            for line in text.split('\n') :
+                lines.append(indent + line)
+
+        # ブロックを抜ける時のコード(left は残りの命令数の式)
+        dirty = written if loop else set()
+        def exit_code(nxt, left='left') :
+            return '\n'.join([ 'r[{0}] = x{0}'.format(i) for i in sorted(dirty) ] +
+                             [ 'return blocks[{}], {}'.format(nxt, left) ])
+
+        emit('def {}(left) :'.format(name))
+        indent = '    '
+        emit('if left < {} :\n    return None, left'.format(n))
+        for i in sorted(live) :
+            emit('x{0} = r[{0}]'.format(i))
+        # ループの中で値の変わらないレジスタをアドレスとするロード/ストアは
+        # ループの前に RAM へのアクセスであることを確かめておき，アドレスの判定を省いた版を作る．
+        fixed = {}
+        if loop :
+            for k, (_, iname, _, rs1, _, imm) in enumerate(insts, 1) :
+                if (iname in _LOAD or iname in _STORE) and rs1 not in written :
+                    fixed[k] = '{} + {}'.format(_reg(rs1), imm) if imm else _reg(rs1)
+
+        def body(fast) :
+            nonlocal indent
+            emit('left -= {}'.format(n))
+            # if 文の中の最後の命令の番号と if 文の始まりの行
+            close = None
+            start = 0
+            for k, (index, iname, rd, rs1, rs2, imm) in enumerate(insts, 1) :
+                if close is not None and k > close :
+                    if len(lines) == start :
+                        emit('pass')
+                    indent = indent[:-4]
+                    close = None
+                a = _reg(rs1)
+                b = _reg(rs2)
+                addr = '{} + {}'.format(a, imm) if imm else a
+                if _writes(iname, rd) :
+                    dirty.add(rd)
+                if iname in _ALU_EXPR :
+                    if rd :
+                        emit('x{} = {}'.format(rd, _ALU_EXPR[iname].format(
+                            a=a, b=b, imm=imm, uimm=imm & 0xFFFFFFFF, simm=(imm ^ 0x80000000) & 0xFFFFFFFF)))
+                elif iname == 'LUI' :
+                    if rd :
+                        emit('x{} = {}'.format(rd, imm & 0xFFFFFFFF))
+                elif iname == 'AUIPC' :
+                    if rd :
+                        emit('x{} = {}'.format(rd, (RAM_BASE + index * 4 + imm) & 0xFFFFFFFF))
+                elif iname in _LOAD :
+                    ram, io, sign = _LOAD[iname]
+                    if not rd :
+                        # 値は捨てるが MU500 からの読み出しは行う(デバイスの副作用のため)．
+                        if not (fast and k in fixed) :
+                            emit('a = {}'.format(addr))
+                            emit('if (a >> 8) == 0x040000 :\n    {}'.format(io))
+                        continue
+                    dst = 'v' if sign else 'x{}'.format(rd)
+                    if fast and k in fixed :
+                        emit('a = a{}\n{} = {}'.format(k, dst, ram))
+                    else :
+                        emit('a = {}'.format(addr))
+                        emit('if (a >> 8) != 0x040000 :\n    {0} = {1}\nelse :\n    {0} = {2}'.format(dst, ram, io))
+                    if sign :
+                        emit('x{} = ((v ^ {s}) - {s}) & 0xFFFFFFFF'.format(rd, s=sign))
+                elif iname in _STORE :
+                    ram, word, io = _STORE[iname]
+                    if fast and k in fixed :
+                        emit('a = a{}'.format(k))
+                        emit(ram.format(b=b))
+                    else :
+                        emit('a = {}'.format(addr))
+                        emit('if (a >> 16) == 0x1000 :')
+                        indent += '    '
+                        emit(ram.format(b=b))
+                        # 変換済みのワードを書き換えたらブロックを抜ける．
+                        emit('if code[{w}] :\n    invalidate({w})'.format(w=word))
+                        indent += '    '
+                        emit(exit_code((index + 1) & 0x3FFF, 'left + {}'.format(n - k)))
+                        indent = indent[:-8]
+                        emit('elif (a >> 8) == 0x040000 :\n    ' + io.format(b=b))
+                elif iname in _BRANCH_COND :
+                    cond = _BRANCH_COND[iname].format(a=a, b=b)
+                    if k in guards :
+                        # 短い範囲を飛び越す分岐は実行しなかった命令数を戻す．
+                        emit('if {} :\n    left += {}\nelse :'.format(cond, guards[k]))
+                        indent += '    '
+                        close = k + guards[k]
+                        start = len(lines)
+                    elif k < n :
+                        # 途中の分岐は分岐する時にブロックを抜ける．
+                        emit('if {} :'.format(cond))
+                        indent += '    '
+                        emit(exit_code((index + (imm >> 2)) & 0x3FFF, 'left + {}'.format(n - k)))
+                        indent = indent[:-4]
+                    elif loop :
+                        emit('if not ({}) :'.format(cond))
+                        indent += '    '
+                        emit(exit_code(fallthrough))
+                        indent = indent[:-4]
+                    else :
+                        emit('if {} :'.format(cond))
+                        indent += '    '
+                        emit(exit_code(target))
+                        indent = indent[:-4]
+                        emit(exit_code(fallthrough))
+                elif iname == 'JAL' or index in jumps :
+                    if rd :
+                        emit('x{} = {}'.format(rd, RAM_BASE + index * 4 + 4))
+                    if k == n and not loop :
+                        emit(exit_code(target))
+                elif iname == 'JALR' :
+                    emit('t = (({}) >> 2) & 0x3FFF'.format(addr))
+                    if rd :
+                        emit('x{} = {}'.format(rd, RAM_BASE + index * 4 + 4))
+                    emit(exit_code('t'))
+            if close is not None :
+                if len(lines) == start :
+                    emit('pass')
+                indent = indent[:-4]
+
+            if loop :
+                # 2回目以降も同じ状態になるループは残りの命令数を早送りする．
+                if self.skip_idle and not guards and _is_idle(insts, self.pure_io) :
+                    emit('m.skipped += left - left % {}'.format(n))
+                    emit(exit_code(entry, 'left % {}'.format(n)))
+                else :
+                    emit('if left < {} :'.format(n))
+                    indent += '    '
+                    emit(exit_code(entry))
+                    indent = indent[:-4]
+            elif target is None and last_name != 'JALR' :
+                emit(exit_code(fallthrough))
+
+        if fixed :
+            conds = []
+            for k, addr in sorted(fixed.items()) :
+                emit('a{} = {}'.format(k, addr))
+                if insts[k - 1][1] in _STORE :
+                    conds.append('(a{0} >> 16) == 0x1000 and not code[(a{0} & 0xFFFF) >> 2]'.format(k))
+                else :
+                    conds.append('(a{} >> 8) != 0x040000'.format(k))
+            emit('if {} :'.format(' and '.join(conds)))
+            indent += '    '
+            # RAM 上のバイト位置に直しておく．
+            for k in sorted(fixed) :
+                emit('a{0} &= 0xFFFF'.format(k))
+            emit('while True :')
+            indent += '    '
+            body(True)
+            indent = indent[:-8]
+        if loop :
+            emit('while True :')
+            indent += '    '
+        body(False)
+        return '\n'.join(lines) + '\n'
+
+    ### @brief 未変換のブロックを変換してから実行する関数を作る．
+    def __make_miss(self, index) :
+        def miss(left) :
+            return self.__translate(index)(left)
+        miss.index = index
+        return miss
+
+
+if __name__ == '__main__' :
+
+    import time
+    from inst import Inst, asm
+
+    # 1 から 1000 までの和を求めることを繰り返す(演算と分岐のみ)．
+    alu = [
+        'outer',
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 1000),
+        'loop',
+        Inst.ADD(6, 6, 7),
+        Inst.ADDI(7, 7, -1),
+        Inst.XOR(8, 6, 7),
+        Inst.SLLI(9, 8, 3),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+    ]
+    # 同じ計算で途中結果を RAM に書き込んで読み出す．
+    mem = [
+        Inst.LUI(5, 0x10008000),
+        'outer',
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 1000),
+        'loop',
+        Inst.ADD(6, 6, 7),
+        Inst.ADDI(7, 7, -1),
+        Inst.SW(5, 6, 0),
+        Inst.LW(8, 5, 0),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+    ]
+    # 配列の要素を 2倍するサブルーチンを呼び出すことを繰り返す(サイズの小さいブロック)．
+    call = [
+        Inst.LUI(5, 0x10008000),
+        'outer',
+        Inst.ADDI(6, 5, 0),
+        Inst.ADDI(7, 0, 64),
+        'loop',
+        Inst.LJAL(1, 'double'),
+        Inst.ADDI(6, 6, 4),
+        Inst.ADDI(7, 7, -1),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+        'double',
+        Inst.LW(8, 6, 0),
+        Inst.ADD(8, 8, 8),
+        Inst.LBEQ(8, 0, 'skip'),
+        Inst.SW(6, 8, 0),
+        'skip',
+        Inst.JALR(0, 1, 0),
+    ]
+    # sample1_7seg.py と同じ 7セグへの書き込みの無限ループ
+    idle = [
+        Inst.LUI(5, 0x04000000),
+        Inst.ADDI(10, 0, 0x60),
+        Inst.SB(5, 10, 0x00),
+        Inst.JAL(0, -4*1),
+    ]
+
+    n = 5000000
+    for name, program in (('alu', alu), ('mem', mem), ('call', call), ('idle', idle)) :
+        rates = []
+        for cls in (Simulator, BlockSimulator) :
+            sim = cls(asm(program))
+            start = time.perf_counter()
+            sim.run(n)
+            rates.append(n / (time.perf_counter() - start))
+            assert sim.steps == n
+        print('{:5}: {:8.2f} -> {:8.2f} M inst/s (x{:.1f})'.format(
+            name, rates[0] / 1e6, rates[1] / 1e6, rates[1] / rates[0]))
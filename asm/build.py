@@ -0,0 +1,296 @@
+#! /usr/bin/env python3
+
+### @file build.py
+### @brief 多数のプログラムをまとめてアセンブルするコマンド
+###
+### 使い方: build.py [-j jobs] [-o outdir] [-c cachedir] [-b base] [-r record_size] [-f] source...
+###   source は asm() を呼び出す Python のスクリプト(sample1_7seg.py など)または
+###   GNU 形式のアセンブリ言語のファイル(.s)．
+###   それぞれを ProcessPoolExecutor で並列にアセンブルし，outdir に
+###   <名前>.hex (Intel HEX), <名前>.lst (リスト), <名前>.bin (メモリイメージ) を書き出す．
+###
+### Python のスクリプトは標準出力を捨てて実行し，最後に呼び出された asm() または
+### sections.link() の結果を出力とする．
+###
+### 結果はソースの内容，アセンブラ(ASSEMBLER_SOURCES)の内容とオプションのハッシュを
+### キーとして cachedir に保存する．
+### 出力が前回と同じキーで書き出されていればそのソースは何もしない．
+### キャッシュにあれば複写するだけでアセンブルしない．
+### スクリプトが import する他のモジュールの変更はキーに含まれないので，その場合は -f を用いる．
+
+import hashlib
+import io
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+# このファイルのあるディレクトリ
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+### @brief キャッシュのキーに含めるアセンブラのファイル
+###
+### asm(optimizer=...) の結果は peephole.py にもよる．cost.py は peephole.py が読み込むので含める．
+### sections.link() の結果は sections.py と image.py にもよる．
+ASSEMBLER_SOURCES = ('inst.py', 'gas.py', 'ihex.py', 'peephole.py', 'cost.py', 'sections.py', 'image.py', 'build.py')
+
+### @brief 出力の種類(拡張子)
+FORMATS = ('hex', 'lst', 'bin')
+
+# キャッシュの形式の版
+_CACHE_VERSION = 1
+
+# 出力(ディレクトリ/名前)ごとに前回のキーを記録するファイル
+_MANIFEST = 'manifest.json'
+
+
+### @brief アセンブラの版を表すハッシュを返す．
+def assembler_version() :
+    h = hashlib.sha256(str(_CACHE_VERSION).encode())
+    for name in ASSEMBLER_SOURCES :
+        with open(os.path.join(_DIR, name), 'rb') as f :
+            h.update(f.read())
+    return h.hexdigest()
+
+
+### @brief ソースのキャッシュのキーを返す．
+### @param[in] data ソースの内容
+### @param[in] version assembler_version() の値
+### @param[in] options オプションを表す文字列
+def cache_key(data, version, options) :
+    h = hashlib.sha256(version.encode())
+    h.update(options.encode())
+    h.update(data)
+    return h.hexdigest()
+
+
+### @brief 命令のリストの出力を作る．
+### @param[in] words 機械語の列
+### @param[in] base 先頭のアドレス
+### @param[in] labels ラベルをキーにしてアドレスを持つ辞書
+### @param[in] record_size Intel HEX の1レコードのバイト数
+### @param[in] source リストの先頭に書くソースの名前
+### @return 拡張子をキーにして内容(bytes)を持つ辞書を返す．
+def artifacts(words, base, labels, record_size, source) :
+    from ihex import write_ihex
+    from inst import listing
+
+    words = array('I', words)
+    out = io.StringIO()
+    write_ihex(out, words, record_size=record_size)
+    hex_text = out.getvalue()
+
+    lines = [ '# {}\n'.format(source) ]
+    lines.extend(listing(words, base, labels))
+
+    if sys.byteorder != 'little' :
+        words.byteswap()
+    return { 'hex' : hex_text.encode('ascii'), 'lst' : ''.join(lines).encode('utf-8'), 'bin' : words.tobytes() }
+
+
+# 実行中のスクリプトが呼び出した asm()/link() の (機械語のリスト, 先頭アドレス, ラベル) のリスト
+_calls = []
+# 置き換える前の sections.link
+_link = None
+
+
+# asm() と同じことを Assembler で行い，そのラベルを記録する．
+# スクリプトが import したモジュールはワーカーに残って asm を持ち続けるので，
+# ジョブごとに関数を作らず，この関数が実行中のジョブの _calls に記録する．
+def _recording_asm(program, base=0x10000000, optimizer=None) :
+    import inst
+    a = inst.Assembler(base)
+    a.extend(program)
+    if optimizer is not None :
+        a.optimize(optimizer)
+    result = a.assemble()
+    # スクリプトが互換性のための labeltbl を読む場合に備える．
+    inst.labeltbl.clear()
+    inst.labeltbl.update(a.labels)
+    _calls.append(([ i.gen_code() for i in result ], base, dict(a.labels)))
+    return result
+
+
+# sections.link() を呼び出し，そのメモリイメージを記録する．
+def _recording_link(program, base=0x10000000, optimizer=None) :
+    img = _link(program, base, optimizer)
+    _calls.append((img.words[:img.nwords()].tolist(), img.base, dict(img.labels)))
+    return img
+
+
+# Python のスクリプトを実行して，最後に呼び出された asm() または link() の
+# (機械語のリスト, 先頭アドレス, ラベル) を返す．
+def _run_script(path) :
+    global _link
+    import contextlib
+    import runpy
+    import inst
+    import sections
+
+    del _calls[:]
+    saved = inst.asm, sections.link
+    _link = sections.link
+    inst.asm = _recording_asm
+    sections.link = _recording_link
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    try :
+        with contextlib.redirect_stdout(io.StringIO()) :
+            runpy.run_path(path, run_name='__build__')
+    finally :
+        inst.asm, sections.link = saved
+        del sys.path[0]
+    if not _calls :
+        raise RuntimeError('neither asm() nor sections.link() was called')
+    return _calls[-1]
+
+
+### @brief ソースを1つアセンブルする(ワーカーで実行される)．
+### @param[in] path ソースのファイル名
+### @param[in] base .s の先頭アドレス
+### @param[in] record_size Intel HEX の1レコードのバイト数
+### @return 拡張子をキーにして内容を持つ辞書を返す．
+def build_one(path, base, record_size) :
+    if path.endswith('.s') :
+        from gas import assemble
+        with open(path) as f :
+            program = assemble(f.read(), base, path)
+        return artifacts(program.words(), program.base, program.labels, record_size, path)
+    words, base, labels = _run_script(path)
+    return artifacts(words, base, labels, record_size, path)
+
+
+def _build_job(job) :
+    path, base, record_size = job
+    try :
+        return build_one(path, base, record_size), None
+    except Exception as e :
+        return None, str(e) or type(e).__name__
+
+
+# ファイルを一時ファイル経由で置き換える．
+def _write_file(path, data) :
+    tmp = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f :
+        f.write(data)
+    os.replace(tmp, path)
+
+
+### @brief 複数のソースをアセンブルする．
+### @param[in] sources ソースのファイル名のリスト
+### @param[in] outdir 出力先のディレクトリ
+### @param[in] cachedir キャッシュのディレクトリ
+### @param[in] jobs 並列に実行するプロセス数(None の場合は CPU 数)
+### @param[in] base .s の先頭アドレス
+### @param[in] record_size Intel HEX の1レコードのバイト数
+### @param[in] force True の場合はキャッシュを用いない
+### @param[in] log 進捗を書き出すファイル(None の場合は書き出さない)
+### @return (アセンブルした数, キャッシュから複写した数, 何もしなかった数, エラーのリスト) を返す．
+###
+### エラーのリストの要素は (ソースのファイル名, メッセージ)．
+def build(sources, outdir, cachedir, jobs=None, base=0x10000000, record_size=4, force=False, log=None) :
+    stems = {}
+    for path in sources :
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if stem in stems :
+            raise ValueError('{} and {} have the same output name {}'.format(stems[stem], path, stem))
+        stems[stem] = path
+
+    objdir = os.path.join(cachedir, 'objects')
+    os.makedirs(outdir, exist_ok=True)
+    os.makedirs(objdir, exist_ok=True)
+    manifest_path = os.path.join(cachedir, _MANIFEST)
+    try :
+        with open(manifest_path) as f :
+            manifest = json.load(f)
+    except (OSError, ValueError) :
+        manifest = {}
+
+    version = assembler_version()
+    options = 'base={:#x} record_size={}'.format(base, record_size)
+    existing = set(os.listdir(outdir))
+    cached = set(os.listdir(objdir))
+
+    todo = []
+    copied = 0
+    skipped = 0
+    for stem, path in stems.items() :
+        target = os.path.join(outdir, stem)
+        with open(path, 'rb') as f :
+            key = cache_key(f.read(), version, options)
+        outputs = [ '{}.{}'.format(stem, ext) for ext in FORMATS ]
+        if not force and manifest.get(target) == key and all(name in existing for name in outputs) :
+            skipped += 1
+            continue
+        if not force and all('{}.{}'.format(key, ext) in cached for ext in FORMATS) :
+            for ext in FORMATS :
+                with open(os.path.join(objdir, '{}.{}'.format(key, ext)), 'rb') as f :
+                    _write_file(os.path.join(outdir, '{}.{}'.format(stem, ext)), f.read())
+            manifest[target] = key
+            copied += 1
+            if log :
+                print('copied  {}'.format(path), file=log)
+            continue
+        todo.append((stem, path, key))
+
+    errors = []
+    if todo :
+        job_args = [ (path, base, record_size) for _, path, _ in todo ]
+        if len(todo) == 1 or jobs == 1 :
+            results = map(_build_job, job_args)
+            pool = None
+        else :
+            pool = ProcessPoolExecutor(max_workers=jobs)
+            results = pool.map(_build_job, job_args, chunksize=max(1, len(todo) // ((jobs or os.cpu_count() or 1) * 4)))
+        try :
+            for (stem, path, key), (outputs, error) in zip(todo, results) :
+                if error is not None :
+                    errors.append((path, error))
+                    manifest.pop(os.path.join(outdir, stem), None)
+                    continue
+                for ext in FORMATS :
+                    _write_file(os.path.join(objdir, '{}.{}'.format(key, ext)), outputs[ext])
+                    _write_file(os.path.join(outdir, '{}.{}'.format(stem, ext)), outputs[ext])
+                manifest[os.path.join(outdir, stem)] = key
+                if log :
+                    print('built   {}'.format(path), file=log)
+        finally :
+            if pool is not None :
+                pool.shutdown()
+
+    if todo or copied :
+        _write_file(manifest_path, json.dumps(manifest, indent=0, sort_keys=True).encode())
+    return len(todo) - len(errors), copied, skipped, errors
+
+
+if __name__ == '__main__' :
+
+    import time
+
+    parser = ArgumentParser(description='assemble many programs in parallel with an artifact cache')
+    parser.add_argument('-j', '--jobs', type=int, help='number of worker processes (default: CPU count)')
+    parser.add_argument('-o', '--outdir', default='build', help='output directory (default: build)')
+    parser.add_argument('-c', '--cachedir', help='cache directory (default: OUTDIR/.cache)')
+    parser.add_argument('-b', '--base', type=lambda s: int(s, 0), default=0x10000000,
+                        help='address of the first word of .s files (default: 0x10000000)')
+    parser.add_argument('-r', '--record-size', type=int, default=4,
+                        help='bytes per Intel HEX record (default: 4)')
+    parser.add_argument('-f', '--force', action='store_true', help='rebuild everything')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('sources', nargs='+')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try :
+        built, copied, skipped, errors = build(
+            args.sources, args.outdir, args.cachedir or os.path.join(args.outdir, '.cache'),
+            args.jobs, args.base, args.record_size, args.force, None if args.quiet else sys.stderr)
+    except ValueError as e :
+        sys.exit(str(e))
+    for path, message in errors :
+        print('error   {}: {}'.format(path, message), file=sys.stderr)
+    print('{} built, {} copied from cache, {} up to date, {} failed ({:.3f} s)'.format(
+        built, copied, skipped, len(errors), time.perf_counter() - start), file=sys.stderr)
+    if errors :
+        sys.exit(1)
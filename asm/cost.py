@@ -0,0 +1,313 @@
+#! /usr/bin/env python3
+
+### @file cost.py
+### @brief kappa3_light のクロック数の見積もり
+###
+### 命令の種類ごとのフェイズ数の表(CostModel)を用いて次のことを行う．
+###   - 命令列のリストに命令ごとのクロック数を付け，基本ブロックごと，
+###     ループ(後ろ向きの分岐)ごとの合計を示す(CostModel.listing())．
+###   - Simulator での実行を計測して，命令の種類ごとの実行回数から
+###     クロック数と実行時間を求める(CycleCounter)．
+###
+### verilog-src/templates/phasegen.v の生成するフェイズは IF, DE, EX, WB の4つで，
+### どの命令もこの4フェイズで実行される．
+### フェイズを進めるレジスタは clock を2分周した clock2 で動くので(kappa3_light_core_dp.v)，
+### 1フェイズは clock の2クロックとなる．
+### フェイズを省略するコントローラの場合は CostModel に種類ごとのフェイズ数を与える．
+###
+### verilog-src/templates/controller.v はポートの宣言だけで中身がないため，命令の種類ごとに
+### フェイズ数が変わるかどうかはわからない．DEFAULT_PHASES はすべて 4 としているので，
+### 既定のモデルは命令の種類を区別できず，クロック数は命令数の 8 倍に過ぎない．
+### 種類ごとの違いを見積もるには，実装したコントローラに合わせて phases を与えること．
+
+from array import array
+
+from inst import decode, mnemonic
+
+### @brief 命令の種類
+LOAD = 0
+STORE = 1
+BRANCH_TAKEN = 2
+BRANCH_NOT_TAKEN = 3
+JAL = 4
+JALR = 5
+ALU = 6
+UNKNOWN = 7
+
+### @brief 命令の種類の名前
+CLASS_NAMES = ('load', 'store', 'branch_taken', 'branch_not_taken', 'jal', 'jalr', 'alu', 'unknown')
+
+### @brief 命令の種類ごとのフェイズ数の既定値(未定義の命令は実行されない)
+###
+### controller.v が未実装なので，すべての種類を phasegen.v の4フェイズとしている．
+DEFAULT_PHASES = (4, 4, 4, 4, 4, 4, 4, 0)
+
+### @brief 1フェイズあたりのクロック数
+CLOCKS_PER_PHASE = 2
+
+# ニーモニックをキーにして命令の種類を持つ辞書
+# 分岐命令は BRANCH_NOT_TAKEN とする．
+_CLASS = {
+    'LB' : LOAD, 'LH' : LOAD, 'LW' : LOAD, 'LBU' : LOAD, 'LHU' : LOAD,
+    'SB' : STORE, 'SH' : STORE, 'SW' : STORE,
+    'BEQ' : BRANCH_NOT_TAKEN, 'BNE' : BRANCH_NOT_TAKEN, 'BLT' : BRANCH_NOT_TAKEN,
+    'BGE' : BRANCH_NOT_TAKEN, 'BLTU' : BRANCH_NOT_TAKEN, 'BGEU' : BRANCH_NOT_TAKEN,
+    'JAL' : JAL, 'JALR' : JALR,
+}
+
+# RAM のワード数
+_NWORDS = 0x4000
+
+
+### @brief 機械語の命令の種類を返す．
+###
+### 分岐命令は BRANCH_NOT_TAKEN を返す．
+def classify(code) :
+    entry = decode(code)
+    if entry is None :
+        return UNKNOWN
+    return _CLASS.get(entry[0], ALU)
+
+
+### @brief 命令の種類ごとのクロック数の表
+class CostModel :
+
+    ### @brief 初期化
+    ### @param[in] phases 命令の種類の名前(CLASS_NAMES)をキーにしてフェイズ数を持つ辞書
+    ###                   (与えなかった種類は DEFAULT_PHASES)
+    ### @param[in] clocks_per_phase 1フェイズあたりのクロック数
+    def __init__(self, phases=None, clocks_per_phase=CLOCKS_PER_PHASE) :
+        table = list(DEFAULT_PHASES)
+        for name, n in (phases or {}).items() :
+            table[CLASS_NAMES.index(name)] = n
+        ## @brief 命令の種類ごとのフェイズ数
+        self.phases = tuple(table)
+        ## @brief 1フェイズあたりのクロック数
+        self.clocks_per_phase = clocks_per_phase
+
+    ### @brief 命令の種類のクロック数を返す．
+    def cycles(self, cls) :
+        return self.phases[cls] * self.clocks_per_phase
+
+    ### @brief 機械語の命令のクロック数を返す．
+    ### @param[in] code 機械語
+    ### @param[in] taken 分岐命令の場合，分岐する時 True
+    def inst_cycles(self, code, taken=False) :
+        cls = classify(code)
+        if cls == BRANCH_NOT_TAKEN and taken :
+            cls = BRANCH_TAKEN
+        return self.cycles(cls)
+
+    ### @brief クロック数を実行時間(秒)に換算する．
+    ### @param[in] cycles クロック数
+    ### @param[in] clock_hz clock の周波数(Hz)
+    @staticmethod
+    def seconds(cycles, clock_hz) :
+        return cycles / clock_hz
+
+    ### @brief 基本ブロックの先頭のアドレスの集合を返す．
+    ### @param[in] codes 機械語のリスト
+    ### @param[in] base 先頭のアドレス
+    @staticmethod
+    def leaders(codes, base) :
+        end = base + len(codes) * 4
+        result = { base }
+        for i, code in enumerate(codes) :
+            entry = decode(code)
+            if entry is None :
+                continue
+            name, layout = entry
+            pc = base + i * 4
+            if name == 'JAL' or _CLASS.get(name) == BRANCH_NOT_TAKEN :
+                target = pc + layout.gather(code)
+                if base <= target < end :
+                    result.add(target)
+                result.add(pc + 4)
+            elif name == 'JALR' :
+                result.add(pc + 4)
+        return result
+
+    ### @brief ループ(後ろ向きの分岐とその飛び先の間)ごとの1回あたりのクロック数を返す．
+    ### @param[in] codes 機械語のリスト
+    ### @param[in] base 先頭のアドレス
+    ### @return (先頭のアドレス, 後ろ向きの分岐のアドレス, クロック数) のリストを返す．
+    ###
+    ### 後ろ向きの分岐は分岐する，途中の分岐は分岐しないとして数える．
+    def loops(self, codes, base) :
+        result = []
+        for i, code in enumerate(codes) :
+            entry = decode(code)
+            if entry is None :
+                continue
+            name, layout = entry
+            if name != 'JAL' and _CLASS.get(name) != BRANCH_NOT_TAKEN :
+                continue
+            pc = base + i * 4
+            target = pc + layout.gather(code)
+            if not base <= target <= pc :
+                continue
+            start = (target - base) >> 2
+            cycles = sum(self.inst_cycles(c) for c in codes[start:i]) + self.inst_cycles(code, True)
+            result.append((target, pc, cycles))
+        return result
+
+    ### @brief クロック数を付けた命令列のリストの行を返すジェネレータ
+    ### @param[in] insts 命令(Inst)または機械語のリスト
+    ### @param[in] base 先頭のアドレス
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書
+    ###
+    ### 基本ブロックの前にブロックの命令数とクロック数(最後の分岐は分岐しない場合)の行を，
+    ### 最後にループごとのクロック数の行を出力する．
+    ### 分岐命令のクロック数は '分岐する場合/分岐しない場合' と表示する．
+    def listing(self, insts, base=0x10000000, labels=None) :
+        codes = [ x if type(x) is int else x.gen_code() for x in insts ]
+        names = {}
+        for name, addr in (labels or {}).items() :
+            names.setdefault(addr, []).append(name)
+        def label_of(addr) :
+            return ', '.join(names.get(addr, ())) or '{:08x}'.format(addr)
+
+        leaders = sorted(self.leaders(codes, base))
+        leaders.append(base + len(codes) * 4)
+        total = 0
+        for start, end in zip(leaders, leaders[1:]) :
+            block = codes[(start - base) >> 2:(end - base) >> 2]
+            if not block :
+                continue
+            cycles = sum(self.inst_cycles(code) for code in block)
+            total += cycles
+            yield '# block {}: {} insts, {} cycles'.format(label_of(start), len(block), cycles)
+            for i, code in enumerate(block) :
+                line = mnemonic(code) or '<unknown>'
+                if classify(code) == BRANCH_NOT_TAKEN :
+                    cost = '{}/{}'.format(self.inst_cycles(code, True), self.inst_cycles(code))
+                else :
+                    cost = str(self.inst_cycles(code))
+                yield '{:08x} | {:08x} | {:32} | {:>5}'.format(start + i * 4, code, line, cost)
+        yield '# total: {} insts, {} cycles (each instruction once)'.format(len(codes), total)
+        for start, end, cycles in self.loops(codes, base) :
+            yield '# loop {} ({:08x} - {:08x}): {} cycles/iteration'.format(label_of(start), start, end, cycles)
+
+
+### @brief Simulator での実行を計測して命令の種類ごとの実行回数とクロック数を求める．
+###
+### 使い方:
+###   counter = CycleCounter(sim)
+###   sim.run(n)
+###   print(counter.report(clock_hz=20e6))
+###
+### Simulator.instrument() で命令の関数を包み，RAM のワードごとの実行回数と
+### 分岐した回数を数える．BlockSimulator では計測している間は命令ごとの実行となる．
+class CycleCounter :
+
+    ### @brief 初期化
+    ### @param[in] sim Simulator または BlockSimulator
+    ### @param[in] model CostModel(省略時は既定の表)
+    def __init__(self, sim, model=None) :
+        ## @brief CostModel
+        self.model = model or CostModel()
+        ## @brief RAM のワードごとの実行回数
+        self.counts = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとの分岐した回数
+        self.taken = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとの命令の種類(最後に変換された時のもの)
+        self.classes = bytearray([ UNKNOWN ]) * _NWORDS
+        self.__sim = sim
+        sim.instrument(self.__wrap)
+
+    ### @brief 計測をやめる．
+    def detach(self) :
+        self.__sim.instrument(None)
+
+    def __wrap(self, index, code, f) :
+        counts = self.counts
+        cls = classify(code)
+        self.classes[index] = cls
+        if cls != BRANCH_NOT_TAKEN :
+            def g() :
+                counts[index] += 1
+                return f()
+            return g
+        taken = self.taken
+        nxt = (index + 1) & 0x3FFF
+        def g() :
+            counts[index] += 1
+            h = f()
+            if h.index != nxt :
+                taken[index] += 1
+            return h
+        return g
+
+    ### @brief 命令の種類ごとの実行回数のリストを返す．
+    def histogram(self) :
+        hist = [ 0 ] * len(CLASS_NAMES)
+        counts = self.counts
+        classes = self.classes
+        taken = self.taken
+        for i, n in enumerate(counts) :
+            if n :
+                cls = classes[i]
+                if cls == BRANCH_NOT_TAKEN :
+                    hist[BRANCH_TAKEN] += taken[i]
+                    n -= taken[i]
+                hist[cls] += n
+        return hist
+
+    ### @brief 見積もったクロック数を返す．
+    def cycles(self) :
+        model = self.model
+        return sum(n * model.cycles(cls) for cls, n in enumerate(self.histogram()))
+
+    ### @brief 結果を文字列で返す．
+    ### @param[in] clock_hz clock の周波数(Hz, 省略時は時間を表示しない)
+    def report(self, clock_hz=None) :
+        model = self.model
+        hist = self.histogram()
+        lines = []
+        for cls, n in enumerate(hist) :
+            if n :
+                lines.append('{:16} {:12} insts {:14} cycles'.format(CLASS_NAMES[cls], n, n * model.cycles(cls)))
+        cycles = sum(n * model.cycles(cls) for cls, n in enumerate(hist))
+        lines.append('{:16} {:12} insts {:14} cycles'.format('total', sum(hist), cycles))
+        if clock_hz :
+            lines.append('{:.6f} s at {:g} MHz'.format(model.seconds(cycles, clock_hz), clock_hz / 1e6))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__' :
+
+    from argparse import ArgumentParser
+    from inst import Inst, Assembler, print_asm
+    from sim import Simulator
+
+    parser = ArgumentParser(description='estimate kappa3_light cycles of a sample program')
+    # led_driver.v のコメントにある実機のシステムクロックを既定値とする．
+    parser.add_argument('-c', '--clock', type=float, default=20e6, help='clock frequency in Hz')
+    parser.add_argument('-n', '--steps', type=int, default=100000)
+    args = parser.parse_args()
+
+    # 1 から 1000 までの和を RAM に書き込むことを繰り返す．
+    program = [
+        Inst.LUI(5, 0x10008000),
+        'outer',
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 1000),
+        'loop',
+        Inst.ADD(6, 6, 7),
+        Inst.ADDI(7, 7, -1),
+        Inst.SW(5, 6, 0),
+        Inst.LW(8, 5, 0),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+    ]
+    a = Assembler()
+    a.extend(program)
+    insts = a.assemble()
+    model = CostModel()
+    print_asm(insts, model=model, labels=a.labels)
+
+    sim = Simulator(insts)
+    counter = CycleCounter(sim, model)
+    sim.run(args.steps)
+    print(counter.report(args.clock))
+    assert counter.cycles() == args.steps * 4 * CLOCKS_PER_PHASE
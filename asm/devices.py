@@ -0,0 +1,496 @@
+#! /usr/bin/env python3
+
+### @file devices.py
+### @brief MU500 の入出力装置のモデル
+###
+### DeviceBus をシミュレータに取り付けると，0x0400 0000 からの入出力の領域への
+### 読み書きがアドレスの範囲ごとに装置(Device)に振り分けられる．
+###
+###   bus = DeviceBus(sim)
+###   bus.schedule(100000, dip_a=0x12)
+###   with FrameRecorder('out.seg', bus) :
+###       bus.run(10000000)
+###
+### 入出力の領域への読み書きは Simulator.set_io() で登録した関数(Python)を通るが，
+### 7セグ，ドットLED，ボタン，スイッチ(mapped な装置)はその中で bytearray に読み書き
+### するだけで，装置の処理は呼び出さない．出力の変化はストアごとではなく period 命令ごとに
+### 調べ，装置ごとに変化した範囲をまとめた Event として記録する．
+### したがって1周期の間に何度も書き換えられた値は最後の値だけが残る．
+###
+### 入力(dip_a, dip_b, hex_a, hex_b, buttons)は schedule() で時刻(実行した命令数)を
+### 指定して変えられる．値はその時刻ちょうどに(run() を区切って)設定される．
+###
+### load()/store() を持つ装置(mapped = False)は読み書きごとに呼び出される．
+### そのような装置がある場合は BlockSimulator も入出力を含む自己ループを早送りしない．
+
+import struct
+from bisect import insort
+from collections import namedtuple
+
+from sim import IO_BASE, IO_SIZE, SEG7_OFFSET, DOT_OFFSET, BUTTON_OFFSET, HEX_OFFSET, DIP_OFFSET
+
+# 入出力の領域の大きさ(ロード/ストアがこの領域として扱うアドレスの範囲)
+_WINDOW = 0x100
+
+### @brief 出力の変化
+###
+### step は変化を検出した時点の実行命令数，device は装置の名前，
+### offset は装置の中の変化した範囲の先頭，data はその範囲の新しい値．
+Event = namedtuple('Event', 'step device offset data')
+
+
+### @brief 入出力装置
+###
+### mapped が True の装置は DeviceBus の持つ bytearray の [offset, offset + size) を
+### そのまま読み書きする．False の装置は load()/store() を実装する．
+class Device :
+
+    ## @brief メモリと同じく読み書きする装置の時 True
+    mapped = True
+    ## @brief プログラムからの書き込みを受け付ける装置の時 True
+    output = False
+
+    ### @brief 初期化
+    ### @param[in] name 名前
+    ### @param[in] offset 入出力の領域の中の先頭
+    ### @param[in] size バイト数
+    def __init__(self, name, offset, size) :
+        ## @brief 名前
+        self.name = name
+        ## @brief 入出力の領域の中の先頭
+        self.offset = offset
+        ## @brief バイト数
+        self.size = size
+
+    ### @brief 読み出し(mapped = False の装置のみ)
+    ### @param[in] offset 装置の中の位置
+    ### @param[in] size バイト数
+    def load(self, offset, size) :
+        raise NotImplementedError
+
+    ### @brief 書き込み(mapped = False の装置のみ)
+    ### @param[in] offset 装置の中の位置
+    ### @param[in] value 値
+    ### @param[in] size バイト数
+    def store(self, offset, value, size) :
+        raise NotImplementedError
+
+    def __repr__(self) :
+        return '{}({!r}, {:#x}, {})'.format(type(self).__name__, self.name, self.offset, self.size)
+
+
+### @brief 7セグ LED (8行x8桁)
+###
+### 1バイトが1桁で，上位ビットから a, b, c, d, e, f, g, dp の各セグメントに対応する．
+class Seg7(Device) :
+
+    output = True
+
+    def __init__(self, name='seg7', offset=SEG7_OFFSET) :
+        super().__init__(name, offset, 64)
+
+    ### @brief 表示内容を文字で描いた行のリストを返す．
+    ### @param[in] data 64バイトの表示内容
+    ### @param[in] rows 描く行(None の場合は何か点灯している行)
+    @staticmethod
+    def render(data, rows=None) :
+        if rows is None :
+            rows = [ r for r in range(8) if any(data[r * 8:r * 8 + 8]) ]
+        lines = []
+        for r in rows :
+            top = []; mid = []; bot = []
+            for v in data[r * 8:r * 8 + 8] :
+                top.append(' {} '.format('_' if v & 0x80 else ' '))
+                mid.append('{}{}{}'.format('|' if v & 0x04 else ' ', '_' if v & 0x02 else ' ', '|' if v & 0x40 else ' '))
+                bot.append('{}{}{}{}'.format('|' if v & 0x08 else ' ', '_' if v & 0x10 else ' ',
+                                             '|' if v & 0x20 else ' ', '.' if v & 0x01 else ' '))
+            lines.append(' '.join(top))
+            lines.append(' '.join(mid))
+            lines.append(''.join(bot))
+        return lines
+
+
+### @brief ドットマトリクス LED (8x8)
+class DotLed(Device) :
+
+    output = True
+
+    def __init__(self, name='led', offset=DOT_OFFSET) :
+        super().__init__(name, offset, 8)
+
+    ### @brief 表示内容を文字で描いた行のリストを返す．
+    @staticmethod
+    def render(data) :
+        return [ ''.join('#' if v & (0x80 >> i) else '.' for i in range(8)) for v in data ]
+
+
+### @brief プッシュボタン(4行x5列)
+class Buttons(Device) :
+
+    def __init__(self, name='buttons', offset=BUTTON_OFFSET) :
+        super().__init__(name, offset, 4)
+
+
+### @brief ロータリースイッチ(hex_a, hex_b)
+class Rotary(Device) :
+
+    def __init__(self, name='hex', offset=HEX_OFFSET) :
+        super().__init__(name, offset, 2)
+
+
+### @brief DIPスイッチ(dip_a, dip_b)
+class Dip(Device) :
+
+    def __init__(self, name='dip', offset=DIP_OFFSET) :
+        super().__init__(name, offset, 2)
+
+
+### @brief kappa3 のボードの装置のリストを返す．
+def board_devices() :
+    return [ Seg7(), DotLed(), Buttons(), Rotary(), Dip() ]
+
+
+### @brief schedule() で設定できる入力の名前
+INPUTS = ('dip_a', 'dip_b', 'hex_a', 'hex_b', 'buttons')
+
+
+### @brief 装置をシミュレータの入出力の領域に取り付ける．
+class DeviceBus :
+
+    ### @brief 初期化
+    ### @param[in] sim Simulator または BlockSimulator
+    ### @param[in] devices 装置のリスト(省略時は board_devices())
+    ### @param[in] period 出力の変化を調べる間隔(命令数)
+    ### @param[in] script (時刻, 入力の名前をキーにして値を持つ辞書) のリスト
+    ###
+    ### mapped の装置の内容はシミュレータの io と共有する．
+    def __init__(self, sim, devices=None, period=10000, script=()) :
+        if period <= 0 :
+            raise ValueError('period must be positive: {}'.format(period))
+        if devices is None :
+            devices = board_devices()
+        ## @brief シミュレータ
+        self.sim = sim
+        ## @brief 装置のリスト
+        self.devices = list(devices)
+        ## @brief 出力の変化を調べる間隔(命令数)
+        self.period = period
+        ## @brief 記録した Event のリスト
+        self.events = []
+        ## @brief 記録する Event の最大数(None の場合は制限しない)
+        ##
+        ## 古いものから捨てる．FrameRecorder だけを用いる場合は 0 にする．
+        self.max_events = None
+        # Event のリストを受け取る関数
+        self.__listeners = []
+        # 時刻順の (時刻, 通し番号, 入力の辞書)
+        self.__inputs = []
+        self.__seq = 0
+
+        io = sim.io
+        handlers = [ None ] * _WINDOW
+        writable = bytearray(_WINDOW)
+        names = set()
+        used = bytearray(_WINDOW)
+        for dev in self.devices :
+            if dev.name in names :
+                raise ValueError('duplicate device name: {}'.format(dev.name))
+            names.add(dev.name)
+            end = dev.offset + dev.size
+            if dev.offset < 0 or end > (IO_SIZE if dev.mapped else _WINDOW) :
+                raise ValueError('{!r} is outside the I/O window'.format(dev))
+            if any(used[dev.offset:end]) :
+                raise ValueError('{!r} overlaps another device'.format(dev))
+            used[dev.offset:end] = b'\x01' * dev.size
+            for o in range(dev.offset, end) :
+                if not dev.mapped :
+                    handlers[o] = dev
+                elif dev.output :
+                    writable[o] = 1
+        # 変化を調べる装置と前回の内容
+        self.__last = [ [ dev, bytes(io[dev.offset:dev.offset + dev.size]) ] for dev in self.devices if dev.mapped ]
+
+        def load_io(addr, size) :
+            o = addr - IO_BASE
+            dev = handlers[o]
+            if dev is not None :
+                return dev.load(o - dev.offset, size)
+            return int.from_bytes(io[o:o + size], 'little')
+
+        def store_io(addr, value, size) :
+            o = addr - IO_BASE
+            dev = handlers[o]
+            if dev is not None :
+                dev.store(o - dev.offset, value, size)
+            elif writable[o] and writable[o + size - 1] :
+                io[o:o + size] = value.to_bytes(size, 'little')
+            else :
+                for i in range(size) :
+                    if writable[o + i] :
+                        io[o + i] = (value >> (i * 8)) & 0xFF
+
+        sim.set_io(load_io, store_io)
+        # mapped の装置は読み書きの回数によらないので，BlockSimulator の早送りを妨げない．
+        if hasattr(sim, 'pure_io') :
+            sim.pure_io = all(dev.mapped for dev in self.devices)
+        for step, values in script :
+            self.schedule(step, **values)
+
+    ### @brief シミュレータから取り外す．
+    def detach(self) :
+        self.sample()
+        self.sim.set_io()
+
+    ### @brief 入力の変更を予約する．
+    ### @param[in] step 時刻(シミュレータの steps)
+    ### @param[in] values dip_a, dip_b, hex_a, hex_b, buttons の値
+    def schedule(self, step, **values) :
+        for name in values :
+            if name not in INPUTS :
+                raise ValueError('unknown input: {}'.format(name))
+        insort(self.__inputs, (step, self.__seq, values))
+        self.__seq += 1
+
+    ### @brief Event のリストを受け取る関数を登録する．
+    ###
+    ### 関数は変化を調べるたびに(変化があれば)一度だけ呼ばれる．
+    def subscribe(self, listener) :
+        self.__listeners.append(listener)
+
+    ### @brief 登録した関数を削除する．
+    def unsubscribe(self, listener) :
+        self.__listeners.remove(listener)
+
+    ### @brief 装置の現在の内容を返す．
+    ### @param[in] name 装置の名前
+    def state(self, name) :
+        for dev in self.devices :
+            if dev.name == name and dev.mapped :
+                return bytes(self.sim.io[dev.offset:dev.offset + dev.size])
+        raise KeyError(name)
+
+    ### @brief 出力の変化を調べて Event を作る．
+    ### @return 作った Event のリストを返す．
+    def sample(self) :
+        io = self.sim.io
+        step = self.sim.steps
+        events = []
+        for entry in self.__last :
+            dev, last = entry
+            cur = io[dev.offset:dev.offset + dev.size]
+            if cur == last :
+                continue
+            first = 0
+            while cur[first] == last[first] :
+                first += 1
+            end = dev.size
+            while cur[end - 1] == last[end - 1] :
+                end -= 1
+            events.append(Event(step, dev.name, first, bytes(cur[first:end])))
+            entry[1] = bytes(cur)
+        if events :
+            if self.max_events != 0 :
+                self.events.extend(events)
+                if self.max_events is not None and len(self.events) > self.max_events :
+                    del self.events[:len(self.events) - self.max_events]
+            for listener in self.__listeners :
+                listener(events)
+        return events
+
+    # 時刻が来た入力を設定する．
+    def __apply_inputs(self) :
+        inputs = self.__inputs
+        sim = self.sim
+        while inputs and inputs[0][0] <= sim.steps :
+            sim.set_inputs(**inputs.pop(0)[2])
+
+    ### @brief 指定された命令数だけ実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    ###
+    ### 予約した入力の時刻と period ごとに実行を区切る．
+    ### シミュレータが停止した場合(未定義の命令など)は例外をそのまま送出する．
+    def run(self, max_steps) :
+        sim = self.sim
+        period = self.period
+        end = sim.steps + max_steps
+        done = 0
+        try :
+            while sim.steps < end :
+                self.__apply_inputs()
+                stop = min(end, (sim.steps // period + 1) * period)
+                if self.__inputs :
+                    stop = min(stop, self.__inputs[0][0])
+                n = sim.run(stop - sim.steps)
+                done += n
+                if sim.steps % period == 0 :
+                    self.sample()
+                if n == 0 :
+                    break
+        finally :
+            self.sample()
+        self.__apply_inputs()
+        return done
+
+
+### @brief 出力の変化をファイルに書き出す．
+###
+### ファイルは次の形をとる(リトルエンディアン)．
+###   'KSEG', 版(2バイト), 装置の数(2バイト)
+###   装置ごとに 名前の長さ(1バイト), 名前, オフセット(1バイト), バイト数(1バイト)
+###   変化ごとに 時刻(8バイト), 装置の番号(1バイト), 装置の中の位置(1バイト), バイト数(1バイト), 値
+### 最初に取り付けた時点の全装置の内容を時刻 sim.steps の変化として書く．
+class FrameRecorder :
+
+    ### @brief 初期化
+    ### @param[in] path ファイル名
+    ### @param[in] bus 記録する DeviceBus
+    ### @param[in] devices 記録する装置の名前(省略時は出力の装置すべて)
+    def __init__(self, path, bus, devices=None) :
+        if devices is None :
+            devices = [ dev.name for dev in bus.devices if dev.mapped and dev.output ]
+        self.__bus = bus
+        self.__index = { name : i for i, name in enumerate(devices) }
+        table = { dev.name : dev for dev in bus.devices if dev.mapped }
+        self.__f = open(path, 'wb')
+        header = [ struct.pack('<4sHH', b'KSEG', 1, len(devices)) ]
+        for name in devices :
+            dev = table[name]
+            encoded = name.encode()
+            header.append(struct.pack('<B', len(encoded)) + encoded + struct.pack('<BB', dev.offset, dev.size))
+        self.__f.write(b''.join(header))
+        ## @brief 書き出した変化の数
+        self.count = 0
+        self.__write([ Event(bus.sim.steps, name, 0, bus.state(name)) for name in devices ])
+        bus.subscribe(self.__write)
+
+    def __write(self, events) :
+        index = self.__index
+        pack = struct.pack
+        out = []
+        for ev in events :
+            i = index.get(ev.device)
+            if i is not None :
+                out.append(pack('<QBBB', ev.step, i, ev.offset, len(ev.data)))
+                out.append(ev.data)
+                self.count += 1
+        self.__f.write(b''.join(out))
+
+    ### @brief 記録を終えてファイルを閉じる．
+    def close(self) :
+        if not self.__f.closed :
+            self.__bus.unsubscribe(self.__write)
+            self.__f.close()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *args) :
+        self.close()
+
+
+### @brief FrameRecorder のファイルを読む．
+### @param[in] path ファイル名
+### @return (時刻, 装置の名前をキーにして内容を持つ辞書) を時刻ごとに返すジェネレータ
+def read_frames(path) :
+    with open(path, 'rb') as f :
+        data = f.read()
+    magic, version, n = struct.unpack_from('<4sHH', data, 0)
+    if magic != b'KSEG' or version != 1 :
+        raise ValueError('{}: not a frame file'.format(path))
+    pos = 8
+    names = []
+    state = []
+    for _ in range(n) :
+        length = data[pos]
+        names.append(data[pos + 1:pos + 1 + length].decode())
+        state.append(bytearray(data[pos + 2 + length]))
+        pos += 3 + length
+    step = None
+    while pos < len(data) :
+        t, i, offset, size = struct.unpack_from('<QBBB', data, pos)
+        pos += 11
+        if step is not None and t != step :
+            yield step, { name : bytes(s) for name, s in zip(names, state) }
+        step = t
+        state[i][offset:offset + size] = data[pos:pos + size]
+        pos += size
+    if step is not None :
+        yield step, { name : bytes(s) for name, s in zip(names, state) }
+
+
+if __name__ == '__main__' :
+
+    import os
+    import tempfile
+    import time
+    from block import BlockSimulator
+    from inst import Inst
+    from sections import link, Section, Byte
+
+    # dip_a の値を16進2桁で HEX0, HEX1 に表示し続ける．
+    program = [
+        Inst.LUI(5, 0x04000000),
+        Inst.LLUI(6, 'glyph'),
+        Inst.LADDI(6, 6, 'glyph'),
+        'loop',
+        Inst.LBU(7, 5, DIP_OFFSET),
+        Inst.ANDI(8, 7, 0xF),
+        Inst.ADD(8, 6, 8),
+        Inst.LBU(8, 8, 0),
+        Inst.SB(5, 8, 0),
+        Inst.SRLI(9, 7, 4),
+        Inst.ADD(9, 6, 9),
+        Inst.LBU(9, 9, 0),
+        Inst.SB(5, 9, 1),
+        Inst.LJAL(0, 'loop'),
+        Section('.rodata'),
+        'glyph',
+        Byte(0xFC, 0x60, 0xDA, 0xF2, 0x66, 0xB6, 0xBE, 0xE4, 0xFE, 0xF6, 0xEE, 0x3E, 0x9C, 0x7A, 0x9E, 0x8E),
+    ]
+    img = link(program)
+    sim = BlockSimulator()
+    sim.load_image(img.payload(), img.base)
+    bus = DeviceBus(sim, script=[ (i * 500000, { 'dip_a' : i * 0x11 }) for i in range(1, 8) ])
+    path = os.path.join(tempfile.mkdtemp(), 'frames.seg')
+    start = time.perf_counter()
+    with FrameRecorder(path, bus) as rec :
+        n = bus.run(5000000)
+    elapsed = time.perf_counter() - start
+    print('{} steps in {:.3f} s, {} events, {} bytes'.format(n, elapsed, rec.count, os.path.getsize(path)))
+    frames = list(read_frames(path))
+    for step, state in frames[-2:] :
+        print('step {}:'.format(step))
+        print('\n'.join(Seg7.render(state['seg7'])))
+    assert frames[-1][1]['seg7'][:2] == bytes((0xE4, 0xE4))
+    assert bus.state('seg7') == frames[-1][1]['seg7']
+
+    # 読み出しの回数を数える装置のポーリングは，BlockSimulator でも読み出しごとに load() を呼ぶ．
+    class Timer(Device) :
+        mapped = False
+
+        def __init__(self) :
+            super().__init__('timer', 0x80, 4)
+            self.reads = 0
+
+        def load(self, offset, size) :
+            self.reads += 1
+            return 1 if self.reads >= 1000 else 0
+
+    from sim import Simulator
+    from inst import asm
+    poll = asm([
+        Inst.LUI(5, 0x04000000),
+        'wait',
+        Inst.LW(6, 5, 0x80),
+        Inst.LBEQ(6, 0, 'wait'),
+        Inst.ADDI(7, 0, 42),
+        'end',
+        Inst.LJAL(0, 'end'),
+    ])
+    for cls in (Simulator, BlockSimulator) :
+        timer = Timer()
+        sim = cls(poll)
+        DeviceBus(sim, board_devices() + [ timer ]).run(100000)
+        assert timer.reads == 1000 and sim.reg[7] == 42, (cls.__name__, timer.reads, sim.reg[7])
+    print('ok')
@@ -0,0 +1,35 @@
+#! /usr/bin/env python3
+
+### @file disasm.py
+### @brief Intel HEX / バイナリのイメージを逆アセンブルする．
+###
+### 使い方: disasm.py [-b base] file...
+###   拡張子が .hex のファイルは quartus/program1.hex と同じく
+###   ワードアドレスの Intel HEX として，それ以外はリトルエンディアンの
+###   バイナリイメージとして読み込む(.bin はメモリマップする)．
+
+import sys
+from argparse import ArgumentParser
+
+from inst import disassemble
+from image import Image
+
+
+if __name__ == '__main__' :
+
+    parser = ArgumentParser(description='disassemble RV32I images')
+    parser.add_argument('-b', '--base', type=lambda s: int(s, 0), default=0x10000000,
+                        help='address of the first word (default: 0x10000000)')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    out = sys.stdout
+    for filename in args.files :
+        if filename.endswith('.bin') :
+            image = Image.map_bin(filename)
+        else :
+            image = Image().load(filename)
+        words = image.words[:image.nwords()]
+        if len(args.files) > 1 :
+            out.write('{}:\n'.format(filename))
+        out.writelines(line + '\n' for line in disassemble(words, args.base))
@@ -0,0 +1,620 @@
+#! /usr/bin/env python3
+
+### @file gas.py
+### @brief GNU as 形式の RV32I アセンブリ言語(.s ファイル)のアセンブラ
+###
+### 使い方: gas.py [-b base] [-o output] [-r record_size] file.s
+###   output の拡張子が .bin の場合はバイナリ，それ以外は Intel HEX で出力する．
+###   output を省略すると Intel HEX を標準出力に出力する．
+###
+### 対応している記述
+###   ラベル         : name:
+###   レジスタ       : x0 - x31 と ABI 名(zero, ra, sp, gp, tp, t0-t6, s0-s11, fp, a0-a7)
+###   即値           : 10進, 0x, 0b, 0o, シンボル, シンボル+定数, シンボル-定数,
+###                    %hi(式), %lo(式)
+###   命令           : RV32I の全命令(GNU as と同じオペランドの並び)
+###                    lui/auipc の即値は上位20ビットの値，
+###                    分岐/jal の数値の飛び先は GNU as と同じく絶対アドレスとする．
+###   疑似命令       : nop, li, la, mv, not, neg, seqz, snez, sltz, sgtz,
+###                    beqz, bnez, blez, bgez, bltz, bgtz, bgt, ble, bgtu, bleu,
+###                    j, jr, ret, call, tail
+###                    (展開は Inst の LI, LA, MV, NOT, CALL, RET と同じ．
+###                    li のシンボルは lui+addi，call/tail は jal とする)
+###   ディレクティブ : .word, .half, .byte, .align, .p2align, .balign, .equ, .set
+###                    (.text, .globl などのその他のディレクティブは無視する)
+###   コメント       : '#' から行末まで
+###
+### 同じ文字列の文は一度だけ解析し，その結果を使い回す．
+### シンボルを参照する文は解析結果を覚えておき，全体を読んだ後で値を埋める．
+
+import gc
+import re
+import struct
+import sys
+from array import array
+
+from inst import Inst, ENCODE_TABLE, INST_TABLE, AsmError
+
+### @brief プログラムの先頭アドレスの既定値
+RAM_BASE = 0x10000000
+
+### @brief レジスタ名をキーにしてレジスタ番号を持つ辞書
+REGS = { 'x{}'.format(i) : i for i in range(32) }
+REGS.update({
+    'zero' : 0, 'ra' : 1, 'sp' : 2, 'gp' : 3, 'tp' : 4,
+    't0' : 5, 't1' : 6, 't2' : 7, 's0' : 8, 'fp' : 8, 's1' : 9,
+    'a0' : 10, 'a1' : 11, 'a2' : 12, 'a3' : 13, 'a4' : 14, 'a5' : 15, 'a6' : 16, 'a7' : 17,
+    's2' : 18, 's3' : 19, 's4' : 20, 's5' : 21, 's6' : 22, 's7' : 23, 's8' : 24, 's9' : 25,
+    's10' : 26, 's11' : 27, 't3' : 28, 't4' : 29, 't5' : 30, 't6' : 31,
+})
+
+_SYMBOL = r'[A-Za-z_.$][\w.$]*'
+_LABEL = re.compile(r'\s*({})\s*:'.format(_SYMBOL))
+_MEM = re.compile(r'(.*?)\(\s*(\w+)\s*\)$')
+_RELOC = re.compile(r'%(hi|lo)\s*\((.*)\)$')
+_EXPR = re.compile(r'({})\s*(?:([+-])\s*(\w+))?$'.format(_SYMBOL))
+# よく現れる形の文の解析に用いる(シンボルのみ，ラベルのみ)
+_QUICKSYMBOL = re.compile(r'{}$'.format(_SYMBOL))
+_QUICKLABEL = re.compile(r'({})\s*:$'.format(_SYMBOL))
+
+_pack = struct.Struct('<I').pack
+_pack_into = struct.Struct('<I').pack_into
+
+# ディレクティブのデータの大きさ
+_DATA_SIZE = { '.word' : 4, '.4byte' : 4, '.half' : 2, '.short' : 2, '.2byte' : 2, '.byte' : 1 }
+
+# 無視するディレクティブ
+_IGNORED = frozenset(('.text', '.globl', '.global', '.local', '.section', '.type', '.size',
+                      '.file', '.ident', '.option', '.attribute'))
+
+# ニーモニック(小文字)をキーにして命令形式を持つ辞書
+_FORMAT = { name.lower() : fmt for name, fmt, _, _, _ in INST_TABLE }
+for _name in ('LB', 'LH', 'LW', 'LBU', 'LHU') :
+    _FORMAT[_name.lower()] = 'L'
+_FORMAT['jalr'] = 'JALR'
+del _name
+
+# ニーモニック(小文字)をキーにして (命令形式, 機械語の固定部分) を持つ辞書
+_ENCODE = { name.lower() : value for name, value in ENCODE_TABLE.items() }
+
+# レジスタ2つの疑似命令をキーにして Inst を作る関数を持つ辞書
+_PSEUDO_RR = {
+    'mv' : Inst.MV,
+    'not' : Inst.NOT,
+    'neg' : lambda rd, rs : Inst.SUB(rd, 0, rs),
+    'seqz' : lambda rd, rs : Inst.SLTIU(rd, rs, 1),
+    'snez' : lambda rd, rs : Inst.SLTU(rd, 0, rs),
+    'sltz' : lambda rd, rs : Inst.SLT(rd, rs, 0),
+    'sgtz' : lambda rd, rs : Inst.SLT(rd, 0, rs),
+}
+
+# 0 と比べる分岐の疑似命令をキーにして (ニーモニック, x0 を rs1 に置く時 True) を持つ辞書
+_PSEUDO_BZ = {
+    'beqz' : ('beq', False), 'bnez' : ('bne', False),
+    'bltz' : ('blt', False), 'bgez' : ('bge', False),
+    'bgtz' : ('blt', True), 'blez' : ('bge', True),
+}
+
+# オペランドを入れ換える分岐の疑似命令をキーにしてニーモニックを持つ辞書
+_PSEUDO_B = { 'bgt' : 'blt', 'ble' : 'bge', 'bgtu' : 'bltu', 'bleu' : 'bgeu' }
+
+# PC 相対のリロケーションの種類をキーにして (PC から引くオフセット, 変換後の種類) を持つ辞書
+# pcrel_lo は直前の auipc の PC からの相対とする．
+_PCREL = { 'pcrel' : (0, 'pcrel'), 'pcrel_hi' : (0, 'hi'), 'pcrel_lo' : (-4, 'lo') }
+
+
+### @brief 数値またはシンボルの式を解析する．
+### @return (シンボル名または None, 定数) を返す．
+def _parse_expr(s) :
+    s = s.strip()
+    try :
+        return None, int(s, 0)
+    except ValueError :
+        pass
+    m = _EXPR.match(s)
+    if m is None :
+        raise ValueError('bad expression: {}'.format(s))
+    sym, sign, num = m.groups()
+    addend = 0
+    if num is not None :
+        addend = int(num, 0)
+        if sign == '-' :
+            addend = -addend
+    return sym, addend
+
+
+### @brief 即値のオペランドを解析する．
+### @return (リロケーションの種類, シンボル名または None, 定数) を返す．
+def _parse_imm(s) :
+    s = s.strip()
+    if s.startswith('%') :
+        m = _RELOC.match(s)
+        if m is None :
+            raise ValueError('bad relocation: {}'.format(s))
+        return (m.group(1),) + _parse_expr(m.group(2))
+    return (None,) + _parse_expr(s)
+
+
+def _reg(s) :
+    try :
+        return REGS[s.strip()]
+    except KeyError :
+        raise ValueError('bad register: {}'.format(s.strip())) from None
+
+
+def _mem(s) :
+    m = _MEM.match(s.strip())
+    if m is None :
+        raise ValueError('bad memory operand: {}'.format(s.strip()))
+    offset = m.group(1).strip()
+    return _reg(m.group(2)), _parse_imm(offset) if offset else (None, None, 0)
+
+
+### @brief 命令のオペランドを解析する．
+### @param[in] fmt 命令形式
+### @param[in] ops オペランドの文字列のリスト
+### @return (rd, rs1, rs2, (リロケーションの種類, シンボル, 定数)) を返す．
+def _operands(fmt, ops) :
+    n = len(ops)
+    if fmt == 'R' and n == 3 :
+        return _reg(ops[0]), _reg(ops[1]), _reg(ops[2]), (None, None, 0)
+    if (fmt == 'I' or fmt == 'I2') and n == 3 :
+        return _reg(ops[0]), _reg(ops[1]), 0, _parse_imm(ops[2])
+    if fmt == 'L' and n == 2 :
+        rs1, imm = _mem(ops[1])
+        return _reg(ops[0]), rs1, 0, imm
+    if fmt == 'S' and n == 2 :
+        rs1, imm = _mem(ops[1])
+        return 0, rs1, _reg(ops[0]), imm
+    if fmt == 'B' and n == 3 :
+        return 0, _reg(ops[0]), _reg(ops[1]), ('pcrel',) + _parse_expr(ops[2])
+    if fmt == 'U' and n == 2 :
+        rel, sym, value = _parse_imm(ops[1])
+        return _reg(ops[0]), 0, 0, (rel or 'upper', sym, value)
+    if fmt == 'J' and (n == 1 or n == 2) :
+        rd = _reg(ops[0]) if n == 2 else 1
+        return rd, 0, 0, ('pcrel',) + _parse_expr(ops[-1])
+    if fmt == 'JALR' :
+        if n == 1 :
+            return 1, _reg(ops[0]), 0, (None, None, 0)
+        if n == 2 and '(' in ops[1] :
+            rs1, imm = _mem(ops[1])
+            return _reg(ops[0]), rs1, 0, imm
+        if n == 2 :
+            return _reg(ops[0]), _reg(ops[1]), 0, (None, None, 0)
+        if n == 3 :
+            return _reg(ops[0]), _reg(ops[1]), 0, _parse_imm(ops[2])
+    raise ValueError('wrong number of operands')
+
+
+### @brief 疑似命令を展開する．
+### @param[in] mnemonic ニーモニック(小文字)
+### @param[in] ops オペランドの文字列のリスト
+### @return 命令のリストを返す．命令は Inst または
+###         (ニーモニック, rd, rs1, rs2, (リロケーションの種類, シンボル, 定数)) とする．
+###         疑似命令でない場合は None を返す．
+def _pseudo(mnemonic, ops) :
+    n = len(ops)
+    if mnemonic in _PSEUDO_RR :
+        if n == 2 :
+            return [ _PSEUDO_RR[mnemonic](_reg(ops[0]), _reg(ops[1])) ]
+    elif mnemonic in _PSEUDO_BZ :
+        if n == 2 :
+            name, swap = _PSEUDO_BZ[mnemonic]
+            rs = _reg(ops[0])
+            rs1, rs2 = (0, rs) if swap else (rs, 0)
+            return [ (name, 0, rs1, rs2, ('pcrel',) + _parse_expr(ops[1])) ]
+    elif mnemonic in _PSEUDO_B :
+        if n == 3 :
+            return [ (_PSEUDO_B[mnemonic], 0, _reg(ops[1]), _reg(ops[0]), ('pcrel',) + _parse_expr(ops[2])) ]
+    elif mnemonic == 'nop' :
+        if n == 0 :
+            return [ Inst.ADDI(0, 0, 0) ]
+    elif mnemonic == 'li' :
+        if n == 2 :
+            rd = _reg(ops[0])
+            sym, value = _parse_expr(ops[1])
+            if sym is None :
+                return Inst.LI(rd, value)
+            return [ ('lui', rd, 0, 0, ('hi', sym, value)), ('addi', rd, rd, 0, ('lo', sym, value)) ]
+    elif mnemonic == 'la' :
+        if n == 2 :
+            rd = _reg(ops[0])
+            sym, value = _parse_expr(ops[1])
+            return [ ('auipc', rd, 0, 0, ('pcrel_hi', sym, value)), ('addi', rd, rd, 0, ('pcrel_lo', sym, value)) ]
+    elif mnemonic == 'j' or mnemonic == 'call' or mnemonic == 'tail' :
+        if n == 1 :
+            return [ ('jal', 1 if mnemonic == 'call' else 0, 0, 0, ('pcrel',) + _parse_expr(ops[0])) ]
+    elif mnemonic == 'jr' :
+        if n == 1 :
+            return [ Inst.JALR(0, _reg(ops[0]), 0) ]
+    elif mnemonic == 'ret' :
+        if n == 0 :
+            return [ Inst.RET() ]
+    else :
+        return None
+    raise ValueError('wrong number of operands')
+
+
+### @brief 即値の値をリロケーションの種類に従って変換し，範囲を調べる．
+### @param[in] layout 命令形式
+### @param[in] rel リロケーションの種類
+### @param[in] value 値(pcrel の場合は PC からの相対アドレス)
+### @return 命令語中の即値部分を返す．
+def _imm_bits(layout, rel, value) :
+    name = layout.name
+    if name == 'R' :
+        return 0
+    if rel == 'hi' :
+        value = ((value + 0x800) >> 12) << 12
+        if name == 'U' :
+            return layout.scatter(value)
+    elif rel == 'lo' :
+        value = ((value & 0xFFF) ^ 0x800) - 0x800
+    elif rel == 'upper' :
+        if not 0 <= value <= 0xFFFFF :
+            raise ValueError('immediate out of range: {}'.format(value))
+        return layout.scatter(value << 12)
+    if name == 'I' or name == 'S' :
+        lo, hi = -0x800, 0x7FF
+    elif name == 'I2' :
+        lo, hi = 0, 31
+    elif name == 'B' :
+        lo, hi = -0x1000, 0xFFE
+    elif name == 'J' :
+        lo, hi = -0x100000, 0xFFFFE
+    else :
+        raise ValueError('bad relocation for {}-type'.format(name))
+    if not lo <= value <= hi :
+        if rel == 'pcrel' :
+            raise ValueError('branch target out of range: {}'.format(value))
+        raise ValueError('immediate out of range: {}'.format(value))
+    if rel == 'pcrel' and value & 1 :
+        raise ValueError('misaligned branch target: {}'.format(value))
+    # 頻度の高い形式は直接配置する．
+    if name == 'I' or name == 'I2' :
+        return (value & 0xFFF) << 20
+    if name == 'S' :
+        return ((value & 0xFE0) << 20) | ((value & 0x1F) << 7)
+    return layout.scatter(value)
+
+
+### @brief 文の最後のオペランドより前の部分(ニーモニックとレジスタ)を解析する．
+### @return (最後のオペランドの種類, 命令形式の Layout, 機械語) を返す．
+###         最後のオペランドの種類は 'R'(レジスタ), 'B'(分岐先のシンボル),
+###         'I', 'I2'(即値), 'LI', 'LS'(メモリオペランド)のいずれか．
+###         よく現れる形でない場合は None を返す．
+def _head(head) :
+    parts = head.split(None, 1)
+    if len(parts) != 2 :
+        return None
+    mnemonic = parts[0]
+    fmt = _FORMAT.get(mnemonic)
+    if fmt is None :
+        return None
+    layout, code = _ENCODE[mnemonic]
+    ops = [ op.strip() for op in parts[1].split(',') ]
+    if not all(op in REGS for op in ops) :
+        return None
+    if len(ops) == 2 :
+        if fmt == 'B' :
+            return 'B', layout, code | (REGS[ops[0]] << 15) | (REGS[ops[1]] << 20)
+        if fmt == 'R' or fmt == 'I' or fmt == 'I2' :
+            return fmt, layout, code | (REGS[ops[0]] << 7) | (REGS[ops[1]] << 15)
+        if fmt == 'JALR' :
+            return 'I', layout, code | (REGS[ops[0]] << 7) | (REGS[ops[1]] << 15)
+    elif len(ops) == 1 :
+        if fmt == 'S' :
+            return 'LS', layout, code | (REGS[ops[0]] << 20)
+        if fmt == 'L' or fmt == 'JALR' :
+            return 'LI', layout, code | (REGS[ops[0]] << 7)
+    return None
+
+
+### @brief よく現れる形の文を解析する．
+### @param[in] stmt 文
+### @param[in] heads _head() の結果を覚えておく辞書
+### @return 解析結果(assemble() の cache の値)を返す．
+###         解析できない場合は None を返す(エラーも一般の処理に任せる)．
+###
+### 最後のオペランドより前の部分は種類が少ないので解析結果を使い回す．
+def _quick(stmt, heads) :
+    head, comma, tail = stmt.rpartition(',')
+    if not comma :
+        return None
+    h = heads.get(head, False)
+    if h is False :
+        h = heads[head] = _head(head)
+    if h is None :
+        return None
+    kind, layout, code = h
+    tail = tail.strip()
+    if kind == 'R' :
+        if tail not in REGS :
+            return None
+        return _pack(code | (REGS[tail] << 20))
+    if kind == 'B' :
+        if _QUICKSYMBOL.match(tail) is None :
+            return None
+        return (code, layout, 'pcrel', tail, 0)
+    if kind == 'LI' or kind == 'LS' :
+        offset, paren, rs1 = tail.partition('(')
+        rs1 = rs1[:-1].strip() if rs1[-1:] == ')' else None
+        if rs1 not in REGS :
+            return None
+        code |= REGS[rs1] << 15
+        tail = offset.strip() or '0'
+    try :
+        value = int(tail, 0)
+    except ValueError :
+        return None
+    if kind == 'I2' :
+        if not 0 <= value <= 31 :
+            return None
+        return _pack(code | (value << 20))
+    if not -0x800 <= value <= 0x7FF :
+        return None
+    if kind == 'LS' :
+        return _pack(code | ((value & 0xFE0) << 20) | ((value & 0x1F) << 7))
+    return _pack(code | ((value & 0xFFF) << 20))
+
+
+### @brief アセンブルの結果
+class Program :
+
+    ### @brief 初期化
+    ### @param[in] base 先頭アドレス
+    ### @param[in] image 内容(RISC-V のメモリと同じリトルエンディアンのバイト列)
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書
+    def __init__(self, base, image, labels) :
+        ## @brief 先頭アドレス
+        self.base = base
+        ## @brief 内容
+        self.image = image
+        ## @brief ラベルをキーにしてアドレス(.equ の場合は値)を持つ辞書
+        self.labels = labels
+
+    ### @brief 内容をワードの配列で返す．
+    ###
+    ### 端数のバイトは 0 で埋める．
+    def words(self) :
+        words = array('I')
+        words.frombytes(bytes(self.image) + bytes(-len(self.image) % 4))
+        if sys.byteorder != 'little' :
+            words.byteswap()
+        return words
+
+    ### @brief 内容を Inst のリストで返す．
+    ###
+    ### データのワードも命令として扱う．
+    def insts(self) :
+        return [ Inst.intern(code) for code in self.words() ]
+
+
+### @brief アセンブリ言語のテキストをアセンブルする．
+### @param[in] text テキスト
+### @param[in] base 先頭アドレス
+### @param[in] filename エラーメッセージ用のファイル名
+### @return Program を返す．
+###
+### エラーの場合は 'ファイル名:行番号: メッセージ' の AsmError 例外を送出する．
+def assemble(text, base=RAM_BASE, filename='<string>') :
+    buf = bytearray()
+    labels = {}
+    # (オフセット, 行番号, 解析結果) のリスト
+    fixups = []
+    # 行の文字列をキーにして解析結果を持つ辞書
+    # 解析結果はシンボルを含まない命令の場合は機械語のバイト列，
+    # それ以外は (機械語, 命令形式, リロケーションの種類, シンボル, 定数) となる．
+    # シンボルを参照する疑似命令は，それらのリストとなる．
+    cache = {}
+    heads = {}
+    lineno = 0
+    misaligned = 0
+    # 解析結果の組が大量にできて循環参照の回収が何度も走るので，その間は止めておく．
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    cache_get = cache.get
+    add_fixup = fixups.append
+    try :
+        for lineno, line in enumerate(text.split('\n'), 1) :
+            # 空白も含めた行をキーにする．
+            entry = cache_get(line)
+            if entry is None :
+                stmt = line.strip()
+                # ラベルのみの行は覚えない(同じラベルは二度現れない)．
+                if stmt[-1:] == ':' :
+                    m = _QUICKLABEL.match(stmt)
+                    if m is not None :
+                        _define(labels, m.group(1), base + len(buf))
+                        continue
+                entry = _quick(stmt, heads)
+                if entry is None :
+                    entry = _statement(stmt, base, buf, labels, fixups, lineno)
+                    if entry is None :
+                        # 命令の位置がずれるのはディレクティブの後だけ
+                        misaligned = len(buf) & 3
+                        continue
+                    entry, cacheable = entry
+                    # ラベルの定義を含む文は覚えない．
+                    if cacheable :
+                        cache[line] = entry
+                else :
+                    cache[line] = entry
+            if misaligned :
+                raise ValueError('misaligned instruction')
+            if type(entry) is bytes :
+                buf += entry
+            elif type(entry) is tuple :
+                add_fixup((len(buf), lineno, entry))
+                buf += b'\0\0\0\0'
+            else :
+                # シンボルを参照する疑似命令の命令列
+                for e in entry :
+                    if type(e) is bytes :
+                        buf += e
+                    else :
+                        add_fixup((len(buf), lineno, e))
+                        buf += b'\0\0\0\0'
+
+        # シンボルを参照する命令/データの値を埋める．
+        branch = _ENCODE['beq'][0]
+        for offset, lineno, entry in fixups :
+            code, layout, rel, sym, value = entry
+            if sym not in labels :
+                raise ValueError('undefined symbol: {}'.format(sym))
+            value += labels[sym]
+            if layout is None :
+                # データ(code はバイト数)
+                if not -(1 << (code * 8 - 1)) <= value < (1 << (code * 8)) :
+                    raise ValueError('value out of range: {}'.format(value))
+                buf[offset:offset + code] = (value & ((1 << (code * 8)) - 1)).to_bytes(code, 'little')
+                continue
+            if rel == 'pcrel' :
+                value -= base + offset
+                if layout is branch and -0x1000 <= value <= 0xFFE and not value & 1 :
+                    _pack_into(buf, offset, code | ((value & 0x1000) << 19) | ((value & 0x7E0) << 20) |
+                               ((value & 0x1E) << 7) | ((value & 0x800) >> 4))
+                    continue
+            elif rel in _PCREL :
+                adjust, rel = _PCREL[rel]
+                value -= base + offset + adjust
+            _pack_into(buf, offset, code | _imm_bits(layout, rel, value))
+    except ValueError as e :
+        raise AsmError('{}:{}: {}'.format(filename, lineno, e)) from None
+    finally :
+        if gc_enabled :
+            gc.enable()
+
+    return Program(base, buf, labels)
+
+
+def _define(labels, name, value) :
+    if name in labels :
+        raise ValueError('duplicate label: {}'.format(name))
+    labels[name] = value
+
+
+### @brief 一般の文を解析する．
+### @return 命令の場合は (解析結果, 覚えてよい時 True) を返す．
+###         ラベルのみ，ディレクティブの場合は処理して None を返す．
+def _statement(stmt, base, buf, labels, fixups, lineno) :
+    # コメントとラベルを取り除く．
+    body = stmt.split('#', 1)[0].strip()
+    cacheable = True
+    while True :
+        m = _LABEL.match(body)
+        if m is None :
+            break
+        _define(labels, m.group(1), base + len(buf))
+        body = body[m.end():].strip()
+        cacheable = False
+    if not body :
+        return None
+
+    parts = body.split(None, 1)
+    mnemonic = parts[0].lower()
+    rest = parts[1] if len(parts) > 1 else ''
+    if mnemonic.startswith('.') :
+        _directive(mnemonic, rest, buf, labels, fixups, lineno)
+        return None
+
+    ops = rest.split(',') if rest else []
+    fmt = _FORMAT.get(mnemonic)
+    if fmt is not None :
+        rd, rs1, rs2, imm = _operands(fmt, ops)
+        entry, fixed = _instruction(mnemonic, rd, rs1, rs2, imm, base + len(buf))
+        return entry, cacheable and fixed
+    insts = _pseudo(mnemonic, ops)
+    if insts is None :
+        raise ValueError('unknown instruction: {}'.format(parts[0]))
+    entries = []
+    for inst in insts :
+        if type(inst) is tuple :
+            entry, fixed = _instruction(*inst, base + len(buf) + 4 * len(entries))
+            cacheable = cacheable and fixed
+        else :
+            entry = _pack(inst.gen_code())
+        entries.append(entry)
+    if all(type(entry) is bytes for entry in entries) :
+        return b''.join(entries), cacheable
+    return entries, cacheable
+
+
+### @brief 命令を1つ作る．
+### @param[in] pc 命令のアドレス
+### @return (解析結果, 覚えてよい時 True) を返す．
+###
+### 数値の飛び先(PC 相対のリロケーションでシンボルのないもの)は絶対アドレスとして
+### ここで PC からの相対に直すので，その結果は覚えない．
+def _instruction(mnemonic, rd, rs1, rs2, imm, pc) :
+    rel, sym, value = imm
+    layout, code = _ENCODE[mnemonic]
+    code |= (rd << 7) | (rs1 << 15) | (rs2 << 20)
+    if sym is not None :
+        return (code, layout, rel, sym, value), True
+    if rel in _PCREL :
+        adjust, rel = _PCREL[rel]
+        return _pack(code | _imm_bits(layout, rel, value - pc - adjust)), False
+    return _pack(code | _imm_bits(layout, rel, value)), True
+
+
+### @brief ディレクティブを処理する．
+def _directive(name, rest, buf, labels, fixups, lineno) :
+    if name in _DATA_SIZE :
+        size = _DATA_SIZE[name]
+        for item in rest.split(',') :
+            sym, value = _parse_expr(item)
+            if sym is not None :
+                fixups.append((len(buf), lineno, (size, None, None, sym, value)))
+                value = 0
+            elif not -(1 << (size * 8 - 1)) <= value < (1 << (size * 8)) :
+                raise ValueError('value out of range: {}'.format(value))
+            buf += (value & ((1 << (size * 8)) - 1)).to_bytes(size, 'little')
+    elif name in ('.align', '.p2align', '.balign') :
+        n = int(rest.split(',')[0], 0)
+        # RISC-V の .align は .p2align と同じく 2 のべき乗を指定する．
+        align = n if name == '.balign' else 1 << n
+        if align <= 0 or align & (align - 1) :
+            raise ValueError('bad alignment: {}'.format(n))
+        buf += bytes(-len(buf) % align)
+    elif name in ('.equ', '.set') :
+        sym, _, expr = rest.partition(',')
+        ref, value = _parse_expr(expr)
+        if ref is not None :
+            if ref not in labels :
+                raise ValueError('undefined symbol: {}'.format(ref))
+            value += labels[ref]
+        _define(labels, sym.strip(), value)
+    elif name not in _IGNORED :
+        raise ValueError('unknown directive: {}'.format(name))
+
+
+if __name__ == '__main__' :
+
+    from argparse import ArgumentParser
+    from ihex import write_ihex
+
+    parser = ArgumentParser(description='assemble GNU-style RV32I assembly')
+    parser.add_argument('-b', '--base', type=lambda s: int(s, 0), default=RAM_BASE,
+                        help='address of the first word (default: 0x10000000)')
+    parser.add_argument('-o', '--output', help='output file (.hex or .bin)')
+    parser.add_argument('-r', '--record-size', type=int, default=4,
+                        help='bytes per Intel HEX record (default: 4)')
+    parser.add_argument('file')
+    args = parser.parse_args()
+
+    with open(args.file) as f :
+        try :
+            program = assemble(f.read(), args.base, args.file)
+        except AsmError as e :
+            sys.exit(str(e))
+
+    if args.output is None :
+        write_ihex(sys.stdout, program.words(), record_size=args.record_size)
+    elif args.output.endswith('.bin') :
+        with open(args.output, 'wb') as f :
+            f.write(program.image)
+    else :
+        with open(args.output, 'w') as f :
+            write_ihex(f, program.words(), record_size=args.record_size)
@@ -0,0 +1,131 @@
+#! /usr/bin/env python3
+
+### @file ihex.py
+### @brief Intel HEX 形式の出力
+###
+### quartus/program1.hex と同じく，アドレスはメモリのワード(word_size バイト)単位で，
+### ワードの中のバイトは上位から順に並べる．
+### 1レコードに複数のワードを詰めることができる(最大 255 バイト)．
+### アドレスが 16ビットを越える場合は拡張アドレスレコード(タイプ 04 または 02)を出力する．
+
+import io
+import sys
+from array import array
+
+### @brief データレコードの最大のバイト数
+MAX_RECORD_SIZE = 255
+
+### @brief 終了レコード
+EOF_RECORD = ':00000001FF'
+
+# まとめて書き出すレコード数
+_CHUNK = 4096
+
+
+### @brief 1レコード分の行を作る．
+### @param[in] rtype レコードタイプ
+### @param[in] offset アドレス(16ビット)
+### @param[in] data データ(bytes)
+### @return 改行を含まない文字列を返す．
+def ihex_record(rtype, offset, data) :
+    if not 0 <= offset <= 0xFFFF :
+        raise ValueError('record offset out of range: {:x}'.format(offset))
+    record = bytes((len(data), offset >> 8, offset & 0xFF, rtype)) + data
+    return ':{}{:02X}'.format(record.hex().upper(), -sum(record) & 0xFF)
+
+
+### @brief 32ビットの機械語の列を HEX ファイルに書くバイト列に変換する．
+### @param[in] words 機械語の列
+def words_to_bytes(words) :
+    words = array('I', words)
+    if sys.byteorder == 'little' :
+        words.byteswap()
+    return words.tobytes()
+
+
+### @brief Intel HEX 形式の行を順に返すジェネレータ
+### @param[in] data 書き込むデータ(バイト列)または 32ビットの機械語の列
+### @param[in] offset 先頭のアドレス(ワード単位)
+### @param[in] record_size 1レコードのバイト数(word_size の倍数で 255 以下)
+### @param[in] word_size アドレス1つあたりのバイト数
+### @param[in] extended アドレスが 16ビットを越える場合の拡張アドレスレコードの種類
+###                     ('linear': タイプ 04, 'segment': タイプ 02)
+###
+### 各行は改行を含む．最後に終了レコードを返す．
+def ihex_lines(data, offset=0, record_size=4, word_size=4, extended='linear') :
+    if not isinstance(data, (bytes, bytearray, memoryview)) :
+        data = words_to_bytes(data)
+    data = memoryview(data).cast('B')
+    if record_size % word_size != 0 or not 0 < record_size <= MAX_RECORD_SIZE :
+        raise ValueError('bad record size: {}'.format(record_size))
+    if extended not in ('linear', 'segment') :
+        raise ValueError('bad extended address type: {}'.format(extended))
+    words_per_record = record_size // word_size
+    nwords = (len(data) + word_size - 1) // word_size
+    end = offset + nwords
+    if extended == 'linear' and end > 0x100000000 or extended == 'segment' and end > 0x100000 :
+        raise ValueError('address out of range: {:x}'.format(end - 1))
+
+    upper = 0
+    addr = offset
+    pos = 0
+    while addr < end :
+        if addr >> 16 != upper :
+            upper = addr >> 16
+            if extended == 'linear' :
+                yield ihex_record(0x04, 0, upper.to_bytes(2, 'big')) + '\n'
+            else :
+                yield ihex_record(0x02, 0, (upper << 12).to_bytes(2, 'big')) + '\n'
+        # レコードは 64K ワードの境界をまたがない．
+        n = min(words_per_record, end - addr, ((upper + 1) << 16) - addr)
+        size = n * word_size
+        yield ihex_record(0x00, addr & 0xFFFF, bytes(data[pos:pos + size])) + '\n'
+        addr += n
+        pos += size
+    yield EOF_RECORD + '\n'
+
+
+### @brief Intel HEX 形式でストリームに書き出す．
+### @param[in] f 出力先(テキストまたはバイナリのストリーム)
+### @param[in] data, offset, record_size, word_size, extended ihex_lines() と同じ
+###
+### 行をまとめて一度に書き込む．
+def write_ihex(f, data, offset=0, record_size=4, word_size=4, extended='linear') :
+    binary = not isinstance(f, io.TextIOBase)
+    lines = []
+    for line in ihex_lines(data, offset, record_size, word_size, extended) :
+        lines.append(line)
+        if len(lines) == _CHUNK :
+            _write(f, lines, binary)
+            lines = []
+    _write(f, lines, binary)
+
+
+def _write(f, lines, binary) :
+    text = ''.join(lines)
+    f.write(text.encode('ascii') if binary else text)
+
+
+if __name__ == '__main__' :
+
+    import time
+
+    # 4バイトのレコードでは quartus/program1.hex と一致する．
+    program1 = [ 0x040002B7, 0x0482A503, 0x04A2A023, 0xFF5FF06F ]
+    out = io.BytesIO()
+    write_ihex(out, program1)
+    with open('../quartus/program1.hex', 'rb') as f :
+        assert out.getvalue() == f.read()
+
+    # 64K バイト(RAM 全体)のイメージ
+    image = bytes(range(256)) * 256
+    for record_size in (4, 16, 252) :
+        n = 20
+        start = time.perf_counter()
+        for _ in range(n) :
+            out = io.StringIO()
+            write_ihex(out, image, record_size=record_size)
+        elapsed = (time.perf_counter() - start) / n
+        print('record_size={:3}: {:6.2f} ms, {:5} lines'.format(
+            record_size, elapsed * 1e3, out.getvalue().count('\n')))
+    print('OK')
@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+
+### @file image.py
+### @brief メモリイメージの読み込み
+###
+### Intel HEX ファイル(quartus/program1.hex と同じくワード単位のアドレスで，
+### ワードの中のバイトは上位から順に並んだもの)とリトルエンディアンのバイナリファイルを
+### mem64kd と同じ大きさの一つの bytearray に読み込む．
+### bytearray のバイトの並びは RISC-V のメモリと同じ(リトルエンディアン)で，
+### words は実行ホストのバイトオーダでのワードの memoryview (コピーなし)となる．
+
+import mmap
+import re
+from array import array
+
+### @brief mem64kd の大きさ(バイト)
+MEM_SIZE = 0x10000
+
+
+### @brief イメージの読み込みのエラーを表す例外
+###
+### ファイル名と行番号(Intel HEX の場合)，桁を持つ．
+class ImageError(ValueError) :
+
+    def __init__(self, message, filename=None, lineno=None, column=None) :
+        loc = [ str(x) for x in (filename, lineno, column) if x is not None ]
+        if loc :
+            message = '{}: {}'.format(':'.join(loc), message)
+        super().__init__(message)
+        self.filename = filename
+        self.lineno = lineno
+        self.column = column
+
+
+### @brief メモリイメージ
+class Image :
+
+    ### @brief 初期化
+    ### @param[in] size 大きさ(バイト, 4 の倍数)
+    ### @param[in] data 内容として用いるバッファ(省略時は size の bytearray を確保する)
+    def __init__(self, size=MEM_SIZE, data=None) :
+        ## @brief 内容
+        self.data = bytearray(size) if data is None else data
+        ## @brief ワード単位の memoryview
+        self.words = memoryview(self.data).cast('I')
+        ## @brief 読み込んだ範囲の終わり(バイト)
+        self.end = 0
+
+    ### @brief 読み込んだ範囲のワード数
+    def nwords(self) :
+        return (self.end + 3) >> 2
+
+    ### @brief ファイルを読み込む．
+    ### @param[in] filename ファイル名
+    ###
+    ### 拡張子が .hex のファイルは Intel HEX として，それ以外はバイナリとして読み込む．
+    def load(self, filename) :
+        if filename.endswith('.hex') :
+            with open(filename, 'rb') as f :
+                self.load_ihex(f, filename=filename)
+        else :
+            with open(filename, 'rb') as f :
+                self.load_bin(f, filename=filename)
+        return self
+
+    ### @brief バイナリのイメージを先頭から読み込む．
+    ### @param[in] f バイナリファイル
+    ### @param[in] filename エラーメッセージ用のファイル名
+    def load_bin(self, f, filename=None) :
+        n = f.readinto(memoryview(self.data))
+        if f.read(1) :
+            raise ImageError('image is larger than {} bytes'.format(len(self.data)), filename)
+        self.end = max(self.end, n)
+        return self
+
+    ### @brief Intel HEX のイメージを読み込む．
+    ### @param[in] f ファイル(テキストでもバイナリでもよい)
+    ### @param[in] word_size アドレス1つあたりのバイト数(1, 2, 4)
+    ### @param[in] filename エラーメッセージ用のファイル名
+    def load_ihex(self, f, word_size=4, filename=None) :
+        if word_size not in (1, 2, 4) :
+            raise ValueError('bad word size: {}'.format(word_size))
+        text = f.read()
+        if not isinstance(text, str) :
+            text = text.decode('ascii', 'replace')
+        data = self.data
+        size = len(data)
+        end = self.end
+        upper = 0
+        for lineno, line in enumerate(text.splitlines(), 1) :
+            if line[:1] != ':' :
+                line = line.rstrip()
+                if not line :
+                    continue
+                if line[0] != ':' :
+                    raise ImageError("record does not start with ':'", filename, lineno, 1)
+            try :
+                record = bytes.fromhex(line[1:])
+            except ValueError as e :
+                m = re.search(r'position (\d+)', str(e))
+                raise ImageError('bad hex digit', filename, lineno, int(m.group(1)) + 2 if m else None) from None
+            n = len(record) - 5
+            if n < 0 or record[0] != n :
+                raise ImageError('record length mismatch', filename, lineno, 2)
+            if sum(record) & 0xFF :
+                raise ImageError('checksum error (expected {:02X})'.format(-sum(record[:-1]) & 0xFF),
+                                 filename, lineno, len(line) - 1)
+            rtype = record[3]
+            if rtype == 0x00 :
+                offset = (upper + ((record[1] << 8) | record[2])) * word_size
+                if offset + n > size :
+                    raise ImageError('address {:x} is out of memory'.format(offset // word_size),
+                                     filename, lineno, 4)
+                if n == word_size :
+                    # 1ワードのレコード(quartus/program1.hex の形式)
+                    chunk = record[n + 3:3:-1]
+                else :
+                    chunk = record[4:-1]
+                if word_size > 1 and n != word_size :
+                    if n % word_size :
+                        raise ImageError('data is not a multiple of {} bytes'.format(word_size),
+                                         filename, lineno, 10)
+                    # ファイルではワードの上位のバイトが先なのでバイトを入れ換える．
+                    chunk = array('I' if word_size == 4 else 'H', chunk)
+                    chunk.byteswap()
+                data[offset:offset + n] = chunk
+                if offset + n > end :
+                    end = offset + n
+            elif rtype == 0x01 :
+                break
+            elif rtype == 0x02 :
+                upper = int.from_bytes(record[4:-1], 'big') << 4
+            elif rtype == 0x04 :
+                upper = int.from_bytes(record[4:-1], 'big') << 16
+            elif rtype not in (0x03, 0x05) :
+                raise ImageError('unknown record type {:02X}'.format(rtype), filename, lineno, 8)
+        self.end = end
+        return self
+
+    ### @brief バイナリファイルをメモリマップして読み込み専用のイメージを作る．
+    ### @param[in] filename ファイル名
+    ###
+    ### 内容はコピーされない．ファイルの大きさは 4 の倍数でなければならない．
+    @staticmethod
+    def map_bin(filename) :
+        with open(filename, 'rb') as f :
+            size = f.seek(0, 2)
+            if size % 4 :
+                raise ImageError('size {} is not a multiple of 4'.format(size), filename)
+            if size == 0 :
+                return Image(0)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        image = Image(data=mm)
+        image.end = size
+        return image
+
+
+if __name__ == '__main__' :
+
+    import io
+    import time
+    from ihex import write_ihex
+
+    image = Image().load('../quartus/program1.hex')
+    assert list(image.words[:image.nwords()]) == [ 0x040002B7, 0x0482A503, 0x04A2A023, 0xFF5FF06F ]
+
+    # 64K バイトのイメージを 4, 252 バイトのレコードで書いて読み戻す．
+    # (ファイルではワードのバイトの並びが逆になる．)
+    src = bytes(range(256)) * 256
+    expect = array('I')
+    expect.frombytes(src)
+    expect.byteswap()
+    expect = expect.tobytes()
+    for record_size in (4, 252) :
+        out = io.BytesIO()
+        write_ihex(out, src, record_size=record_size)
+        text = out.getvalue()
+        n = 20
+        start = time.perf_counter()
+        for _ in range(n) :
+            image = Image().load_ihex(io.BytesIO(text))
+        elapsed = (time.perf_counter() - start) / n
+        assert image.data == expect
+        print('record_size={:3}: {:6.2f} ms ({:.1f} MB/s of HEX text)'.format(
+            record_size, elapsed * 1e3, len(text) / elapsed / 1e6))
+
+    # エラーの位置
+    bad = text.replace(b':FC0000', b':FC0001', 1)
+    try :
+        Image().load_ihex(io.BytesIO(bad), filename='bad.hex')
+    except ImageError as e :
+        print(e)
+    try :
+        Image().load_ihex(io.StringIO(':0400000004G002B73F\n'), filename='bad.hex')
+    except ImageError as e :
+        print(e)
+    print('OK')
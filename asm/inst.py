@@ -7,9 +7,15 @@
 ### Copyright (C) 2018 Yusuke Matsunaga
 ### All rights reserved.
 
+import io
+import sys
+import threading
+import weakref
+from bisect import bisect_left
 from enum import Enum
+from functools import lru_cache
 
-labeltbl = {}
+from ihex import ihex_record, write_ihex
 
 ### @brief オプコードの定義
 class Opcode(Enum) :
@@ -112,38 +118,23 @@ class Funct7(Enum) :
 ### @param[in] msb 切り出すスライスの msb
 ### @param[in] lsb 切り出すスライスの lsb
 def part(src, msb, lsb) :
-    mask = 0
-    for i in range(lsb, msb + 1) :
-        mask |= (1 << i)
-    ans = src & mask
-    ans >>= lsb
-    return ans
+    return (src >> lsb) & ((1 << (msb - lsb + 1)) - 1)
 
 
 ### @brief 指定されたビット幅の２進数(2の補数表現)に変換する．
 ### @param[in] src 変換する値
 ### @param[in] bw ビット幅
 def pack(src, bw) :
-    mask = 0
-    for i in range(bw - 1) :
-        mask |= (1 << i)
-    m_src = src & mask
-    if src & (1 << (bw - 1)) :
-        return (1 << (bw - 1)) + m_src
-    else :
-        return m_src
+    return src & ((1 << bw) - 1)
 
 
 ### @brief 符号拡張を行う．
 ### @param[in] src 変換する値
 ### @param[in] bw ビット幅
 def unpack(src, bw) :
-    if src & (1 << (bw - 1)) :
-        mask = 0
-        for i in range(bw - 1) :
-            mask |= (1 << i)
-            m_src = src & mask
-        return m_src - (1 << (bw - 1))
+    sign = 1 << (bw - 1)
+    if src & sign :
+        return (src & (sign - 1)) - sign
     else :
         return src
 
@@ -159,366 +150,612 @@ def imm_str(imm) :
     return "{:x}h".format(imm)
 
 
+### @brief 命令形式ごとの即値フィールドの配置を表すクラス
+###
+### fields は (即値の msb, 即値の lsb, 命令語中の lsb) のタプルのリスト．
+### 生成時にマスクとシフト量を求めておき，
+### 符号化(scatter)と即値の取り出し(gather)の両方に用いる．
+class Layout :
+
+    __slots__ = ('name', 'bw', 'signed', 'mask', 'fields')
+
+    ### @brief 初期化
+    ### @param[in] name 形式名
+    ### @param[in] bw 即値のビット幅
+    ### @param[in] signed 即値が符号付きの時 True
+    ### @param[in] fields 即値フィールドの配置
+    def __init__(self, name, bw, signed, fields) :
+        self.name = name
+        self.bw = bw
+        self.signed = signed
+        self.mask = (1 << bw) - 1
+        self.fields = tuple((lsb, (1 << (msb - lsb + 1)) - 1, pos) for msb, lsb, pos in fields)
+
+    ### @brief 即値を命令語中のビット位置に配置する．
+    ### @param[in] imm 即値
+    def scatter(self, imm) :
+        p_imm = imm & self.mask
+        code = 0
+        for lsb, mask, pos in self.fields :
+            code |= ((p_imm >> lsb) & mask) << pos
+        return code
+
+    ### @brief 命令語から即値を取り出す．
+    ### @param[in] code 命令語
+    def gather(self, code) :
+        imm = 0
+        for lsb, mask, pos in self.fields :
+            imm |= ((code >> pos) & mask) << lsb
+        if self.signed :
+            return unpack(imm, self.bw)
+        return imm
+
+
+### @brief 命令形式ごとのフィールド配置
+LAYOUT = {
+    'R'  : Layout('R',   0, False, ()),
+    'I'  : Layout('I',  12, True,  ((11,  0, 20), )),
+    'I2' : Layout('I2',  5, False, (( 4,  0, 20), )),
+    'S'  : Layout('S',  12, True,  ((11,  5, 25), ( 4,  0,  7))),
+    'B'  : Layout('B',  13, True,  ((12, 12, 31), (10,  5, 25), ( 4,  1,  8), (11, 11,  7))),
+    'U'  : Layout('U',  32, False, ((31, 12, 12), )),
+    'J'  : Layout('J',  21, True,  ((20, 20, 31), (10,  1, 21), (11, 11, 20), (19, 12, 12))),
+}
+
+
+### @brief 命令ごとの (ニーモニック, 形式, opcode, funct3, funct7) の定義
+INST_TABLE = (
+    ('LUI',   'U',  Opcode.LUI,   None,         None),
+    ('AUIPC', 'U',  Opcode.AUIPC, None,         None),
+    ('JAL',   'J',  Opcode.JAL,   None,         None),
+    ('JALR',  'I',  Opcode.JALR,  Funct3.JALR,  None),
+    ('BEQ',   'B',  Opcode.BEQ,   Funct3.BEQ,   None),
+    ('BNE',   'B',  Opcode.BNE,   Funct3.BNE,   None),
+    ('BLT',   'B',  Opcode.BLT,   Funct3.BLT,   None),
+    ('BGE',   'B',  Opcode.BGE,   Funct3.BGE,   None),
+    ('BLTU',  'B',  Opcode.BLTU,  Funct3.BLTU,  None),
+    ('BGEU',  'B',  Opcode.BGEU,  Funct3.BGEU,  None),
+    ('LB',    'I',  Opcode.LB,    Funct3.LB,    None),
+    ('LH',    'I',  Opcode.LH,    Funct3.LH,    None),
+    ('LW',    'I',  Opcode.LW,    Funct3.LW,    None),
+    ('LBU',   'I',  Opcode.LBU,   Funct3.LBU,   None),
+    ('LHU',   'I',  Opcode.LHU,   Funct3.LHU,   None),
+    ('SB',    'S',  Opcode.SB,    Funct3.SB,    None),
+    ('SH',    'S',  Opcode.SH,    Funct3.SH,    None),
+    ('SW',    'S',  Opcode.SW,    Funct3.SW,    None),
+    ('ADDI',  'I',  Opcode.ADDI,  Funct3.ADDI,  None),
+    ('SLTI',  'I',  Opcode.SLTI,  Funct3.SLTI,  None),
+    ('SLTIU', 'I',  Opcode.SLTIU, Funct3.SLTIU, None),
+    ('XORI',  'I',  Opcode.XORI,  Funct3.XORI,  None),
+    ('ORI',   'I',  Opcode.ORI,   Funct3.ORI,   None),
+    ('ANDI',  'I',  Opcode.ANDI,  Funct3.ANDI,  None),
+    ('SLLI',  'I2', Opcode.SLLI,  Funct3.SLLI,  Funct7.SLL),
+    ('SRLI',  'I2', Opcode.SRLI,  Funct3.SRLI,  Funct7.SRL),
+    ('SRAI',  'I2', Opcode.SRAI,  Funct3.SRAI,  Funct7.SRA),
+    ('ADD',   'R',  Opcode.ADD,   Funct3.ADD,   Funct7.ADD),
+    ('SUB',   'R',  Opcode.SUB,   Funct3.SUB,   Funct7.SUB),
+    ('SLL',   'R',  Opcode.SLL,   Funct3.SLL,   Funct7.SLL),
+    ('SLT',   'R',  Opcode.SLT,   Funct3.SLT,   Funct7.SLT),
+    ('SLTU',  'R',  Opcode.SLTU,  Funct3.SLTU,  Funct7.SLTU),
+    ('XOR',   'R',  Opcode.XOR,   Funct3.XOR,   Funct7.XOR),
+    ('SRL',   'R',  Opcode.SRL,   Funct3.SRL,   Funct7.SRL),
+    ('SRA',   'R',  Opcode.SRA,   Funct3.SRA,   Funct7.SRA),
+    ('OR',    'R',  Opcode.OR,    Funct3.OR,    Funct7.OR),
+    ('AND',   'R',  Opcode.AND,   Funct3.AND,   Funct7.AND),
+)
+
+
+### @brief 命令の opcode, funct3, funct7 部分の機械語を作る．
+def base_code(opcode, funct3, funct7) :
+    code = opcode.value
+    if funct3 is not None :
+        code |= funct3.value << 12
+    if funct7 is not None :
+        code |= funct7.value << 25
+    return code
+
+
+### @brief ニーモニックをキーにして (Layout, opcode/funct 部分の機械語) を持つ辞書
+ENCODE_TABLE = { name : (LAYOUT[fmt], base_code(opcode, funct3, funct7))
+                 for name, fmt, opcode, funct3, funct7 in INST_TABLE }
+
+
+### @brief opcode, funct3 ごとに命令の識別に用いるビットのマスクを求める．
+###
+### U-type, J-type は opcode のみ，シフト命令と R-type は funct7 までを用いる．
+def match_mask(fmt) :
+    if fmt == 'U' or fmt == 'J' :
+        return 0x0000007F
+    elif fmt == 'R' or fmt == 'I2' :
+        return 0xFE00707F
+    else :
+        return 0x0000707F
+
+
+### @brief (funct3 << 7) | opcode をインデックスとする識別用マスクの表
+###
+### 未定義の組み合わせは None
+MATCH_MASK = [ None ] * 1024
+
+### @brief 識別用マスクをとった機械語をキーにして (ニーモニック, Layout) を持つ辞書
+DECODE_TABLE = {}
+
+def _make_decode_table() :
+    for name, fmt, opcode, funct3, funct7 in INST_TABLE :
+        layout, code = ENCODE_TABLE[name]
+        mask = match_mask(fmt)
+        if funct3 is None :
+            for f3 in range(8) :
+                MATCH_MASK[(f3 << 7) | opcode.value] = mask
+        else :
+            MATCH_MASK[(funct3.value << 7) | opcode.value] = mask
+        DECODE_TABLE[code] = (name, layout)
+
+_make_decode_table()
+
+
+### @brief 機械語を解読する．
+### @param[in] code 32ビットの機械語
+### @return (ニーモニック, Layout) を返す．未定義の命令の場合は None を返す．
+def decode(code) :
+    mask = MATCH_MASK[((code >> 5) & 0x380) | (code & 0x7F)]
+    if mask is None :
+        return None
+    return DECODE_TABLE.get(code & mask)
+
+
+# レジスタ名の表
+_REG = tuple(reg_name(i) for i in range(32))
+
+### @brief R-type の命令のオペランドを表す文字列を返す．
+def _R_operands(layout, code) :
+    return '{0}, {1}, {2}'.format(_REG[(code >> 7) & 0x1F], _REG[(code >> 15) & 0x1F], _REG[(code >> 20) & 0x1F])
+
+### @brief I-type の命令のオペランドを表す文字列を返す．
+def _I_operands(layout, code) :
+    return '{0}, {1}, {2:x}h'.format(_REG[(code >> 7) & 0x1F], _REG[(code >> 15) & 0x1F], layout.gather(code))
+
+### @brief シフト命令のオペランドを表す文字列を返す．
+def _I2_operands(layout, code) :
+    return '{0}, {1}, {2}'.format(_REG[(code >> 7) & 0x1F], _REG[(code >> 15) & 0x1F], (code >> 20) & 0x1F)
+
+### @brief S-type, B-type の命令のオペランドを表す文字列を返す．
+def _SB_operands(layout, code) :
+    return '{0}, {1}, {2:x}h'.format(_REG[(code >> 15) & 0x1F], _REG[(code >> 20) & 0x1F], layout.gather(code))
+
+### @brief U-type, J-type の命令のオペランドを表す文字列を返す．
+def _UJ_operands(layout, code) :
+    return '{0}, {1:x}h'.format(_REG[(code >> 7) & 0x1F], layout.gather(code))
+
+### @brief 形式ごとのオペランドの整形関数
+OPERAND_FORMATTER = {
+    'R'  : _R_operands,
+    'I'  : _I_operands,
+    'I2' : _I2_operands,
+    'S'  : _SB_operands,
+    'B'  : _SB_operands,
+    'U'  : _UJ_operands,
+    'J'  : _UJ_operands,
+}
+
+
+### @brief 機械語をニーモニックに変換する．
+### @param[in] code 32ビットの機械語
+### @return ニーモニックを表す文字列を返す．未定義の命令の場合は None を返す．
+def mnemonic(code) :
+    mask = MATCH_MASK[((code >> 5) & 0x380) | (code & 0x7F)]
+    if mask is None :
+        return None
+    entry = DECODE_TABLE.get(code & mask)
+    if entry is None :
+        return None
+    name, layout = entry
+    return '{:5} {}'.format(name, OPERAND_FORMATTER[layout.name](layout, code))
+
+
+### @brief Inst.encode() が覚えておく命令の数
+ENCODE_CACHE_SIZE = 1 << 14
+
+
 ### @brief RISC-V の命令を表すクラス
+###
+### 命令は 32ビットの機械語のみを保持する．
+### 同一の機械語を持つ命令は Inst.intern() で共有される．
+### 共有の表は弱参照なので，どこからも使われなくなった命令は消える．
 class Inst :
 
+    __slots__ = ('__code', '__weakref__')
+
+    # 機械語をキーにして共有インスタンスの弱参照を持つ辞書
+    __pool = {}
+    # __pool がこの大きさになったら消えた命令の項目を取り除く
+    __limit = 1 << 16
+    __lock = threading.Lock()
+
     ### @brief 初期化
-    def __init__(self, opcode) :
-        # 命令によっては None のままのメンバもある．
-        self.__opcode = opcode
-        self.__funct3 = None
-        self.__funct7 = None
-        self.__rd = None
-        self.__rs1 = None
-        self.__rs2 = None
-        self.__I_31_20 = None  # [11: 0]
-        self.__S_31_25 = None  # [11: 5]
-        self.__S_11_07 = None  # [ 4: 0]
-        self.__B_31_31 = None  # [12:12]
-        self.__B_30_25 = None  # [10: 5]
-        self.__B_11_08 = None  # [ 4: 1]
-        self.__B_07_07 = None  # [11:11]
-        self.__U_31_12 = None  # [31:12]
-        self.__J_31_31 = None  # [20:20]
-        self.__J_30_21 = None  # [10:01]
-        self.__J_20_20 = None  # [11:11]
-        self.__J_19_12 = None  # [19:12]
-
-        self.__cont = False
-#        self.__pc = 0x1000 # for debug
+    ### @param[in] code 32ビットの機械語
+    def __init__(self, code) :
+        self.__code = code
+
+    ### @brief 機械語に対応する共有インスタンスを返す．
+    ### @param[in] code 32ビットの機械語
+    @staticmethod
+    def intern(code) :
+        ref = Inst.__pool.get(code)
+        if ref is not None :
+            inst = ref()
+            if inst is not None :
+                return inst
+        # 複数のスレッドから同時に呼ばれても同じインスタンスを返す．
+        with Inst.__lock :
+            pool = Inst.__pool
+            ref = pool.get(code)
+            inst = ref() if ref is not None else None
+            if inst is None :
+                if len(pool) >= Inst.__limit :
+                    Inst.__sweep()
+                inst = Inst(code)
+                pool[code] = weakref.ref(inst)
+        return inst
+
+    # 消えた命令の項目を取り除き，次に取り除く時の大きさを決める．
+    @staticmethod
+    def __sweep() :
+        pool = Inst.__pool
+        for code in [ code for code, ref in pool.items() if ref() is None ] :
+            del pool[code]
+        Inst.__limit = max(1 << 16, 2 * len(pool))
+
+    ### @brief pickle されたものを戻す時も共有インスタンスにする．
+    def __reduce__(self) :
+        return (Inst.intern, (self.__code, ))
+
+    ### @brief 機械語から命令を作る．
+    ### @param[in] code 32ビットの機械語
+    ###
+    ### 未定義の命令の場合は ValueError 例外を送出する．
+    @staticmethod
+    def from_code(code) :
+        if code >> 32 or decode(code) is None :
+            raise ValueError('unknown instruction: {:08x}'.format(code))
+        return Inst.intern(code)
 
     ### @brief LUI命令を作る．
     @staticmethod
     def LUI(rd, imm) :
-        return Inst.__Utype(Opcode.LUI, rd, imm)
+        return Inst.encode('LUI', rd, 0, 0, imm)
 
     ### @brief AUIPC命令を作る．
     @staticmethod
     def AUIPC(rd, imm) :
-        return Inst.__Utype(Opcode.AUIPC, rd, imm)
+        return Inst.encode('AUIPC', rd, 0, 0, imm)
 
     ### @brief JAL命令を作る．
     @staticmethod
     def JAL(rd, imm) :
-        return Inst.__Jtype(Opcode.JAL, rd, imm)
+        return Inst.encode('JAL', rd, 0, 0, imm)
 
     ### @brief JAL命令を作る．(ラベル対応)
     @staticmethod
     def LJAL(rd, label) :
-        return Inst.__LJtype(Opcode.JAL, rd, label)
+        return Inst.__label('JAL', rd, 0, 0, label)
 
     ### @brief JALR命令を作る．
     @staticmethod
     def JALR(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.JALR, Funct3.JALR, rd, rs1, imm)
+        return Inst.encode('JALR', rd, rs1, 0, imm)
 
     ### @brief BEQ命令を作る．
     @staticmethod
     def BEQ(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BEQ, rs1, rs2, imm)
+        return Inst.encode('BEQ', 0, rs1, rs2, imm)
 
     ### @brief Label BEQ命令を作る．
     @staticmethod
     def LBEQ(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BEQ, rs1, rs2, label)
+        return Inst.__label('BEQ', 0, rs1, rs2, label)
 
     ### @brief BNE命令を作る．
     @staticmethod
     def BNE(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BNE, rs1, rs2, imm)
+        return Inst.encode('BNE', 0, rs1, rs2, imm)
 
     ### @brief Label BNE命令を作る．
     @staticmethod
     def LBNE(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BNE, rs1, rs2, label)
+        return Inst.__label('BNE', 0, rs1, rs2, label)
 
     ### @brief BLT命令を作る．
     @staticmethod
     def BLT(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BLT, rs1, rs2, imm)
+        return Inst.encode('BLT', 0, rs1, rs2, imm)
 
     ### @brief Label BLT命令を作る．
     @staticmethod
     def LBLT(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BLT, rs1, rs2, label)
+        return Inst.__label('BLT', 0, rs1, rs2, label)
 
     ### @brief BGE命令を作る．
     @staticmethod
     def BGE(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BGE, rs1, rs2, imm)
+        return Inst.encode('BGE', 0, rs1, rs2, imm)
 
     ### @brief Label BGE命令を作る．
     @staticmethod
     def LBGE(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BGE, rs1, rs2, label)
+        return Inst.__label('BGE', 0, rs1, rs2, label)
 
     ### @brief BLTU命令を作る．
     @staticmethod
     def BLTU(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BLTU, rs1, rs2, imm)
+        return Inst.encode('BLTU', 0, rs1, rs2, imm)
 
     ### @brief label BLTU命令を作る．
     @staticmethod
     def LBLTU(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BLTU, rs1, rs2, label)
+        return Inst.__label('BLTU', 0, rs1, rs2, label)
 
     ### @brief BGEU命令を作る．
     @staticmethod
     def BGEU(rs1, rs2, imm) :
-        return Inst.__Btype(Opcode.BEQ, Funct3.BGEU, rs1, rs2, imm)
+        return Inst.encode('BGEU', 0, rs1, rs2, imm)
 
     ### @brief label BGEU命令を作る．
     @staticmethod
     def LBGEU(rs1, rs2, label) :
-        return Inst.__LBtype(Opcode.BEQ, Funct3.BGEU, rs1, rs2, label)
+        return Inst.__label('BGEU', 0, rs1, rs2, label)
 
     ### @brief LB命令を作る．
     @staticmethod
     def LB(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.LB, Funct3.LB, rd, rs1, imm)
+        return Inst.encode('LB', rd, rs1, 0, imm)
 
     ### @brief LH命令を作る．
     @staticmethod
     def LH(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.LH, Funct3.LH, rd, rs1, imm)
+        return Inst.encode('LH', rd, rs1, 0, imm)
 
     ### @brief LW命令を作る．
     @staticmethod
     def LW(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.LW, Funct3.LW, rd, rs1, imm)
+        return Inst.encode('LW', rd, rs1, 0, imm)
 
     ### @brief LBU命令を作る．
     @staticmethod
     def LBU(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.LBU, Funct3.LBU, rd, rs1, imm)
+        return Inst.encode('LBU', rd, rs1, 0, imm)
 
     ### @brief LHU命令を作る．
     @staticmethod
     def LHU(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.LHU, Funct3.LHU, rd, rs1, imm)
+        return Inst.encode('LHU', rd, rs1, 0, imm)
 
     ### @brief SB命令を作る．
     @staticmethod
     def SB(rs1, rs2, imm) :
-        return Inst.__Stype(Opcode.SB, Funct3.SB, rs1, rs2, imm)
+        return Inst.encode('SB', 0, rs1, rs2, imm)
 
     ### @brief SH命令を作る．
     @staticmethod
     def SH(rs1, rs2, imm) :
-        return Inst.__Stype(Opcode.SH, Funct3.SH, rs1, rs2, imm)
+        return Inst.encode('SH', 0, rs1, rs2, imm)
 
     ### @brief SW命令を作る．
     @staticmethod
     def SW(rs1, rs2, imm) :
-        return Inst.__Stype(Opcode.SW, Funct3.SW, rs1, rs2, imm)
+        return Inst.encode('SW', 0, rs1, rs2, imm)
 
     ### @brief ADDI命令を作る．
     @staticmethod
     def ADDI(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.ADDI, Funct3.ADDI, rd, rs1, imm)
+        return Inst.encode('ADDI', rd, rs1, 0, imm)
 
     ### @brief SLTI命令を作る．
     @staticmethod
     def SLTI(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.SLTI, Funct3.SLTI, rd, rs1, imm)
+        return Inst.encode('SLTI', rd, rs1, 0, imm)
 
     ### @brief SLTIU命令を作る．
     @staticmethod
     def SLTIU(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.SLTIU, Funct3.SLTIU, rd, rs1, imm)
+        return Inst.encode('SLTIU', rd, rs1, 0, imm)
 
     ### @brief XORI命令を作る．
     @staticmethod
     def XORI(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.XORI, Funct3.XORI, rd, rs1, imm)
+        return Inst.encode('XORI', rd, rs1, 0, imm)
 
     ### @brief ORI命令を作る．
     @staticmethod
     def ORI(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.ORI, Funct3.ORI, rd, rs1, imm)
+        return Inst.encode('ORI', rd, rs1, 0, imm)
 
     ### @brief ANDI命令を作る．
     @staticmethod
     def ANDI(rd, rs1, imm) :
-        return Inst.__Itype(Opcode.ANDI, Funct3.ANDI, rd, rs1, imm)
+        return Inst.encode('ANDI', rd, rs1, 0, imm)
 
     ### @brief SLLI命令を作る．
     @staticmethod
     def SLLI(rd, rs1, imm) :
-        return Inst.__Itype2(Opcode.SLLI, Funct3.SLLI, rd, rs1, imm, Funct7.SLL)
+        return Inst.encode('SLLI', rd, rs1, 0, imm)
 
     ### @brief SRLI命令を作る．
     @staticmethod
     def SRLI(rd, rs1, imm) :
-        return Inst.__Itype2(Opcode.SRLI, Funct3.SRLI, rd, rs1, imm, Funct7.SRL)
+        return Inst.encode('SRLI', rd, rs1, 0, imm)
 
     ### @brief SRAI命令を作る．
     @staticmethod
     def SRAI(rd, rs1, imm) :
-        return Inst.__Itype2(Opcode.SRAI, Funct3.SRAI, rd, rs1, imm, Funct7.SRA)
+        return Inst.encode('SRAI', rd, rs1, 0, imm)
 
     ### @brief ADD命令を作る．
     @staticmethod
     def ADD(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.ADD, Funct3.ADD, Funct7.ADD, rd, rs1, rs2)
+        return Inst.encode('ADD', rd, rs1, rs2, 0)
 
     ### @brief SUB命令を作る．
     @staticmethod
     def SUB(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SUB, Funct3.SUB, Funct7.SUB, rd, rs1, rs2)
+        return Inst.encode('SUB', rd, rs1, rs2, 0)
 
     ### @brief SLT命令を作る．
     @staticmethod
     def SLT(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SLT, Funct3.SLT, Funct7.SLT, rd, rs1, rs2)
+        return Inst.encode('SLT', rd, rs1, rs2, 0)
 
     ### @brief SLTU命令を作る．
     @staticmethod
     def SLTU(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SLTU, Funct3.SLTU, Funct7.SLTU, rd, rs1, rs2)
+        return Inst.encode('SLTU', rd, rs1, rs2, 0)
 
     ### @brief XOR命令を作る．
     @staticmethod
     def XOR(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.XOR, Funct3.XOR, Funct7.XOR, rd, rs1, rs2)
+        return Inst.encode('XOR', rd, rs1, rs2, 0)
 
     ### @brief OR命令を作る．
     @staticmethod
     def OR(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.OR, Funct3.OR, Funct7.OR, rd, rs1, rs2)
+        return Inst.encode('OR', rd, rs1, rs2, 0)
 
     ### @brief AND命令を作る．
     @staticmethod
     def AND(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.AND, Funct3.AND, Funct7.AND, rd, rs1, rs2)
+        return Inst.encode('AND', rd, rs1, rs2, 0)
 
     ### @brief SLL命令を作る．
     @staticmethod
     def SLL(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SLL, Funct3.SLL, Funct7.SLL, rd, rs1, rs2)
+        return Inst.encode('SLL', rd, rs1, rs2, 0)
 
     ### @brief SRL命令を作る．
     @staticmethod
     def SRL(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SRL, Funct3.SRL, Funct7.SRL, rd, rs1, rs2)
+        return Inst.encode('SRL', rd, rs1, rs2, 0)
 
     ### @brief SRA命令を作る．
     @staticmethod
     def SRA(rd, rs1, rs2) :
-        return Inst.__Rtype(Opcode.SRA, Funct3.SRA, Funct7.SRA, rd, rs1, rs2)
-
-    ### @brief R-type の命令を作る．
+        return Inst.encode('SRA', rd, rs1, rs2, 0)
+
+    ### @brief LI疑似命令(rd に定数を入れる)の命令列を作る．
+    ### @param[in] rd レジスタ番号
+    ### @param[in] imm 32ビットの定数(符号付き，符号なしのどちらでもよい)
+    ###
+    ### ADDI または LUI の1命令で済む場合はそれを，それ以外は LUI+ADDI を返す．
+    ### ADDI の即値は符号拡張されるので LUI の即値はその分を繰り上げておく．
     @staticmethod
-    def __Rtype(opcode, funct3, funct7, rd, rs1, rs2) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__funct7 = funct7
-        inst.__rs1 = rs1
-        inst.__rs2 = rs2
-        inst.__rd = rd
-        return inst
-
-    ### @brief I-type の命令を作る．
+    def LI(rd, imm) :
+        if not -0x80000000 <= imm <= 0xFFFFFFFF :
+            raise ValueError('immediate out of range: {}'.format(imm))
+        imm = unpack(imm & 0xFFFFFFFF, 32)
+        if -0x800 <= imm < 0x800 :
+            return [ Inst.ADDI(rd, 0, imm) ]
+        lo = unpack(imm & 0xFFF, 12)
+        hi = (imm - lo) & 0xFFFFFFFF
+        if lo == 0 :
+            return [ Inst.LUI(rd, hi) ]
+        return [ Inst.LUI(rd, hi), Inst.ADDI(rd, rd, lo) ]
+
+    ### @brief LA疑似命令(rd にラベルのアドレスを入れる)の命令列を作る．(ラベル対応)
+    ###
+    ### AUIPC+ADDI の PC 相対の2命令を返す．
     @staticmethod
-    def __Itype(opcode, funct3, rd, rs1, imm) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__rs1 = rs1
-        inst.__rd = rd
-        inst.__I_31_20 = pack(imm, 12)
-        return inst
+    def LA(rd, label) :
+        return [ LabelInst('AUIPC', rd, 0, 0, label, 'hi'), LabelInst('ADDI', rd, rd, 0, label, 'lo') ]
 
-    ### @brief Label I-type の命令を作る．
+    ### @brief ラベルのアドレスの上位20ビットを rd に入れる LUI 命令を作る．(ラベル対応)
+    ###
+    ### LADDI(rd, rd, label) と組にしてラベルのアドレスを rd に入れる．
     @staticmethod
-    def __LItype(opcode, funct3, rd, rs1, label) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__rs1 = rs1
-        inst.__rd = rd
-        inst.label = label
-        inst.__cont = lambda self: Inst.__Itype(opcode, funct3, rd, rs1, Inst.pcrelref(self))
+    def LLUI(rd, label) :
+        return LabelInst('LUI', rd, 0, 0, label, 'abs_hi')
 
-        return inst
-
-    ### @brief シフト命令用の I-type の命令を作る．
+    ### @brief ラベルのアドレスの下位12ビットを加える ADDI 命令を作る．(ラベル対応)
     @staticmethod
-    def __Itype2(opcode, funct3, rd, rs1, imm, funct7) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__rs1 = rs1
-        inst.__rd = rd
-        tmp = imm | (funct7.value << 5)
-        inst.__I_31_20 = pack(tmp, 12)
-        return inst
+    def LADDI(rd, rs1, label) :
+        return LabelInst('ADDI', rd, rs1, 0, label, 'abs_lo')
 
-    ### @brief S-type の命令を作る．
+    ### @brief MV疑似命令(ADDI rd, rs1, 0)を作る．
     @staticmethod
-    def __Stype(opcode, funct3, rs1, rs2, imm) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__rs1 = rs1
-        inst.__rs2 = rs2
-        p_imm = pack(imm, 12)
-        inst.__S_31_25 = part(p_imm, 11, 5)
-        inst.__S_11_07 = part(p_imm,  4, 0)
-        return inst
-
-    ### @brief B-type の命令を作る．
-    @staticmethod
-    def __Btype(opcode, funct3, rs1, rs2, imm) :
-        inst = Inst(opcode)
-        inst.__funct3 = funct3
-        inst.__rs1 = rs1
-        inst.__rs2 = rs2
-        p_imm = pack(imm, 13)
-        inst.__B_31_31 = part(p_imm, 12, 12)
-        inst.__B_30_25 = part(p_imm, 10,  5)
-        inst.__B_11_08 = part(p_imm,  4,  1)
-        inst.__B_07_07 = part(p_imm, 11, 11)
-        return inst
+    def MV(rd, rs1) :
+        return Inst.ADDI(rd, rs1, 0)
 
-    ### @brief Label Label B-type の命令を作る．
+    ### @brief NOT疑似命令(XORI rd, rs1, -1)を作る．
     @staticmethod
-    def __LBtype(opcode, funct3, rs1, rs2, label) :
-        inst = Inst(opcode)
-        inst.label = label
-        inst.__cont = lambda self: Inst.__Btype(opcode, funct3, rs1, rs2, Inst.pcrelref(self))
+    def NOT(rd, rs1) :
+        return Inst.XORI(rd, rs1, -1)
 
-        return inst
-
-    ### @brief U-type の命令を作る．
+    ### @brief CALL疑似命令を作る．(ラベル対応)
+    ###
+    ### JAL ra, label となる．JAL の範囲を越える場合は asm() で AUIPC+JALR に置き換わる．
     @staticmethod
-    def __Utype(opcode, rd, imm) :
-        inst = Inst(opcode)
-        inst.__rd = rd
-        inst.__U_31_12 = part(imm, 31, 12)
-        return inst
+    def CALL(label) :
+        return Inst.__label('JAL', 1, 0, 0, label)
 
-    ### @brief J-type の命令を作る．
+    ### @brief RET疑似命令(JALR x0, ra, 0)を作る．
     @staticmethod
-    def __Jtype(opcode, rd, imm) :
-        inst = Inst(opcode)
-        inst.__rd = rd
-        p_imm = pack(imm, 21)
-        inst.__J_31_31 = part(p_imm, 20, 20)
-        inst.__J_30_21 = part(p_imm, 10,  1)
-        inst.__J_20_20 = part(p_imm, 11, 11)
-        inst.__J_19_12 = part(p_imm, 19, 12)
-        return inst
-
-    ### @brief Label J-type の命令を作る．
+    def RET() :
+        return Inst.JALR(0, 1, 0)
+
+    ### @brief ENCODE_TABLE に従って命令を作る．
+    ### @param[in] name ニーモニック
+    ### @param[in] rd, rs1, rs2 レジスタ番号(使わないものは 0)
+    ### @param[in] imm 即値
+    ###
+    ### 結果はオペランドをキーにして最近の ENCODE_CACHE_SIZE 個だけ覚えておく．
     @staticmethod
-    def __LJtype(opcode, rd, label) :
-        inst = Inst(opcode)
-        inst.__rd = rd
-        inst.label = label
-        inst.__cont = lambda self: Inst.__Jtype(opcode, rd, Inst.pcrelref(self))
-
-        return inst
-
+    @lru_cache(maxsize=ENCODE_CACHE_SIZE)
+    def encode(name, rd, rs1, rs2, imm) :
+        layout, code = ENCODE_TABLE[name]
+        code |= (rd << 7) | (rs1 << 15) | (rs2 << 20) | layout.scatter(imm)
+        return Inst.intern(code)
+
+    ### @brief ラベルを参照する命令を作る．
+    ### @param[in] name ニーモニック
+    ### @param[in] rd, rs1, rs2 レジスタ番号(使わないものは 0)
+    ### @param[in] label 参照するラベル
     @staticmethod
-    def pcrelref(self):
-        return -(self.pc - labeltbl[self.label])
+    def __label(name, rd, rs1, rs2, label) :
+        return LabelInst(name, rd, rs1, rs2, label)
+
+    ### @brief opcode フィールドを返す．
+    @property
+    def __opcode(self) :
+        try :
+            return Opcode(self.__code & 0x7F)
+        except ValueError :
+            return None
+
+    ### @brief funct3 フィールドを返す．
+    @property
+    def __funct3(self) :
+        return Funct3(part(self.__code, 14, 12))
+
+    ### @brief funct7 フィールドを返す．
+    @property
+    def __funct7(self) :
+        try :
+            return Funct7(part(self.__code, 31, 25))
+        except ValueError :
+            return None
+
+    ### @brief rd フィールドを返す．
+    @property
+    def __rd(self) :
+        return part(self.__code, 11, 7)
+
+    ### @brief rs1 フィールドを返す．
+    @property
+    def __rs1(self) :
+        return part(self.__code, 19, 15)
+
+    ### @brief rs2 フィールドを返す．
+    @property
+    def __rs2(self) :
+        return part(self.__code, 24, 20)
 
     ### @brief lui 命令のとき true を返す．
     def is_lui(self) :
@@ -690,270 +927,620 @@ class Inst :
 
     ### @brief I-type の即値を取り出す．
     def get_I_imm(self) :
-        return imm_str(unpack(self.__I_31_20, 12))
+        return imm_str(LAYOUT['I'].gather(self.__code))
 
     ### @brief S-type の即値を取り出す．
     def get_S_imm(self) :
-        return imm_str(unpack((self.__S_31_25 << 5) | self.__S_11_07, 12))
+        return imm_str(LAYOUT['S'].gather(self.__code))
 
     ### @brief B-type の即値を取り出す．
     def get_B_imm(self) :
-        return imm_str(unpack((self.__B_31_31 << 12) | (self.__B_30_25 << 5) | (self.__B_11_08 << 1) | (self.__B_07_07 << 11), 13))
+        return imm_str(LAYOUT['B'].gather(self.__code))
 
     ### @brief U-type の即値を取り出す．
     def get_U_imm(self) :
-        return imm_str((self.__U_31_12 << 12))
+        return imm_str(LAYOUT['U'].gather(self.__code))
 
     ### @brief J-type の即値を取り出す．
     def get_J_imm(self) :
-        return imm_str(unpack((self.__J_31_31 << 20) | (self.__J_30_21 << 1) | (self.__J_20_20 << 11) | (self.__J_19_12 << 12), 21))
+        return imm_str(LAYOUT['J'].gather(self.__code))
+
+    ### @brief rd フィールドの値を返す．
+    def get_rd(self) :
+        return self.__rd
+
+    ### @brief rs1 フィールドの値を返す．
+    def get_rs1(self) :
+        return self.__rs1
+
+    ### @brief rs2 フィールドの値を返す．
+    def get_rs2(self) :
+        return self.__rs2
+
+    ### @brief 命令形式に従って即値を数値で返す．
+    ###
+    ### 即値のない命令と未定義の命令は 0 を返す．
+    def get_imm(self) :
+        d = decode(self.__code)
+        if d is None :
+            return 0
+        return d[1].gather(self.__code)
 
     ### @brief コードを出力する．
     def gen_code(self) :
-        code = self.__opcode.value
-        if self.__funct3 :
-            code |= (self.__funct3.value << 12)
-        if self.__funct7 :
-            code |= (self.__funct7.value << 25)
-        if self.__rd :
-            code |= (self.__rd << 7)
-        if self.__rs1 :
-            code |= (self.__rs1 << 15)
-        if self.__rs2 :
-            code |= (self.__rs2 << 20)
-        if self.__I_31_20 :
-            code |= (self.__I_31_20 << 20)
-        if self.__S_31_25 :
-            code |= (self.__S_31_25 << 25)
-        if self.__S_11_07 :
-            code |= (self.__S_11_07 << 7)
-        if self.__B_31_31 :
-            code |= (self.__B_31_31 << 31)
-        if self.__B_30_25 :
-            code |= (self.__B_30_25 << 25)
-        if self.__B_11_08 :
-            code |= (self.__B_11_08 << 8)
-        if self.__B_07_07 :
-            code |= (self.__B_07_07 << 7)
-        if self.__U_31_12 :
-            code |= (self.__U_31_12 << 12)
-        if self.__J_31_31 :
-            code |= (self.__J_31_31 << 31)
-        if self.__J_30_21 :
-            code |= (self.__J_30_21 << 21)
-        if self.__J_20_20 :
-            code |= (self.__J_20_20 << 20)
-        if self.__J_19_12 :
-            code |= (self.__J_19_12 << 12)
-        return code
+        return self.__code
 
     ### @brief intel HEX フォーマットの行を出力する．
+    ### @param[in] offset ワード単位のアドレス(16ビット)
+    ###
+    ### 複数の命令をまとめて出力する場合は ihex.write_ihex() を用いる．
     def gen_HEX(self, offset) :
-        data_size = 0x04
-        offset_h = (offset >> 8) & 0xFF
-        offset_l = offset & 0xFF
-        record_type = 0x00
-        code = self.gen_code()
-        code_3 = (code >> 24) & 0xFF
-        code_2 = (code >> 16) & 0xFF
-        code_1 = (code >>  8) & 0xFF
-        code_0 = code & 0xFF
-        record = []
-        record.append(data_size)
-        record.append(offset_h)
-        record.append(offset_l)
-        record.append(record_type)
-        record.append(code_3)
-        record.append(code_2)
-        record.append(code_1)
-        record.append(code_0)
-        s = 0
-        line = ':'
-        for b in record :
-            s += b
-            line += '{:02X}'.format(b)
-        cs = (~s + 1) & 0xFF
-        line += '{:02X}'.format(cs)
-        return line
+        return ihex_record(0x00, offset, self.__code.to_bytes(4, 'big'))
 
     ### @brief ニーモニックに変換する．
     def gen_mnemonic(self) :
-        opcode = self.__opcode
-        if opcode == Opcode.LB :
-            inst_type = 'I'
-            funct3 = self.__funct3
-            if funct3 == Funct3.LB :
-                op = 'LB'
-            elif funct3 == Funct3.LH :
-                op = 'LH'
-            elif funct3 == Funct3.LW :
-                op = 'LW'
-            elif funct3 == Funct3.LBU :
-                op = 'LBU'
-            elif funct3 == Funct3.LHU :
-                op = 'LHU'
+        line = mnemonic(self.__code)
+        if line is None :
+            return '{:5}  ---'.format('---')
+        return line
+
+    ### @brief アドレスとラベルの表に従ってラベルを解決した命令を返す．
+    ###
+    ### ラベルを参照しない命令はそのまま返す．
+    def resolve(self, pc, labels) :
+        return self
+
+
+### @brief ラベルを参照する命令を表すクラス
+###
+### ラベルの解決前は即値部分が 0 の機械語を保持する．
+### resolve() で解決済みの Inst に変換される．
+### 自身は変更されないので，同じ命令を複数のプログラムで同時に用いてもよい．
+class LabelInst(Inst) :
+
+    __slots__ = ('label', '__name', '__regs', '__reloc', '__limit')
+
+    ### @brief 初期化
+    ### @param[in] name ニーモニック
+    ### @param[in] rd, rs1, rs2 レジスタ番号(使わないものは 0)
+    ### @param[in] label 参照するラベル
+    ### @param[in] reloc 即値の求め方
+    ###                  None: ラベルまでの相対アドレス
+    ###                  'hi': 相対アドレスの上位20ビット(AUIPC 用)
+    ###                  'lo': 直前の命令からの相対アドレスの下位12ビット(AUIPC の次の命令用)
+    ###                  'abs_hi': アドレスの上位20ビット(LUI 用)
+    ###                  'abs_lo': アドレスの下位12ビット(LUI の次の命令用)
+    def __init__(self, name, rd, rs1, rs2, label, reloc=None) :
+        layout, code = ENCODE_TABLE[name]
+        super().__init__(code | (rd << 7) | (rs1 << 15) | (rs2 << 20))
+        self.label = label
+        self.__name = name
+        self.__regs = (rd, rs1, rs2)
+        self.__reloc = reloc
+        self.__limit = 1 << (layout.bw - 1)
+
+    ### @brief ラベルを解決した命令を返す．
+    ### @param[in] pc この命令のアドレス
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書
+    def resolve(self, pc, labels) :
+        try :
+            target = labels[self.label]
+        except KeyError :
+            raise AsmError('undefined label: {}'.format(self.label)) from None
+        reloc = self.__reloc
+        if reloc == 'abs_hi' :
+            return Inst.encode(self.__name, *self.__regs, (target + 0x800) & 0xFFFFF000)
+        if reloc == 'abs_lo' :
+            return Inst.encode(self.__name, *self.__regs, unpack(target & 0xFFF, 12))
+        return self.resolve_offset(target - pc)
+
+    ### @brief ラベルまでの相対アドレスを与えて解決した命令を返す．
+    ###
+    ### 相対アドレスが即値の範囲を越える場合は AsmRangeError 例外を送出する．
+    ### 絶対アドレスを用いる命令('abs_hi', 'abs_lo')は resolve() でしか解決できない．
+    def resolve_offset(self, offset) :
+        reloc = self.__reloc
+        if reloc == 'abs_hi' or reloc == 'abs_lo' :
+            raise AsmError('{} {} needs an absolute address'.format(self.__name, self.label))
+        if reloc == 'hi' :
+            offset = (offset + 0x800) & -0x1000
+        elif reloc == 'lo' :
+            offset = unpack((offset + 4) & 0xFFF, 12)
+        elif not -self.__limit <= offset < self.__limit :
+            raise AsmRangeError('{} to {} is out of range: {}'.format(self.__name, self.label, offset))
+        return Inst.encode(self.__name, *self.__regs, offset)
+
+    ### @brief 参照するラベルだけを変えた命令を返す．
+    def retarget(self, label) :
+        return LabelInst(self.__name, *self.__regs, label, self.__reloc)
+
+    ### @brief 相対アドレスが即値の範囲に収まるか調べる．
+    def fits(self, offset) :
+        return self.__reloc is not None or -self.__limit <= offset < self.__limit
+
+    ### @brief relax() で置き換えられる命令の時 True を返す．
+    ###
+    ### ラベル参照の分岐命令と，rd が x0 以外の JAL 命令が置き換えられる．
+    def relaxable(self) :
+        if self.__reloc is not None :
+            return False
+        return self.__name in _INVERSE or self.__name == 'JAL' and self.__regs[0] != 0
+
+    ### @brief 遠くまで飛べる2命令に置き換える．
+    ###
+    ### 分岐命令は，条件を反転して次の命令を飛び越す分岐とラベルへの JAL を返す．
+    ### JAL 命令は，AUIPC rd と JALR rd, rd の組を返す．
+    def relax(self) :
+        rd, rs1, rs2 = self.__regs
+        if self.__name == 'JAL' :
+            return [ LabelInst('AUIPC', rd, 0, 0, self.label, 'hi'), LabelInst('JALR', rd, rd, 0, self.label, 'lo') ]
+        return [ Inst.encode(_INVERSE[self.__name], 0, rs1, rs2, 8), LabelInst('JAL', 0, 0, 0, self.label) ]
+
+    def __reduce__(self) :
+        return (LabelInst, (self.__name, ) + self.__regs + (self.label, self.__reloc))
+
+
+# 条件を反転した分岐命令
+_INVERSE = { 'BEQ' : 'BNE', 'BNE' : 'BEQ', 'BLT' : 'BGE', 'BGE' : 'BLT', 'BLTU' : 'BGEU', 'BGEU' : 'BLTU' }
+
+
+### @brief アセンブルのエラーを表す例外
+class AsmError(ValueError) :
+    pass
+
+
+### @brief ラベルまでの相対アドレスが命令の即値の範囲を越えることを表す例外
+class AsmRangeError(AsmError) :
+    pass
+
+
+### @brief アセンブラ
+###
+### ラベルの表，先頭アドレス，現在のアドレスを自身で持つので，
+### 複数のプログラムを別々のスレッドやプロセスで同時にアセンブルできる．
+###
+### 使い方:
+###   a = Assembler()
+###   a.extend(program)    # 命令とラベル(文字列)のリスト
+###   insts = a.assemble()
+class Assembler :
+
+    ### @brief 初期化
+    ### @param[in] base プログラムの先頭アドレス
+    def __init__(self, base=0x10000000) :
+        ## @brief 先頭アドレス
+        self.base = base
+        ## @brief 次の命令のアドレス
+        self.pc = base
+        ## @brief ラベルをキーにしてアドレスを持つ辞書
+        self.labels = {}
+        ## @brief プログラムの外で定義されたラベル(データなど)をキーにしてアドレスを持つ辞書
+        ##
+        ## 緩和や最適化で命令が動いてもアドレスは変わらない．
+        self.symbols = {}
+        # (アドレス, 命令) のリスト
+        self.__insts = []
+
+    ### @brief ラベルを現在のアドレスに定義する．
+    def label(self, name) :
+        self.labels[name] = self.pc
+
+    ### @brief 命令(または疑似命令の命令列)を追加する．
+    def add(self, inst) :
+        if type(inst) is list :
+            self.extend(inst)
+            return
+        self.__insts.append((self.pc, inst))
+        self.pc += 4
+
+    ### @brief 命令とラベル(文字列)の列を追加する．
+    ###
+    ### 疑似命令の命令列(リスト)はそのまま並べる．
+    def extend(self, program) :
+        insts = self.__insts
+        labels = self.labels
+        pc = self.pc
+        for inst in program :
+            if type(inst) is str :
+                labels[inst] = pc
+            elif type(inst) is list :
+                for x in inst :
+                    insts.append((pc, x))
+                    pc += 4
             else :
-                op = '---'
-        elif opcode == Opcode.ADDI :
-            inst_type = 'I'
-            funct3 = self.__funct3
-            if funct3 == Funct3.ADDI :
-                op = 'ADDI'
-            elif funct3 == Funct3.SLTI :
-                op = 'SLTI'
-            elif funct3 == Funct3.SLTIU :
-                op = 'SLTIU'
-            elif funct3 == Funct3.XORI :
-                op = 'XORI'
-            elif funct3 == Funct3.ORI :
-                op = 'ORI'
-            elif funct3 == Funct3.ANDI :
-                op = 'ANDI'
-            elif funct3 == Funct3.SLLI :
-                inst_type = 'I2'
-                shamt = part(self.__I_31_20, 4, 0)
-                op = 'SLLI'
-            elif funct3 == Funct3.SRLI :
-                inst_type = 'I2'
-                tmp = part(self.__I_31_20, 11, 5)
-                shamt = part(self.__I_31_20, 4, 0)
-                if tmp == 0b0000000 :
-                    op = 'SRLI'
-                elif tmp == 0b0100000 :
-                    op = 'SRAI'
-                else :
-                    op = '---'
-        elif opcode == Opcode.AUIPC :
-            inst_type = 'U'
-            op = 'AUIPC'
-        elif opcode == Opcode.SB :
-            inst_type = 'S'
-            funct3 = self.__funct3
-            if funct3 == Funct3.SB :
-                op = 'SB'
-            elif funct3 == Funct3.SH :
-                op = 'SH'
-            elif funct3 == Funct3.SW :
-                op = 'SW'
+                insts.append((pc, inst))
+                pc += 4
+        self.pc = pc
+
+    ### @brief 命令列を最適化する．
+    ### @param[in] optimizer 最適化パス
+    ###
+    ### optimizer は (命令のリスト, ラベルをキーにして命令の番号を持つ辞書) を受け取り，
+    ### 書き換えた同じ形の組を返す関数(peephole.Peephole など)．
+    ### labels, pc は書き換え後のアドレスになる．
+    def optimize(self, optimizer) :
+        base = self.base
+        insts = [ inst for _, inst in self.__insts ]
+        index = { name : (pc - base) >> 2 for name, pc in self.labels.items() }
+        insts, index = optimizer(insts, index)
+        self.__insts = [ (base + i * 4, inst) for i, inst in enumerate(insts) ]
+        self.pc = base + len(insts) * 4
+        self.labels.clear()
+        self.labels.update({ name : base + i * 4 for name, i in index.items() })
+
+    ### @brief ラベルを解決した命令のリストを返す．
+    ###
+    ### 飛び先が範囲外になるラベル参照の分岐命令があれば，
+    ### 条件を反転した分岐と JAL の2命令に置き換えて(緩和)からアセンブルし直す．
+    ### JAL 命令(rd が x0 以外)は AUIPC+JALR に置き換える．
+    ### 置き換えた後は labels, pc も置き換え後のアドレスになる．
+    def assemble(self) :
+        while True :
+            labels = self.labels
+            if self.symbols :
+                labels = dict(self.symbols)
+                labels.update(self.labels)
+            try :
+                return [ inst.resolve(pc, labels) for pc, inst in self.__insts ]
+            except AsmRangeError :
+                if not self.__relax() :
+                    raise
+
+    ### @brief 範囲外の分岐命令，JAL 命令を2命令に置き換える．
+    ### @return 置き換えた命令があれば True を返す．
+    ###
+    ### すべての分岐を1命令として始め，置き換えによって範囲外になった分岐も
+    ### 置き換えることを変化がなくなるまで繰り返す．
+    ### 置き換える分岐は増える一方なので必ず終わり，置き換えは必要なものだけになる．
+    def __relax(self) :
+        base = self.base
+        insts = [ inst for _, inst in self.__insts ]
+        # ラベルの位置(命令の番号)．命令はすべて1語なのでアドレスから求まる．
+        index = { name : (pc - base) >> 2 for name, pc in self.labels.items() }
+        branches = [ (i, index[inst.label], inst) for i, inst in enumerate(insts)
+                     if type(inst) is LabelInst and inst.label in index and inst.relaxable() ]
+        # 置き換える分岐の番号(昇順)
+        far = []
+        while True :
+            # 番号 i の命令のアドレスは i とそれより前の置き換える分岐の数の和で決まる．
+            grown = [ i for i, t, inst in branches
+                      if not inst.fits(((t + bisect_left(far, t)) - (i + bisect_left(far, i))) * 4) ]
+            grown = set(grown).difference(far)
+            if not grown :
+                break
+            far = sorted(grown.union(far))
+        if not far :
+            return False
+
+        far_set = set(far)
+        relaxed = []
+        pc = base
+        for i, inst in enumerate(insts) :
+            if i in far_set :
+                for x in inst.relax() :
+                    relaxed.append((pc, x))
+                    pc += 4
             else :
-                op = '---'
-        elif opcode == Opcode.ADD :
-            inst_type = 'R'
-            funct3 = self.__funct3
-            if funct3 == Funct3.ADD :
-                funct7 = self.__funct7
-                if funct7 == Funct7.ADD :
-                    op = 'ADD'
-                elif funct7 == Funct7.SUB :
-                    op = 'SUB'
-                else :
-                    op = '---'
-            elif funct3 == Funct3.SLL :
-                op = 'SLL'
-            elif funct3 == Funct3.SLT :
-                op = 'SLT'
-            elif funct3 == Funct3.SLTU :
-                op = 'SLTU'
-            elif funct3 == Funct3.XOR :
-                op = 'XOR'
-            elif funct3 == Funct3.SRL :
-                funct7 = self.__funct7
-                if funct7 == Funct7.SRL :
-                    op = 'SRL'
-                elif funct7 == Funct7.SRA :
-                    op = 'SRA'
-                else :
-                    op = '---'
-            elif funct3 == Funct3.OR :
-                op = 'OR'
-            elif funct3 == Funct3.AND :
-                op = 'AND'
-        elif opcode == Opcode.LUI :
-            inst_type = 'U'
-            op = 'LUI'
-        elif opcode == Opcode.BEQ :
-            inst_type = 'B'
-            funct3 = self.__funct3
-            if funct3 == Funct3.BEQ :
-                op = 'BEQ'
-            elif funct3 == Funct3.BNE :
-                op = 'BNE'
-            elif funct3 == Funct3.BLT :
-                op = 'BLT'
-            elif funct3 == Funct3.BGE :
-                op = 'BGE'
-            elif funct3 == Funct3.BLTU :
-                op = 'BLTU'
-            elif funct3 == Funct3.BGEU :
-                op = 'BGEU'
+                relaxed.append((pc, inst))
+                pc += 4
+        self.__insts = relaxed
+        self.pc = pc
+        for name, i in index.items() :
+            self.labels[name] = base + (i + bisect_left(far, i)) * 4
+        return True
+
+
+### @brief 編集されたところだけをアセンブルし直すアセンブラ
+###
+### 命令の位置(先頭からの命令数)で範囲を指定してプログラムを書き換える．
+### 書き換えた範囲の命令と，ラベルまでの相対アドレスが変わった命令だけを解決し直す．
+### ラベルは命令の間の位置に定義され，範囲の両端にあるラベルは残る．
+###
+### 使い方:
+###   a = IncrementalAssembler(program)
+###   a.replace(10, 11, [ Inst.ADDI(1, 1, 1) ])   # 10番目の命令を置き換える．
+###   insts = a.insts()
+class IncrementalAssembler :
+
+    ### @brief 初期化
+    ### @param[in] program 命令とラベル(文字列)のリスト
+    ### @param[in] base プログラムの先頭アドレス
+    def __init__(self, program=(), base=0x10000000) :
+        ## @brief 先頭アドレス
+        self.base = base
+        ## @brief 直前の編集で解決し直したラベル参照の命令の数
+        self.reresolved = 0
+        # 元の命令
+        self.__src = []
+        # 解決済みの命令
+        self.__out = []
+        # ラベル参照の命令の相対位置(ワード単位)．それ以外は None
+        self.__disp = []
+        # ラベル参照の命令の位置(昇順)と参照するラベル
+        self.__refs = []
+        self.__names = []
+        # ラベルをキーにして位置を持つ辞書
+        self.__labels = {}
+        self.replace(0, 0, program)
+
+    ### @brief 命令数を返す．
+    def __len__(self) :
+        return len(self.__src)
+
+    ### @brief 解決済みの命令のリストを返す．
+    def insts(self) :
+        return list(self.__out)
+
+    ### @brief ラベルをキーにしてアドレスを持つ辞書を返す．
+    def labels(self) :
+        base = self.base
+        return { name : base + index * 4 for name, index in self.__labels.items() }
+
+    ### @brief 命令を挿入する．
+    ### @param[in] index 位置
+    ### @param[in] program 命令とラベル(文字列)のリスト
+    def insert(self, index, program) :
+        self.replace(index, index, program)
+
+    ### @brief 命令を削除する．
+    def delete(self, start, stop) :
+        self.replace(start, stop, ())
+
+    ### @brief ラベルを削除する．
+    def remove_label(self, name) :
+        del self.__labels[name]
+        self.__relink(self.__refs, self.__names)
+
+    ### @brief 範囲の命令を置き換える．
+    ### @param[in] start, stop 置き換える範囲(命令の位置)
+    ### @param[in] program 新しい命令とラベル(文字列)のリスト
+    ###
+    ### 未定義のラベルを参照すると AsmError 例外を送出する．
+    ### その命令は後の編集でラベルが定義された時に解決される．
+    ### 命令の位置を保つため分岐の緩和は行わず，飛び先が範囲外になると
+    ### AsmRangeError 例外を送出して同様に未解決のままにする．
+    def replace(self, start, stop, program) :
+        n = len(self.__src)
+        if not 0 <= start <= stop <= n :
+            raise IndexError('bad range: {}:{}'.format(start, stop))
+        insts = []
+        new_labels = []
+        for inst in program :
+            if type(inst) is str :
+                new_labels.append((inst, start + len(insts)))
+            elif type(inst) is list :
+                insts.extend(inst)
             else :
-                op = '---'
-        elif opcode == Opcode.JALR :
-            inst_type = 'I'
-            op = 'JALR'
-        elif opcode == Opcode.JAL :
-            inst_type = 'J'
-            op = 'JAL'
-        else :
-            inst_type = '-'
-            op = '---'
-
-        line = '{:5} '.format(op)
-        if inst_type == 'R' :
-            line += '{0}, {1}, {2}'.format(reg_name(self.__rd), reg_name(self.__rs1), reg_name(self.__rs2))
-        elif inst_type == 'I' :
-            imm = self.get_I_imm()
-            line += '{0}, {1}, {2}'.format(reg_name(self.__rd), reg_name(self.__rs1), imm)
-        elif inst_type == 'I2' :
-            line += '{0}, {1}, {2}'.format(reg_name(self.__rd), reg_name(self.__rs1), shamt)
-        elif inst_type == 'S' :
-            imm = self.get_S_imm()
-            line += '{0}, {1}, {2}'.format(reg_name(self.__rs1), reg_name(self.__rs2), imm)
-        elif inst_type == 'B' :
-            imm = self.get_B_imm()
-            line += '{0}, {1}, {2}'.format(reg_name(self.__rs1), reg_name(self.__rs2), imm)
-        elif inst_type == 'U' :
-            imm = self.get_U_imm()
-            line += '{0}, {1}'.format(reg_name(self.__rd), imm)
-        elif inst_type == 'J' :
-            imm = self.get_J_imm()
-            line += '{0}, {1}'.format(reg_name(self.__rd), imm)
+                insts.append(inst)
+        delta = len(insts) - (stop - start)
+
+        # 範囲の中のラベルを消して，後ろのラベルをずらす．
+        labels = self.__labels
+        removed = []
+        if stop > start :
+            removed = [ name for name, k in labels.items() if start < k < stop ]
+            for name in removed :
+                del labels[name]
+        if delta :
+            for name, k in labels.items() :
+                if k >= stop :
+                    labels[name] = k + delta
+        for name, k in new_labels :
+            labels[name] = k
+
+        # 新しい命令は解決が必要なものだけ後で解決する．
+        out = []
+        new_refs = []
+        new_names = []
+        for i, inst in enumerate(insts, start) :
+            if isinstance(inst, LabelInst) :
+                new_refs.append(i)
+                new_names.append(inst.label)
+                out.append(None)
+            else :
+                out.append(inst)
+        self.__src[start:stop] = insts
+        self.__out[start:stop] = out
+        self.__disp[start:stop] = [ None ] * len(insts)
+        refs = self.__refs
+        names = self.__names
+        lo = bisect_left(refs, start)
+        hi = bisect_left(refs, stop)
+        if delta :
+            self.__refs = refs[:lo] + new_refs + [ i + delta for i in refs[hi:] ]
         else :
-            line += ' ---'
+            refs[lo:hi] = new_refs
+        names[lo:hi] = new_names
 
-        return line
+        if delta or new_labels or removed :
+            # ラベルが動いたのですべての参照を調べる．
+            self.__relink(self.__refs, self.__names)
+        else :
+            self.__relink(new_refs, new_names)
+
+    ### @brief 相対位置の変わったラベル参照の命令を解決し直す．
+    ### @param[in] refs 調べる命令の位置のリスト
+    ### @param[in] names それぞれの命令の参照するラベルのリスト
+    def __relink(self, refs, names) :
+        src = self.__src
+        out = self.__out
+        disp = self.__disp
+        labels = self.__labels
+        count = 0
+        error = None
+        for i, name in zip(refs, names) :
+            k = labels.get(name)
+            if k is None :
+                error = AsmError('undefined label: {}'.format(name))
+                out[i] = disp[i] = None
+                continue
+            d = k - i
+            if d != disp[i] :
+                try :
+                    out[i] = src[i].resolve_offset(d * 4)
+                    disp[i] = d
+                except AsmRangeError as e :
+                    error = e
+                    out[i] = disp[i] = None
+                count += 1
+        self.reresolved = count
+        if error is not None :
+            raise error
+
+
+### @brief 最後に asm() でアセンブルしたプログラムのラベルの表
+###
+### 互換性のためだけに asm() が書き込む．このパッケージの中では読まない．
+### ラベルは Assembler.labels から得ること．
+labeltbl = {}
 
-    def force(self):
-        if self.__cont:
-            return self.__cont(self)
-        else:
-            return self
-
-def asm(program):
-    # pass1: make symbol table
-    pc = 0x10000000
-    for inst in program:
-        if type(inst) is str:
-            # label
-            labeltbl[inst] = pc
-        else:
-            # instruction
-            inst.pc = pc
-            pc += 4
-
-    # pass2: resolve and remove labels
-    program = [inst.force() for inst in program if type(inst) is not str]
-
-    return program
-
-def print_asm(program):
-    for i in program :
-        print('{:08x} | {}'.format(i.gen_code(), i.gen_mnemonic()))
-
-def print_ihex(program):
-    for offset, inst in enumerate(program) :
-        print(inst.gen_HEX(offset))
-    print(':00000001FF\n')
+### @brief 命令とラベルのリストをアセンブルする．
+### @param[in] program 命令とラベル(文字列)のリスト
+### @param[in] base プログラムの先頭アドレス
+### @param[in] optimizer ラベルを集めた後，解決する前に適用する最適化パス
+###                      (Assembler.optimize() を参照)
+def asm(program, base=0x10000000, optimizer=None):
+    a = Assembler(base)
+    a.extend(program)
+    if optimizer is not None :
+        a.optimize(optimizer)
+    result = a.assemble()
+    labeltbl.clear()
+    labeltbl.update(a.labels)
+    return result
+
+# listing() の1語分の情報を作る．
+# ('機械語 | ニーモニック', 種類, レジスタ, 即値) を返す．種類は次のとおり．
+# 種類 3 の即値は AUIPC と組になった時に取り出す．
+#   0: 飛び先のない命令
+#   1: PC 相対の分岐/JAL
+#   2: AUIPC(レジスタは rd)
+#   3: ADDI/JALR(レジスタは rs1, 直前の AUIPC と組になる場合がある)
+def _listing_entry(code) :
+    entry = decode(code)
+    if entry is None :
+        return '{:08x} | <unknown>'.format(code), 0, -1, 0
+    name, layout = entry
+    text = '{:08x} | {:5} {}'.format(code, name, OPERAND_FORMATTER[layout.name](layout, code))
+    if layout.name == 'B' or name == 'JAL' :
+        return text, 1, -1, layout.gather(code)
+    if name == 'AUIPC' :
+        return text, 2, (code >> 7) & 0x1F, layout.gather(code)
+    if name == 'ADDI' or name == 'JALR' :
+        return text, 3, (code >> 15) & 0x1F, None
+    return text, 0, -1, 0
+
+# listing() の行を size 行ずつのリストで返すジェネレータ
+def _listing_chunks(program, base, labels, size) :
+    if labels is None :
+        labels = {}
+    names = {}
+    for name, addr in labels.items() :
+        names.setdefault(addr, []).append(name)
+    heads = { addr : ''.join('{}:\n'.format(name) for name in names[addr]) for addr in names }
+    def target_name(addr) :
+        addr &= 0xFFFFFFFF
+        return names[addr][0] if addr in names else '{:08x}'.format(addr)
+    cache = {}
+    get = cache.get
+    out = []
+    append = out.append
+    addr = base
+    # 直前の AUIPC の (rd, 値)
+    hi_reg = -1
+    hi_value = 0
+    for inst in program :
+        code = inst if type(inst) is int else inst.gen_code()
+        entry = get(code)
+        if entry is None :
+            entry = cache[code] = _listing_entry(code)
+        if addr in heads :
+            append(heads[addr])
+        text, kind, reg, imm = entry
+        if kind == 0 or kind == 3 and reg != hi_reg :
+            append('%08x | %s\n' % (addr, text))
+            hi_reg = -1
+        elif kind == 2 :
+            append('%08x | %s\n' % (addr, text))
+            hi_reg = reg
+            hi_value = addr + imm
+        else :
+            target = addr + imm if kind == 1 else hi_value + decode(code)[1].gather(code)
+            append('%08x | %-43s # -> %s\n' % (addr, text, target_name(target)))
+            hi_reg = -1
+        addr += 4
+        if len(out) >= size :
+            yield out
+            out = []
+            append = out.append
+    if out :
+        yield out
+
+### @brief ラベル付きのリストの行を返すジェネレータ
+### @param[in] program 命令(Inst)または機械語のリスト
+### @param[in] base 先頭のアドレス
+### @param[in] labels ラベルをキーにしてアドレスを持つ辞書(Assembler.labels など．省略時はラベルを付けない)
+###
+### 各行は改行を含み，'アドレス | 機械語 | ニーモニック' の形をとる．
+### ラベルの位置にはその前に 'ラベル:' の行を入れる．
+### 分岐/JAL と AUIPC に続く ADDI/JALR(LA, CALL)には飛び先をラベル(なければアドレス)で付け加える．
+### ニーモニックは同じ機械語については一度だけ作る．
+def listing(program, base=0x10000000, labels=None):
+    for lines in _listing_chunks(program, base, labels, 4096) :
+        yield from lines
+
+### @brief ラベル付きのリストをファイルに書き出す．
+### @param[in] f 書き出すファイル(テキストまたはバイナリ)
+### @param[in] program 命令(Inst)または機械語のリスト
+### @param[in] base 先頭のアドレス
+### @param[in] labels ラベルをキーにしてアドレスを持つ辞書(Assembler.labels など．省略時はラベルを付けない)
+###
+### 行は listing() と同じ．4096行ずつまとめて書き出す．
+def write_listing(f, program, base=0x10000000, labels=None):
+    binary = not isinstance(f, io.TextIOBase)
+    for lines in _listing_chunks(program, base, labels, 4096) :
+        text = ''.join(lines)
+        f.write(text.encode() if binary else text)
+
+### @brief 命令のリストを標準出力に表示する．
+### @param[in] program 命令のリスト
+### @param[in] model クロック数を付ける場合は cost.CostModel
+### @param[in] base 先頭のアドレス
+### @param[in] labels ラベルをキーにしてアドレスを持つ辞書(Assembler.labels など．省略時はラベルを付けない)
+###
+### model を与えない場合は write_listing() と同じ．
+def print_asm(program, model=None, base=0x10000000, labels=None):
+    if model is not None :
+        for line in model.listing(program, base, labels) :
+            print(line)
+        return
+    write_listing(sys.stdout, program, base, labels)
+
+### @brief 機械語の列を逆アセンブルする．
+### @param[in] words 機械語の列
+### @param[in] base 先頭のアドレス
+###
+### 1語ごとに 'アドレス | 機械語 | ニーモニック' の行を返すジェネレータ．
+### 未定義の命令は '<unknown>' として出力する．
+### 同じ機械語のニーモニックは一度だけ作る．
+def disassemble(words, base=0x10000000):
+    cache = {}
+    addr = base
+    for code in words:
+        line = cache.get(code)
+        if line is None:
+            line = mnemonic(code)
+            if line is None:
+                line = '<unknown>'
+            cache[code] = line
+        yield '{:08x} | {:08x} | {}'.format(addr, code, line)
+        addr += 4
+
+### @brief プログラムを intel HEX フォーマットで標準出力に出力する．
+### @param[in] program 命令のリスト
+### @param[in] record_size 1レコードのバイト数(4 の倍数で 252 以下)
+def print_ihex(program, record_size=4):
+    write_ihex(sys.stdout, [ inst.gen_code() for inst in program ], record_size=record_size)
 
 if __name__ == '__main__' :
 
@@ -997,3 +1584,10 @@ if __name__ == '__main__' :
     inst_test(Inst.SRA(29, 30, 31), 'SRA(x29, x30, x31)')
     inst_test(Inst.OR(1, 2, 3), 'OR(x1, x2, x3)')
     inst_test(Inst.AND(4, 5, 6), 'AND(x4, x5, x6)')
+
+    for rd, imm in ((5, 100), (5, 0x12345000), (5, 0x12345FFF), (5, -1)) :
+        for inst in Inst.LI(rd, imm) :
+            inst_test(inst, 'LI(x{}, {:#x})'.format(rd, imm))
+    inst_test(Inst.MV(1, 2), 'MV(x1, x2)')
+    inst_test(Inst.NOT(3, 4), 'NOT(x3, x4)')
+    inst_test(Inst.RET(), 'RET()')
@@ -0,0 +1,448 @@
+#! /usr/bin/env python3
+
+### @file peephole.py
+### @brief asm() の命令列に対するのぞき穴最適化
+###
+### 使い方:
+###   opt = Peephole()
+###   insts = asm(program, optimizer=opt)
+###   print(opt.report())
+###
+### 規則は rule(ctx, i) の形の関数で，ctx.insts[i] から始まる命令列を調べ，
+### 置き換える場合は (置き換える命令数 n, 新しい命令のリスト, 実行されなくなる命令のリスト) を，
+### 置き換えない場合は None を返す．
+### ctx.insts[i+1:i+n] に飛び先がある場合は置き換えてはならない(ctx.is_target() で調べる)．
+### ctx.insts[i] に飛んでいた分岐は新しい命令列の先頭に飛ぶようになる．
+### 規則は Peephole(rules) または add_rule() で与える．
+###
+### 先頭の命令から分岐，ジャンプ(ラベル参照と数値の相対アドレスの両方)と
+### 呼び出しからの戻り先をたどって実行されうる命令を求め，それ以外のワード(データなど)は書き換えない．
+### 数値の相対アドレスの分岐命令，JAL 命令は，間の命令が消えた分だけ相対アドレスを直す．
+### 実行されないワードが分岐命令，JAL 命令として解釈できる場合は，念のため飛び先までの間を書き換えない．
+### 数値の AUIPC で求めるアドレスも同様に，そのアドレスまでの間を書き換えない．
+### LUI などで作った数値の絶対アドレスは追跡しないので，ラベルを用いること．
+
+from collections import Counter
+
+from cost import CostModel, classify
+from inst import Inst, LabelInst, AsmRangeError, decode
+
+
+### @brief 規則に渡す命令列の情報
+class Context :
+
+    ### @brief 初期化
+    ### @param[in] insts 命令のリスト
+    ### @param[in] labels ラベルをキーにして命令の番号を持つ辞書
+    def __init__(self, insts, labels) :
+        ## @brief 命令のリスト
+        self.insts = insts
+        ## @brief ラベルをキーにして命令の番号を持つ辞書
+        self.labels = labels
+        ## @brief 実行されうる数値の相対アドレスの分岐命令，JAL 命令の番号をキーにして飛び先の番号を持つ辞書
+        ##
+        ## 飛び先がプログラムの外にあるものは含まない(間を書き換えないようにする)．
+        self.jumps = {}
+        n = len(insts)
+        self.__targets = set(labels.values())
+        self.__reachable = bytearray(n)
+        self.__frozen = bytearray(n)
+        self.__trace()
+        for i in range(n) :
+            if not self.__reachable[i] :
+                self.__frozen[i] = 1
+                inst = insts[i]
+                if type(inst) is not LabelInst and (inst.is_branch() or inst.is_jal()) :
+                    self.__freeze(i, i + (inst.get_imm() >> 2))
+
+    # 先頭の命令から実行されうる命令をたどる．
+    def __trace(self) :
+        insts = self.insts
+        labels = self.labels
+        targets = self.__targets
+        reachable = self.__reachable
+        n = len(insts)
+        work = [ 0 ]
+        while work :
+            k = work.pop()
+            # 未定義のラベル(プログラムの外)は None になる．
+            if k is None or not 0 <= k < n or reachable[k] :
+                continue
+            reachable[k] = 1
+            inst = insts[k]
+            if type(inst) is LabelInst :
+                t = labels.get(inst.label)
+                if inst.is_branch() :
+                    work += [ k + 1, t ]
+                elif inst.is_jal() or inst.is_jalr() :
+                    # CALL などの JALR はラベルに飛ぶ．
+                    work.append(t)
+                    if inst.get_rd() != 0 :
+                        targets.add(k + 1)
+                        work.append(k + 1)
+                else :
+                    work.append(k + 1)
+                continue
+            if decode(inst.gen_code()) is None :
+                continue
+            if inst.is_branch() or inst.is_jal() :
+                imm = inst.get_imm()
+                t = k + (imm >> 2)
+                if imm & 3 :
+                    self.__freeze(k, t + 1)
+                elif 0 <= t < n :
+                    self.jumps[k] = t
+                    targets.add(t)
+                else :
+                    self.__freeze(k, t)
+                if inst.is_branch() :
+                    work += [ k + 1, t ]
+                else :
+                    work.append(t)
+                    if inst.get_rd() != 0 :
+                        targets.add(k + 1)
+                        work.append(k + 1)
+            elif inst.is_jalr() :
+                # 飛び先はわからないので，呼び出しからの戻り先だけをたどる．
+                if inst.get_rd() != 0 :
+                    targets.add(k + 1)
+                    work.append(k + 1)
+            else :
+                if inst.is_auipc() :
+                    self.__freeze_auipc(k)
+                work.append(k + 1)
+
+    # 数値の AUIPC で求めるアドレスまでの間を書き換えないようにする．
+    def __freeze_auipc(self, k) :
+        insts = self.insts
+        inst = insts[k]
+        rd = inst.get_rd()
+        offset = inst.get_imm()
+        nxt = insts[k + 1] if k + 1 < len(insts) else None
+        if (nxt is None or type(nxt) is LabelInst or nxt.get_rs1() != rd or
+            not (nxt.is_imm_op() or nxt.is_load() or nxt.is_store() or nxt.is_jalr())) :
+            # アドレスがわからないので全体を書き換えない．
+            self.__freeze(0, len(insts))
+            return
+        offset += nxt.get_imm()
+        self.__freeze(k, k + (offset >> 2) + (1 if offset & 3 else 0))
+
+    # i 番目から j 番目(両端を含む．どちらが前でもよい)の命令を書き換えないようにする．
+    # プログラムの外は端までとする．
+    def __freeze(self, i, j) :
+        lo = max(0, min(i, j))
+        hi = min(len(self.insts), max(i, j) + 1)
+        if lo < hi :
+            self.__frozen[lo:hi] = b'\x01' * (hi - lo)
+
+    ### @brief i 番目の命令の位置にラベルがあるか，分岐や呼び出しからの戻りの飛び先の時 True を返す．
+    def is_target(self, i) :
+        return i in self.__targets
+
+    ### @brief i 番目の命令が実行されうる時 True を返す．
+    def is_reachable(self, i) :
+        return self.__reachable[i] != 0
+
+    ### @brief i 番目の命令を書き換えてはならない時 True を返す．
+    ###
+    ### 実行されないワードと，数値のアドレスで参照される範囲の命令が該当する．
+    def is_frozen(self, i) :
+        return self.__frozen[i] != 0
+
+    ### @brief i 番目の命令(分岐命令，JAL 命令)の飛び先の命令の番号を返す．
+    ###
+    ### ラベル参照の命令はラベルの位置，数値の相対アドレスの命令は jumps の値を返す．
+    ### それ以外の命令と未定義のラベルの場合は None を返す．
+    def target(self, i) :
+        inst = self.insts[i]
+        if type(inst) is not LabelInst :
+            return self.jumps.get(i)
+        return self.labels.get(inst.label)
+
+
+# 結果を捨てても副作用のない演算命令
+def _is_pure(inst) :
+    return inst.is_imm_op() or inst.is_reg_op() or inst.is_lui() or inst.is_auipc()
+
+
+### @brief 何もしない命令を消す．
+###
+### x0 に書き込む演算命令と，ADDI/ORI/XORI/シフト rd, rd, 0 および
+### ADD/SUB/OR/XOR/シフト rd, rd, x0 を消す．
+def remove_nop(ctx, i) :
+    inst = ctx.insts[i]
+    if type(inst) is LabelInst or not _is_pure(inst) :
+        return None
+    rd = inst.get_rd()
+    if rd == 0 :
+        return 1, [], [ inst ]
+    if inst.get_rs1() != rd :
+        return None
+    if inst.is_imm_op() :
+        if inst.get_imm() == 0 and not (inst.is_slti() or inst.is_sltiu() or inst.is_andi()) :
+            return 1, [], [ inst ]
+    elif inst.is_reg_op() :
+        if inst.get_rs2() == 0 and (inst.is_add() or inst.is_sub() or inst.is_or() or inst.is_xor() or
+                                    inst.is_sll() or inst.is_srl() or inst.is_sra()) :
+            return 1, [], [ inst ]
+    return None
+
+
+### @brief 同じレジスタへの連続した ADDI をまとめる．
+###
+### ADDI rd, rs1, a; ADDI rd, rd, b を ADDI rd, rs1, a+b にする．
+### rs1 が rd で a+b が 0 の場合は両方消す．
+def merge_addi(ctx, i) :
+    insts = ctx.insts
+    if i + 1 >= len(insts) or ctx.is_target(i + 1) :
+        return None
+    a = insts[i]
+    b = insts[i + 1]
+    if type(a) is LabelInst or type(b) is LabelInst or not (a.is_addi() and b.is_addi()) :
+        return None
+    rd = a.get_rd()
+    if rd == 0 or b.get_rd() != rd or b.get_rs1() != rd :
+        return None
+    imm = a.get_imm() + b.get_imm()
+    if not -0x800 <= imm < 0x800 :
+        return None
+    if imm == 0 and a.get_rs1() == rd :
+        return 2, [], [ a, b ]
+    return 2, [ Inst.ADDI(rd, a.get_rs1(), imm) ], [ b ]
+
+
+### @brief 次の命令への分岐/ジャンプを消す．
+###
+### 分岐命令と JAL x0 が対象．
+def branch_to_next(ctx, i) :
+    inst = ctx.insts[i]
+    if ctx.target(i) != i + 1 :
+        return None
+    if inst.is_branch() or inst.is_jal() and inst.get_rd() == 0 :
+        return 1, [], [ inst ]
+    return None
+
+
+### @brief JAL の飛び先が JAL x0 の場合は，その飛び先に直接飛ぶようにする．
+###
+### 分岐命令は飛び先が遠くなると緩和で2命令になることがあるので対象にしない．
+def thread_jump(ctx, i) :
+    inst = ctx.insts[i]
+    if type(inst) is not LabelInst or not inst.is_jal() :
+        return None
+    insts = ctx.insts
+    label = inst.label
+    seen = { i }
+    # 通らなくなる JAL x0
+    skipped = []
+    j = ctx.labels.get(label)
+    while j is not None and j < len(insts) and j not in seen :
+        seen.add(j)
+        nxt = insts[j]
+        if type(nxt) is not LabelInst or not nxt.is_jal() or nxt.get_rd() != 0 :
+            break
+        label = nxt.label
+        skipped.append(nxt)
+        j = ctx.labels.get(label)
+    if label == inst.label :
+        return None
+    return 1, [ inst.retarget(label) ], skipped
+
+
+# 数値の相対アドレスの分岐命令，JAL 命令の相対アドレスを変える．
+def _retarget(inst, offset) :
+    if inst.get_imm() == offset :
+        return inst
+    name = decode(inst.gen_code())[0]
+    if inst.is_branch() :
+        if not -0x1000 <= offset < 0x1000 :
+            raise AsmRangeError('{} is out of range: {}'.format(name, offset))
+        return Inst.encode(name, 0, inst.get_rs1(), inst.get_rs2(), offset)
+    if not -0x100000 <= offset < 0x100000 :
+        raise AsmRangeError('{} is out of range: {}'.format(name, offset))
+    return Inst.encode(name, inst.get_rd(), 0, 0, offset)
+
+
+### @brief 既定の規則
+DEFAULT_RULES = (remove_nop, merge_addi, branch_to_next, thread_jump)
+
+
+### @brief のぞき穴最適化パス
+###
+### asm() の optimizer 引数に渡す．変化がなくなるまで規則の適用を繰り返す．
+class Peephole :
+
+    ### @brief 初期化
+    ### @param[in] rules 規則のリスト(省略時は DEFAULT_RULES)
+    ### @param[in] model 削減クロック数の見積もりに用いる cost.CostModel (省略時は既定のもの)
+    def __init__(self, rules=None, model=None) :
+        ## @brief 規則のリスト(先にあるものから試す)
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        ## @brief 削減クロック数の見積もりに用いる cost.CostModel
+        self.model = CostModel() if model is None else model
+        ## @brief 消した命令数
+        self.removed = 0
+        ## @brief 実行されなくなる命令数(それぞれ1回実行されるとした見積もり)
+        self.saved = 0
+        ## @brief 見積もった削減クロック数(実行されなくなる命令の種類ごとのクロック数の和)
+        self.cycles_saved = 0
+        ## @brief 規則の名前をキーにした適用回数
+        self.applied = Counter()
+
+    ### @brief 規則を追加する．
+    def add_rule(self, rule) :
+        self.rules.append(rule)
+
+    ### @brief 最適化する．
+    ### @param[in] insts 命令のリスト
+    ### @param[in] labels ラベルをキーにして命令の番号を持つ辞書
+    ### @return 最適化した (命令のリスト, ラベルの辞書) を返す．
+    def __call__(self, insts, labels) :
+        n0 = len(insts)
+        while True :
+            insts, labels, changed = self.__pass(insts, labels)
+            if not changed :
+                break
+        self.removed += n0 - len(insts)
+        return insts, labels
+
+    # 先頭から1回規則を適用する．
+    def __pass(self, insts, labels) :
+        ctx = Context(insts, labels)
+        rules = self.rules
+        model = self.model
+        jumps = ctx.jumps
+        out = []
+        # 元の命令の番号から新しい命令の番号への対応
+        pos = []
+        # 残した数値の相対アドレスの分岐命令，JAL 命令の (新しい番号, 元の飛び先の番号)
+        moved = []
+        changed = False
+        i = 0
+        n = len(insts)
+        while i < n :
+            result = None
+            if not ctx.is_frozen(i) :
+                for rule in rules :
+                    result = rule(ctx, i)
+                    if result is not None :
+                        count = result[0]
+                        if not any(ctx.is_frozen(k) for k in range(i + 1, min(i + count, n))) :
+                            break
+                        result = None
+            if result is not None :
+                count, replacement, skipped = result
+                pos.extend([ len(out) ] * count)
+                out.extend(replacement)
+                self.saved += len(skipped)
+                self.cycles_saved += sum(model.cycles(classify(inst.gen_code())) for inst in skipped)
+                self.applied[rule.__name__] += 1
+                changed = True
+                i += count
+            else :
+                if i in jumps :
+                    moved.append((len(out), jumps[i]))
+                pos.append(len(out))
+                out.append(insts[i])
+                i += 1
+        pos.append(len(out))
+        for k, t in moved :
+            out[k] = _retarget(out[k], (pos[t] - k) * 4)
+        return out, { name : pos[k] for name, k in labels.items() }, changed
+
+    ### @brief 結果を文字列で返す．
+    def report(self) :
+        lines = [ 'removed {} instructions, saved about {} cycles'.format(self.removed, self.cycles_saved) ]
+        for name, count in self.applied.most_common() :
+            lines.append('  {:16} {}'.format(name, count))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__' :
+
+    import random
+    from argparse import ArgumentParser
+    from inst import asm
+    from sim import Simulator, RAM_BASE
+
+    parser = ArgumentParser(description='check the peephole optimizer on random programs')
+    parser.add_argument('-n', '--programs', type=int, default=200)
+    args = parser.parse_args()
+
+    _BRANCHES = ('LBEQ', 'LBNE', 'LBLT', 'LBGE', 'LBLTU', 'LBGEU')
+    _ALU = ('ADD', 'SUB', 'XOR', 'SLT', 'SLTU', 'AND', 'OR')
+
+    # 素朴なコード生成器の出力に似せた，前向きの分岐だけのプログラムを作る．
+    # 最後は END で止まる．
+    def make_program(rnd, length) :
+        program = [ Inst.LUI(2, RAM_BASE + 0x8000) ]
+        for i in range(length) :
+            if i % 4 == 0 :
+                program.append('L{}'.format(i // 4))
+            k = rnd.random()
+            r = rnd.randrange(3, 12)
+            s = rnd.randrange(0, 12)
+            if k < 0.1 :
+                program.append(Inst.ADDI(r, r, 0))
+            elif k < 0.15 :
+                program.append(Inst.ADD(0, r, s))
+            elif k < 0.3 :
+                program += [ Inst.ADDI(r, s, rnd.randrange(-100, 100)), Inst.ADDI(r, r, rnd.randrange(-2047, 2048)) ]
+            elif k < 0.4 :
+                label = 'L{}'.format(i // 4 + rnd.randrange(1, 3))
+                program.append(getattr(Inst, rnd.choice(_BRANCHES))(r, s, label))
+            elif k < 0.45 :
+                program.append(Inst.LJAL(0, 'J{}'.format(rnd.randrange(3))))
+            elif k < 0.55 :
+                program.append(Inst.SW(2, r, rnd.randrange(16) * 4))
+            elif k < 0.6 :
+                program.append(Inst.LW(r, 2, rnd.randrange(16) * 4))
+            elif k < 0.65 :
+                program.append(Inst.SLLI(r, r, 0))
+            else :
+                program.append(getattr(Inst, rnd.choice(_ALU))(r, s, rnd.randrange(12)))
+        program += [ 'L{}'.format((length - 1) // 4 + k) for k in (1, 2) ]
+        program += [ Inst.LJAL(0, 'END'),
+                     'J0', Inst.LJAL(0, 'J1'), 'J1', Inst.LJAL(0, 'J2'), 'J2', Inst.LJAL(0, 'END'),
+                     'END', Inst.LJAL(0, 'END') ]
+        return program
+
+    def run(insts) :
+        m = Simulator()
+        m.load_words([ inst.gen_code() for inst in insts ])
+        m.run(len(insts) * 4)
+        return m.reg[1:32], bytes(m.mem[0x8000:0x8040])
+
+    # ラベルを数値の相対アドレスに置き換えたプログラムを作る(分岐はすべて1命令で届く)．
+    def numeric(program) :
+        return list(asm(program))
+
+    rnd = random.Random(1)
+    total = Peephole()
+    for k in range(args.programs) :
+        program = make_program(rnd, rnd.randrange(5, 100))
+        if k % 2 :
+            program = numeric(program)
+        expected = run(asm(program))
+        opt = Peephole()
+        result = run(asm(program, optimizer=opt))
+        assert expected == result
+        total.removed += opt.removed
+        total.saved += opt.saved
+        total.cycles_saved += opt.cycles_saved
+        total.applied.update(opt.applied)
+    print(total.report())
+
+    # 数値の相対アドレスの後ろ向きの分岐を含むループ(x8 は 1 のまま．飛び先を誤ると 3 になる)．
+    loop = [ Inst.ADDI(7, 0, 3), Inst.ADDI(8, 8, 1), Inst.ADDI(5, 5, 1), Inst.ADDI(6, 6, 0), Inst.BNE(5, 7, -8), Inst.JAL(0, 0) ]
+    opt = Peephole()
+    insts = asm(loop, optimizer=opt)
+    assert run(asm(loop)) == run(insts) and run(insts)[0][8 - 1] == 1 and len(insts) == 5, insts
+
+    # 実行されないデータのワードは NOP と同じ値でも消さない．
+    nop = Inst.ADDI(0, 0, 0)
+    data = [ Inst.LJAL(0, 'end'), nop, Inst.ADDI(5, 5, 0), 'end', Inst.ADDI(5, 5, 0), Inst.LW(6, 0, 4), Inst.LJAL(0, 'end') ]
+    insts = asm(data, optimizer=Peephole())
+    assert [ x.gen_code() for x in insts[:3] ] == [ Inst.JAL(0, 12).gen_code(), nop.gen_code(), Inst.ADDI(5, 5, 0).gen_code() ], insts
+    assert len(insts) == 5
+    print('OK')
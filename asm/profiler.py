@@ -0,0 +1,352 @@
+#! /usr/bin/env python3
+
+### @file profiler.py
+### @brief Simulator の実行プロファイラ
+###
+### 使い方:
+###   a = Assembler()
+###   a.extend(program)
+###   prof = Profiler(Simulator(a.assemble()), labels=a.labels)
+###   prof.run(1000000)
+###   print(prof.report())
+###
+### 命令ごとの実行回数，命令の種類ごとの実行回数，ロード/ストアのアドレスの分布(RAM のワード単位)，
+### ループ(後ろ向きの分岐)ごとの実行回数を数える．
+### カウンタは RAM のワード位置((PC - RAM_BASE) / 4)を添字とする array に持つ．
+###
+### 計測には2つのモードがある．
+###   - 全数(period が None): Simulator.instrument() で命令の関数を包み，すべての実行を数える．
+###   - サンプリング(period が整数): 命令を包まずに period 命令(の前後に揺らした数)ずつ実行し，
+###     止まった位置の1命令だけを調べて period 回の実行として数える．
+###     長い実行でも速度はほとんど落ちない．
+### 2つのモードの結果は同じカウンタに加算される．
+
+import random
+from array import array
+from bisect import bisect_right
+
+from inst import decode, mnemonic
+from cost import classify, CostModel, CLASS_NAMES, LOAD, STORE, BRANCH_TAKEN, BRANCH_NOT_TAKEN, UNKNOWN
+from sim import RAM_BASE, _NWORDS
+
+# ヒートマップの濃さを表す文字
+_SHADES = ' .:-=+*#%@'
+
+
+### @brief 実行プロファイラ
+class Profiler :
+
+    ### @brief 初期化
+    ### @param[in] sim Simulator または BlockSimulator
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書(報告に用いる)
+    ### @param[in] period サンプリングの間隔(命令数, None の場合は全数を数える)
+    ### @param[in] seed サンプリングの間隔を揺らす乱数の種
+    def __init__(self, sim, labels=None, period=None, seed=0) :
+        ## @brief RAM のワードごとの実行回数
+        self.counts = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとの分岐した回数
+        self.taken = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとのロードの回数(アクセスしたアドレスのワード)
+        self.loads = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとのストアの回数(アクセスしたアドレスのワード)
+        self.stores = array('Q', bytes(8 * _NWORDS))
+        ## @brief RAM のワードごとの命令の種類(最後に調べた時のもの)
+        self.classes = bytearray([ UNKNOWN ]) * _NWORDS
+        ## @brief MU500 からのロードの回数
+        self.io_loads = 0
+        ## @brief MU500 へのストアの回数
+        self.io_stores = 0
+        ## @brief 計測した命令数
+        self.steps = 0
+        ## @brief ラベルをキーにしてアドレスを持つ辞書
+        self.labels = dict(labels or {})
+        self.__sim = sim
+        self.__period = None
+        self.__attached = False
+        self.__rnd = random.Random(seed)
+        self.period = period
+
+    ### @brief サンプリングの間隔(None の場合は全数)
+    @property
+    def period(self) :
+        return self.__period
+
+    @period.setter
+    def period(self, period) :
+        if period is not None and period < 2 :
+            raise ValueError('sampling period must be at least 2: {}'.format(period))
+        if period is None and not self.__attached :
+            self.__sim.instrument(self.__wrap)
+            self.__attached = True
+        elif period is not None and self.__attached :
+            self.__sim.instrument(None)
+            self.__attached = False
+        self.__period = period
+
+    ### @brief 計測をやめる(以後この Profiler で実行してはならない)．
+    def detach(self) :
+        if self.__attached :
+            self.__sim.instrument(None)
+            self.__attached = False
+
+    ### @brief 計測しながら実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    def run(self, max_steps) :
+        period = self.__period
+        if period is None :
+            n = self.__sim.run(max_steps)
+            self.steps += n
+            return n
+        sim = self.__sim
+        rnd = self.__rnd
+        done = 0
+        while done < max_steps :
+            # 一定の間隔だとループの長さと揃った時に同じ命令ばかり調べるので揺らす．
+            interval = rnd.randrange(period >> 1, period + (period >> 1)) + 1
+            interval = min(interval, max_steps - done)
+            n = sim.run(interval - 1)
+            done += n
+            if n < interval - 1 :
+                break
+            n = self.__sample(interval)
+            done += n
+            if n == 0 :
+                break
+        self.steps += done
+        return done
+
+    # 次の命令を1命令実行し，weight 回実行されたものとして数える．
+    def __sample(self, weight) :
+        sim = self.__sim
+        index = (sim.pc >> 2) & 0x3FFF
+        code = sim.wv[index]
+        cls = classify(code)
+        self.classes[index] = cls
+        if cls == LOAD or cls == STORE :
+            a = (sim.reg[(code >> 15) & 0x1F] + decode(code)[1].gather(code)) & 0xFFFFFFFF
+            self.__access(cls, a, weight)
+        n = sim.step()
+        if n :
+            self.counts[index] += weight
+            if cls == BRANCH_NOT_TAKEN and (sim.pc >> 2) & 0x3FFF != (index + 1) & 0x3FFF :
+                self.taken[index] += weight
+        return n
+
+    # ロード/ストアのアドレスを数える．
+    def __access(self, cls, a, weight) :
+        if cls == LOAD :
+            if (a >> 8) != 0x040000 :
+                self.loads[(a & 0xFFFF) >> 2] += weight
+            else :
+                self.io_loads += weight
+        elif (a >> 16) == 0x1000 :
+            self.stores[(a & 0xFFFF) >> 2] += weight
+        elif (a >> 8) == 0x040000 :
+            self.io_stores += weight
+
+    # 命令の関数を包む(全数のモード)．
+    def __wrap(self, index, code, f) :
+        counts = self.counts
+        cls = classify(code)
+        self.classes[index] = cls
+        if cls == BRANCH_NOT_TAKEN :
+            taken = self.taken
+            nxt = (index + 1) & 0x3FFF
+            def g() :
+                counts[index] += 1
+                h = f()
+                if h.index != nxt :
+                    taken[index] += 1
+                return h
+            return g
+        if cls == LOAD or cls == STORE :
+            r = self.__sim.reg
+            rs1 = (code >> 15) & 0x1F
+            imm = decode(code)[1].gather(code)
+            access = self.__access
+            def g() :
+                counts[index] += 1
+                access(cls, (r[rs1] + imm) & 0xFFFFFFFF, 1)
+                return f()
+            return g
+        def g() :
+            counts[index] += 1
+            return f()
+        return g
+
+    ### @brief 命令の種類ごとの実行回数のリストを返す(cost.CLASS_NAMES の順)．
+    def histogram(self) :
+        hist = [ 0 ] * len(CLASS_NAMES)
+        classes = self.classes
+        taken = self.taken
+        for i, n in enumerate(self.counts) :
+            if n :
+                cls = classes[i]
+                if cls == BRANCH_NOT_TAKEN :
+                    hist[BRANCH_TAKEN] += taken[i]
+                    n -= taken[i]
+                hist[cls] += n
+        return hist
+
+    ### @brief アドレスをラベルからの位置で表した文字列を返す．
+    def where(self, addr) :
+        items = sorted((a, name) for name, a in self.labels.items())
+        addrs = [ a for a, _ in items ]
+        k = bisect_right(addrs, addr)
+        if k == 0 :
+            return '{:08x}'.format(addr)
+        a, name = items[k - 1]
+        return name if a == addr else '{}+{:#x}'.format(name, addr - a)
+
+    ### @brief 実行回数の多い命令を返す．
+    ### @param[in] n 返す命令の数
+    ### @return (アドレス, 実行回数) のリストを返す．
+    def hot_pcs(self, n=10) :
+        counts = self.counts
+        hot = sorted((i for i in range(_NWORDS) if counts[i]), key=counts.__getitem__, reverse=True)
+        return [ (RAM_BASE + i * 4, counts[i]) for i in hot[:n] ]
+
+    ### @brief 実行回数の多いループを返す．
+    ### @param[in] n 返すループの数
+    ### @return (先頭のアドレス, 後ろ向きの分岐のアドレス, 回った回数, ループ内の実行命令数) の
+    ###         リストを実行命令数の多い順に返す．
+    ###
+    ### 実行された後ろ向きの分岐/ジャンプとその飛び先の間をループとする．
+    def hot_loops(self, n=10) :
+        counts = self.counts
+        taken = self.taken
+        wv = self.__sim.wv
+        loops = []
+        for i in range(_NWORDS) :
+            if not counts[i] :
+                continue
+            code = wv[i]
+            entry = decode(code)
+            if entry is None :
+                continue
+            name, layout = entry
+            cls = self.classes[i]
+            if name != 'JAL' and cls != BRANCH_NOT_TAKEN :
+                continue
+            start = i + (layout.gather(code) >> 2)
+            if not 0 <= start <= i :
+                continue
+            iterations = counts[i] if name == 'JAL' else taken[i]
+            if iterations :
+                loops.append((RAM_BASE + start * 4, RAM_BASE + i * 4, iterations, sum(counts[start:i + 1])))
+        loops.sort(key=lambda x : x[3], reverse=True)
+        return loops[:n]
+
+    ### @brief ロード/ストアのアドレスの分布を返す．
+    ### @param[in] kind 'load', 'store' または 'both'
+    ### @param[in] bucket 1つにまとめるバイト数(4の倍数)
+    ### @return RAM の先頭から bucket バイトごとのアクセス回数のリストを返す．
+    def heatmap(self, kind='both', bucket=256) :
+        if bucket % 4 or bucket <= 0 :
+            raise ValueError('bucket must be a positive multiple of 4: {}'.format(bucket))
+        if kind == 'load' :
+            sources = (self.loads,)
+        elif kind == 'store' :
+            sources = (self.stores,)
+        elif kind == 'both' :
+            sources = (self.loads, self.stores)
+        else :
+            raise ValueError('unknown kind: {}'.format(kind))
+        words = bucket >> 2
+        return [ sum(sum(s[i:i + words]) for s in sources) for i in range(0, _NWORDS, words) ]
+
+    ### @brief ロード/ストアのアドレスの分布を文字列で返す．
+    ### @param[in] kind 'load', 'store' または 'both'
+    ### @param[in] bucket 1文字で表すバイト数
+    ### @param[in] width 1行の文字数
+    ###
+    ### 各文字はアクセス回数の最大値に対する対数の割合を ' .:-=+*#%@' で表す．
+    def format_heatmap(self, kind='both', bucket=256, width=64) :
+        heat = self.heatmap(kind, bucket)
+        top = max(heat)
+        lines = []
+        for row in range(0, len(heat), width) :
+            chars = []
+            for v in heat[row:row + width] :
+                if v == 0 :
+                    chars.append(_SHADES[0])
+                else :
+                    k = 1 + (len(_SHADES) - 2) * v.bit_length() // max(1, top.bit_length())
+                    chars.append(_SHADES[min(k, len(_SHADES) - 1)])
+            lines.append('{:08x} |{}|'.format(RAM_BASE + row * bucket, ''.join(chars)))
+        return '\n'.join(lines)
+
+    ### @brief 結果を文字列で返す．
+    ### @param[in] n 表示する命令/ループの数
+    ### @param[in] model クロック数の見積もりに用いる cost.CostModel(省略時は既定の表)
+    def report(self, n=10, model=None) :
+        model = model or CostModel()
+        wv = self.__sim.wv
+        mode = 'exact' if not self.__period else 'sampled every ~{} insts'.format(self.__period)
+        lines = [ '{} instructions ({})'.format(self.steps, mode), '', 'classes:' ]
+        hist = self.histogram()
+        total = sum(hist) or 1
+        for cls, count in enumerate(hist) :
+            if count :
+                lines.append('  {:16} {:12} {:6.2f}%'.format(CLASS_NAMES[cls], count, 100 * count / total))
+        lines.append('  {:16} {:12} cycles'.format('estimated', sum(c * model.cycles(k) for k, c in enumerate(hist))))
+        lines += [ '', 'hot instructions:' ]
+        for addr, count in self.hot_pcs(n) :
+            index = (addr - RAM_BASE) >> 2
+            lines.append('  {:08x} {:20} {:12} {:6.2f}%  {}'.format(
+                addr, self.where(addr), count, 100 * count / total, mnemonic(wv[index]) or '<unknown>'))
+        lines += [ '', 'hot loops:' ]
+        for start, end, iterations, count in self.hot_loops(n) :
+            lines.append('  {:20} {:08x}-{:08x} {:10} iterations {:12} insts {:6.2f}%'.format(
+                self.where(start), start, end, iterations, count, 100 * count / total))
+        lines += [ '', 'memory accesses (RAM, 256 bytes/char):' ]
+        lines.append(self.format_heatmap())
+        lines.append('MU500: {} loads, {} stores'.format(self.io_loads, self.io_stores))
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__' :
+
+    import time
+    from argparse import ArgumentParser
+    from inst import Inst, Assembler
+    from sim import Simulator
+
+    parser = ArgumentParser(description='profile a sample program')
+    parser.add_argument('-n', '--steps', type=int, default=1000000)
+    parser.add_argument('-p', '--period', type=int, help='sampling period (default: count every instruction)')
+    args = parser.parse_args()
+
+    # 配列の要素を足し合わせることを繰り返し，和を LED に書き込む．
+    program = [
+        Inst.LUI(5, 0x10008000),
+        Inst.LUI(10, 0x04000000),
+        Inst.ADDI(7, 0, 256),
+        'init',
+        Inst.SW(5, 7, 0),
+        Inst.ADDI(5, 5, 4),
+        Inst.ADDI(7, 7, -1),
+        Inst.LBNE(7, 0, 'init'),
+        'outer',
+        Inst.LUI(5, 0x10008000),
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 256),
+        'sum',
+        Inst.LW(8, 5, 0),
+        Inst.ADD(6, 6, 8),
+        Inst.ADDI(5, 5, 4),
+        Inst.ADDI(7, 7, -1),
+        Inst.LBNE(7, 0, 'sum'),
+        Inst.SW(10, 6, 0),
+        Inst.LJAL(0, 'outer'),
+    ]
+    a = Assembler()
+    a.extend(program)
+    sim = Simulator(a.assemble())
+    prof = Profiler(sim, a.labels, args.period)
+    start = time.perf_counter()
+    prof.run(args.steps)
+    elapsed = time.perf_counter() - start
+    print(prof.report())
+    print('{:.2f} M inst/s'.format(args.steps / elapsed / 1e6))
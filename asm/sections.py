@@ -0,0 +1,376 @@
+#! /usr/bin/env python3
+
+### @file sections.py
+### @brief データのセクションとメモリイメージの作成
+###
+### asm() と同じプログラムのリストに Section, Word, Half, Byte, Space, Align を混ぜて
+### link() に渡すと，.text/.rodata/.data/.bss を 64KB の RAM (mem64kd) の中に配置し，
+### 1つの bytearray のメモリイメージを作る．
+###
+###   program = [
+###       Inst.LLUI(10, 'glyph'),
+###       Inst.LADDI(10, 10, 'glyph'),
+###       Inst.LBU(11, 10, 0),
+###       ...
+###       Section('.rodata'),
+###       'glyph',
+###       Byte(0x3F, 0x06, 0x5B, 0x4F),
+###       Section('.bss'),
+###       'buf',
+###       Space(64),
+###   ]
+###   img = link(program)
+###
+### データのラベルは LLUI/LADDI (絶対アドレス)でも LA (PC 相対)でも参照できる．
+### Word にはラベル(文字列)を書くとそのアドレスになる．
+###
+### セクションは .text を base に置き，アドレスを指定しないセクションは
+### .text, .rodata, .data, .bss の順に直前のセクションの後ろ(4バイト境界)に置く．
+### RAM に収まらない場合や重なる場合は LayoutError 例外を送出する．
+
+from image import Image, MEM_SIZE
+from inst import Assembler, AsmError
+
+### @brief RAM の先頭のアドレス
+RAM_BASE = 0x10000000
+
+### @brief セクションの名前(既定の配置の順)
+SECTIONS = ('.text', '.rodata', '.data', '.bss')
+
+
+### @brief セクションの配置のエラーを表す例外
+class LayoutError(AsmError) :
+    pass
+
+
+### @brief セクションを切り替える指示
+class Section :
+
+    ### @brief 初期化
+    ### @param[in] name セクションの名前(SECTIONS のいずれか)
+    ### @param[in] addr 先頭のアドレス(None の場合は直前のセクションの後ろ)
+    ###
+    ### 同じ名前のセクションが複数ある場合は続けて配置する．addr は最初のものだけに書ける．
+    def __init__(self, name, addr=None) :
+        if name not in SECTIONS :
+            raise LayoutError('unknown section: {}'.format(name))
+        ## @brief セクションの名前
+        self.name = name
+        ## @brief 先頭のアドレス
+        self.addr = addr
+
+    def __repr__(self) :
+        return 'Section({!r}, {})'.format(self.name, None if self.addr is None else '{:#x}'.format(self.addr))
+
+
+# 値を並べるデータの基底クラス
+class _Values :
+
+    # 1つの値のバイト数
+    width = 4
+
+    def __init__(self, *values) :
+        ## @brief 値のタプル
+        self.values = values
+
+    ### @brief バイト数
+    def size(self, addr) :
+        return self.width * len(self.values)
+
+    ### @brief 内容を書き込む．
+    ### @param[in] buf 書き込む先
+    ### @param[in] offset buf の中の位置
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書
+    def emit(self, buf, offset, labels) :
+        width = self.width
+        limit = 1 << (width * 8)
+        for value in self.values :
+            value = self.value(value, labels)
+            if not -(limit >> 1) <= value < limit :
+                raise LayoutError('{:#x} does not fit in {} bytes'.format(value, width))
+            buf[offset:offset + width] = (value & (limit - 1)).to_bytes(width, 'little')
+            offset += width
+
+    def value(self, value, labels) :
+        if type(value) is not int :
+            raise LayoutError('{} takes integers: {!r}'.format(type(self).__name__, value))
+        return value
+
+    def __repr__(self) :
+        return '{}({})'.format(type(self).__name__, ', '.join(map(repr, self.values)))
+
+
+### @brief 32ビットの値を並べる(.word)
+###
+### 値にラベル(文字列)を書くとそのアドレスになる．
+class Word(_Values) :
+
+    width = 4
+
+    def value(self, value, labels) :
+        if type(value) is str :
+            try :
+                return labels[value]
+            except KeyError :
+                raise LayoutError('undefined label: {}'.format(value)) from None
+        return super().value(value, labels)
+
+
+### @brief 16ビットの値を並べる(.half)
+class Half(_Values) :
+
+    width = 2
+
+
+### @brief 8ビットの値を並べる(.byte)
+class Byte(_Values) :
+
+    width = 1
+
+
+### @brief 指定したバイト数の領域を確保する(.space)
+class Space :
+
+    ### @brief 初期化
+    ### @param[in] n バイト数
+    ### @param[in] fill 埋める値(.bss では 0 のみ)
+    def __init__(self, n, fill=0) :
+        if n < 0 or not 0 <= fill < 0x100 :
+            raise LayoutError('bad space: {} bytes of {:#x}'.format(n, fill))
+        self.n = n
+        self.fill = fill
+
+    def size(self, addr) :
+        return self.n
+
+    def emit(self, buf, offset, labels) :
+        if self.fill :
+            buf[offset:offset + self.n] = bytes((self.fill, )) * self.n
+
+    def __repr__(self) :
+        return 'Space({}, {:#x})'.format(self.n, self.fill)
+
+
+### @brief 次のデータを境界に揃える(.balign)
+class Align :
+
+    ### @brief 初期化
+    ### @param[in] n 境界のバイト数(2 のべき)
+    def __init__(self, n) :
+        if n <= 0 or n & (n - 1) :
+            raise LayoutError('alignment must be a power of 2: {}'.format(n))
+        self.n = n
+
+    def size(self, addr) :
+        return -addr & (self.n - 1)
+
+    def emit(self, buf, offset, labels) :
+        pass
+
+    def __repr__(self) :
+        return 'Align({})'.format(self.n)
+
+
+### @brief link() で作ったメモリイメージ
+###
+### data は RAM 全体(RAM_BASE から MEM_SIZE バイト)で，end は最後のセクション(.bss を含む)の
+### 終わりのオフセットとなる．.bss も 0 のイメージに含まれるので，読み込むと初期化される．
+class MemoryImage(Image) :
+
+    def __init__(self) :
+        super().__init__(MEM_SIZE)
+        ## @brief RAM の先頭のアドレス
+        self.base = RAM_BASE
+        ## @brief すべてのラベルをキーにしてアドレスを持つ辞書
+        self.labels = {}
+        ## @brief セクションの名前をキーにして (先頭アドレス, 終わりのアドレス) を持つ辞書
+        self.sections = {}
+        ## @brief .text の命令(Inst)のリスト
+        self.insts = []
+
+    ### @brief 読み込む範囲のバイト列(memoryview)を返す．
+    ###
+    ### Simulator.load_image(img.payload(), img.base) でシミュレータに読み込める．
+    def payload(self) :
+        return memoryview(self.data)[:self.end]
+
+    ### @brief Intel HEX で書き出す．
+    ### @param[in] f 書き出すファイル
+    ### @param[in] record_size 1レコードのバイト数
+    def write_ihex(self, f, record_size=4) :
+        from ihex import write_ihex
+        # ワードの列で渡すと上位バイトから順に書き出される(quartus/program1.hex と同じ形)．
+        write_ihex(f, self.words[:self.nwords()].tolist(), record_size=record_size)
+
+    ### @brief セクションの配置を表す行のリストを返す．
+    def map(self) :
+        return [ '{:8} {:08x}-{:08x} {:6} bytes'.format(name, start, end, end - start)
+                 for name, (start, end) in self.sections.items() ]
+
+
+# プログラムをセクションごとに分ける．
+# セクションの名前をキーにして (指定されたアドレス, 要素のリスト) を持つ辞書を返す．
+def _split(program) :
+    parts = { name : [ None, [] ] for name in SECTIONS }
+    current = parts['.text']
+    name = '.text'
+    for item in program :
+        if type(item) is Section :
+            name = item.name
+            current = parts[name]
+            if item.addr is not None :
+                if current[0] is not None or current[1] :
+                    raise LayoutError('address of {} given twice'.format(name))
+                current[0] = item.addr
+            continue
+        if name == '.text' :
+            if isinstance(item, (_Values, Space, Align)) :
+                raise LayoutError('data in .text: {!r}'.format(item))
+        elif type(item) is not str :
+            if not isinstance(item, (_Values, Space, Align)) :
+                raise LayoutError('instruction in {}: {!r}'.format(name, item))
+            if name == '.bss' and (isinstance(item, _Values) or type(item) is Space and item.fill) :
+                raise LayoutError('initialized data in .bss: {!r}'.format(item))
+        current[1].append(item)
+    return parts
+
+
+# データのセクションのラベルのアドレスを決め，終わりのアドレスを返す．
+def _place(items, addr, labels) :
+    for item in items :
+        if type(item) is str :
+            if item in labels :
+                raise LayoutError('duplicate label: {}'.format(item))
+            labels[item] = addr
+        else :
+            addr += item.size(addr)
+    return addr
+
+
+### @brief セクションを含むプログラムからメモリイメージを作る．
+### @param[in] program 命令，ラベル(文字列)とセクションの指示のリスト
+### @param[in] base .text の先頭のアドレス
+### @param[in] optimizer .text の最適化パス(asm() と同じ)
+### @return MemoryImage を返す．
+###
+### .text は asm() と同じようにアセンブルする(分岐の緩和で大きさが変わる場合は
+### データのセクションを配置し直す)．データのラベルは緩和や最適化で動かない．
+def link(program, base=RAM_BASE, optimizer=None) :
+    parts = _split(program)
+    if parts['.text'][0] is not None and parts['.text'][0] != base :
+        raise LayoutError('.text must start at base {:08x}'.format(base))
+    a = Assembler(base)
+    a.extend(parts['.text'][1])
+    if optimizer is not None :
+        a.optimize(optimizer)
+    text_end = a.pc
+    while True :
+        symbols = {}
+        bounds = { '.text' : (base, text_end) }
+        addr = text_end
+        for name in SECTIONS[1:] :
+            start, items = parts[name]
+            if start is None :
+                start = (addr + 3) & ~3
+            addr = _place(items, start, symbols)
+            bounds[name] = (start, addr)
+        for name in symbols :
+            if name in a.labels :
+                raise LayoutError('duplicate label: {}'.format(name))
+        a.symbols = symbols
+        insts = a.assemble()
+        # 緩和で .text が伸びた場合はデータを後ろにずらしてもう一度解決する．
+        if base + len(insts) * 4 == text_end :
+            break
+        text_end = base + len(insts) * 4
+
+    sections = { name : bounds[name] for name in SECTIONS if bounds[name][1] > bounds[name][0] or name == '.text' }
+    ordered = sorted(sections.items(), key=lambda x: x[1])
+    for name, (start, end) in ordered :
+        if not RAM_BASE <= start or end > RAM_BASE + MEM_SIZE :
+            raise LayoutError('{} ({:08x}-{:08x}) does not fit in RAM ({:08x}-{:08x})'.format(
+                name, start, end, RAM_BASE, RAM_BASE + MEM_SIZE))
+    for (name1, (_, end1)), (name2, (start2, _)) in zip(ordered, ordered[1:]) :
+        if start2 < end1 :
+            raise LayoutError('{} overlaps {} at {:08x}'.format(name2, name1, start2))
+
+    img = MemoryImage()
+    words = img.words
+    offset = (base - RAM_BASE) >> 2
+    for i, inst in enumerate(insts) :
+        words[offset + i] = inst.gen_code()
+    labels = dict(symbols)
+    labels.update(a.labels)
+    data = img.data
+    for name in SECTIONS[1:] :
+        addr = bounds[name][0]
+        for item in parts[name][1] :
+            if type(item) is not str :
+                item.emit(data, addr - RAM_BASE, labels)
+                addr += item.size(addr)
+    img.labels = labels
+    img.sections = sections
+    img.insts = insts
+    img.end = max(end for _, end in sections.values()) - RAM_BASE
+    return img
+
+
+if __name__ == '__main__' :
+
+    from inst import Inst, print_asm
+    from sim import Simulator
+
+    # 7セグメントのパターンを表で引いて，buf に書き込んだ後に HEX0 に表示する．
+    program = [
+        Inst.LLUI(10, 'glyph'),
+        Inst.LADDI(10, 10, 'glyph'),
+        Inst.LA(12, 'buf'),
+        Inst.ADDI(13, 0, 0),
+        Inst.ADDI(14, 0, 10),
+        'loop',
+        Inst.ADD(15, 10, 13),
+        Inst.LBU(11, 15, 0),
+        Inst.ADD(15, 12, 13),
+        Inst.SB(15, 11, 0),
+        Inst.ADDI(13, 13, 1),
+        Inst.LBLT(13, 14, 'loop'),
+        Inst.LLUI(16, 'table'),
+        Inst.LADDI(16, 16, 'table'),
+        Inst.LW(17, 16, 4),
+        Inst.LW(18, 17, 0),
+        Inst.LUI(19, 0x04000000),
+        Inst.SW(19, 18, 0),
+        'end',
+        Inst.LJAL(0, 'end'),
+
+        Section('.rodata'),
+        'glyph',
+        Byte(0x3F, 0x06, 0x5B, 0x4F, 0x66, 0x6D, 0x7D, 0x27, 0x7F, 0x6F),
+        Align(4),
+        'table',
+        Word('glyph', 'count', 0x12345678),
+        Section('.data'),
+        'count',
+        Word(0x0000067F),
+        Half(-1, 0x1234),
+        Section('.bss'),
+        'buf',
+        Space(16),
+    ]
+    img = link(program)
+    print_asm(img.insts, labels=img.labels)
+    print('\n'.join(img.map()))
+
+    sim = Simulator()
+    sim.load_image(img.payload(), img.base)
+    sim.pc = RAM_BASE
+    sim.run(200)
+    assert sim.reg[18] == 0x0000067F, hex(sim.reg[18])
+    assert bytes(sim.mem[img.labels['buf'] & 0xFFFF:][:10]) == bytes(img.data[img.labels['glyph'] - RAM_BASE:][:10])
+    print('seg7 = {:08x}'.format(sim.reg[18]))
+
+    # データが RAM からはみ出す場合
+    try :
+        link([ Inst.ADDI(0, 0, 0), Section('.bss'), 'big', Space(MEM_SIZE) ])
+    except LayoutError as e :
+        print('error:', e)
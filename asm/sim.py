@@ -0,0 +1,790 @@
+#! /usr/bin/env python3
+
+### @file sim.py
+### @brief KAPPA3-RV32I の命令セットシミュレータ
+###
+### asm() の出力(または機械語の列)を kappa3 のメモリマップ上で実行する．
+###
+### メモリマップ
+###   0x0400 0000 - 0x0400 004f : MU500 (7セグ, ドットLED, ボタン, スイッチ)
+###   0x1000 0000 - 0x1000 ffff : RAM (64Kバイト)
+###
+### RAM は verilog-src/public/memory.v と同じく，書き込みはアドレスの上位16ビットが
+### 0x1000 の時のみ行われ，読み出しは上位ビットに関わらず address[15:0] で行われる．
+### ワード/ハーフワードのアクセスは境界に揃えたアドレスで行う(ldconv/stconv と同じ)．
+###
+### 各命令は RAM のワードごとに一度だけ Python の関数(クロージャ)に変換される．
+### 関数は次に実行する命令の関数を返すので，実行ループは関数を呼び出すだけでよい．
+### 変換済みのワードへの書き込みがあると，そのワードは再変換される．
+### PC は RAM 上のワード位置として扱うので，RAM 外への分岐は RAM 内に折り返される．
+### メモリの内容は実行ホストのバイトオーダがリトルエンディアンであることを仮定している．
+###
+### 速さの目安(python sim.py)は演算と分岐のみのループで 5 M inst/s 程度，
+### 4-5命令ごとに SW/LW を含むループで 3.5-4 M inst/s 程度である．読み書きの多いプログラムで
+### 5 M inst/s 以上が必要な場合は，ブロック単位で変換する block.BlockSimulator を用いる
+### (python block.py で同じループを比べる)．
+
+from collections import deque
+from itertools import repeat
+
+from inst import decode
+
+### @brief RAM の先頭アドレス
+RAM_BASE = 0x10000000
+
+### @brief RAM のサイズ(バイト)
+RAM_SIZE = 0x10000
+
+### @brief MU500 の先頭アドレス
+IO_BASE = 0x04000000
+
+### @brief MU500 のレジスタのサイズ(バイト)
+IO_SIZE = 0x50
+
+### @brief 7セグ LED のオフセット(8行x8列x8ビット)
+SEG7_OFFSET = 0x00
+
+### @brief ドットマトリクス LED のオフセット(8バイト)
+DOT_OFFSET = 0x40
+
+### @brief プッシュボタンのオフセット(4行x5列)
+BUTTON_OFFSET = 0x48
+
+### @brief ロータリースイッチ(hex_a, hex_b)のオフセット
+HEX_OFFSET = 0x4C
+
+### @brief DIPスイッチ(dip_a, dip_b)のオフセット
+DIP_OFFSET = 0x4E
+
+M32 = 0xFFFFFFFF
+
+# RAM のワード数
+_NWORDS = RAM_SIZE >> 2
+
+### @brief Simulator.seg7_log に残す記録の数
+SEG7_LOG_SIZE = 4096
+
+### @brief 書き込みを記録する RAM のページの大きさ(ビット数)
+PAGE_SHIFT = 8
+
+### @brief RAM のページ数
+NPAGES = RAM_SIZE >> PAGE_SHIFT
+
+
+### @brief シミュレーション中のエラーを表す例外
+class SimulationError(Exception) :
+    pass
+
+
+### @brief 32ビットの値を符号付き整数に変換する．
+def signed(v) :
+    return v - ((v & 0x80000000) << 1)
+
+
+### 以下は各命令の関数を作る関数
+### @param[in] m Simulator
+### @param[in] index 命令の RAM 上のワード位置
+### @param[in] rd, rs1, rs2 レジスタ番号
+### @param[in] imm 即値(符号拡張済み)
+###
+### 作られる関数は引数をとらず，次に実行する命令の関数を返す．
+
+def _LUI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = imm
+        return ops[nxt]
+    return f
+
+def _AUIPC(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    value = (RAM_BASE + index * 4 + imm) & 0xFFFFFFFF
+    def f() :
+        r[rd] = value
+        return ops[nxt]
+    return f
+
+def _JAL(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops
+    link = RAM_BASE + index * 4 + 4
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        r[rd] = link
+        return ops[target]
+    return f
+
+def _JALR(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops
+    link = RAM_BASE + index * 4 + 4
+    def f() :
+        t = (r[rs1] + imm) >> 2
+        r[rd] = link
+        return ops[t & 0x3FFF]
+    return f
+
+def _BEQ(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if r[rs1] == r[rs2] :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _BNE(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if r[rs1] != r[rs2] :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _BLT(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if (r[rs1] ^ 0x80000000) < (r[rs2] ^ 0x80000000) :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _BGE(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if (r[rs1] ^ 0x80000000) >= (r[rs2] ^ 0x80000000) :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _BLTU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if r[rs1] < r[rs2] :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _BGEU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    target = (index + (imm >> 2)) & 0x3FFF
+    def f() :
+        if r[rs1] >= r[rs2] :
+            return ops[target]
+        return ops[nxt]
+    return f
+
+def _LB(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; mem = m.mem; load_io = m.load_io
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 8) != 0x040000 :
+            v = mem[a & 0xFFFF]
+        else :
+            v = load_io(a, 1)
+        r[rd] = (v ^ 0x80) - 0x80 & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _LH(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; hv = m.hv; load_io = m.load_io
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 8) != 0x040000 :
+            v = hv[(a & 0xFFFF) >> 1]
+        else :
+            v = load_io(a & ~1, 2)
+        r[rd] = (v ^ 0x8000) - 0x8000 & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _LW(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; wv = m.wv; load_io = m.load_io
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 8) != 0x040000 :
+            r[rd] = wv[(a & 0xFFFF) >> 2]
+        else :
+            r[rd] = load_io(a & ~3, 4)
+        return ops[nxt]
+    return f
+
+def _LBU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; mem = m.mem; load_io = m.load_io
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 8) != 0x040000 :
+            r[rd] = mem[a & 0xFFFF]
+        else :
+            r[rd] = load_io(a, 1)
+        return ops[nxt]
+    return f
+
+def _LHU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; hv = m.hv; load_io = m.load_io
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 8) != 0x040000 :
+            r[rd] = hv[(a & 0xFFFF) >> 1]
+        else :
+            r[rd] = load_io(a & ~1, 2)
+        return ops[nxt]
+    return f
+
+def _SB(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; mem = m.mem; code = m.code; invalidate = m.invalidate; store_io = m.store_io; dirty = m.dirty
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 16) == 0x1000 :
+            a &= 0xFFFF
+            mem[a] = r[rs2] & 0xFF
+            dirty[a >> 8] = 1
+            if code[a >> 2] :
+                invalidate(a >> 2)
+        elif (a >> 8) == 0x040000 :
+            store_io(a, r[rs2] & 0xFF, 1)
+        return ops[nxt]
+    return f
+
+def _SH(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; hv = m.hv; code = m.code; invalidate = m.invalidate; store_io = m.store_io; dirty = m.dirty
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 16) == 0x1000 :
+            a &= 0xFFFF
+            hv[a >> 1] = r[rs2] & 0xFFFF
+            dirty[a >> 8] = 1
+            if code[a >> 2] :
+                invalidate(a >> 2)
+        elif (a >> 8) == 0x040000 :
+            store_io(a & ~1, r[rs2] & 0xFFFF, 2)
+        return ops[nxt]
+    return f
+
+def _SW(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF; wv = m.wv; code = m.code; invalidate = m.invalidate; store_io = m.store_io; dirty = m.dirty
+    def f() :
+        a = r[rs1] + imm
+        if (a >> 16) == 0x1000 :
+            a = (a & 0xFFFF) >> 2
+            wv[a] = r[rs2]
+            dirty[a >> 6] = 1
+            if code[a] :
+                invalidate(a)
+        elif (a >> 8) == 0x040000 :
+            store_io(a & ~3, r[rs2], 4)
+        return ops[nxt]
+    return f
+
+def _ADDI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = (r[rs1] + imm) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _SLTI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm ^= 0x80000000
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = 1 if (r[rs1] ^ 0x80000000) < imm else 0
+        return ops[nxt]
+    return f
+
+def _SLTIU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = 1 if r[rs1] < imm else 0
+        return ops[nxt]
+    return f
+
+def _XORI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = r[rs1] ^ imm
+        return ops[nxt]
+    return f
+
+def _ORI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = r[rs1] | imm
+        return ops[nxt]
+    return f
+
+def _ANDI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    imm &= 0xFFFFFFFF
+    def f() :
+        r[rd] = r[rs1] & imm
+        return ops[nxt]
+    return f
+
+def _SLLI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = (r[rs1] << imm) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _SRLI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = r[rs1] >> imm
+        return ops[nxt]
+    return f
+
+def _SRAI(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        v = r[rs1]
+        r[rd] = ((v - ((v & 0x80000000) << 1)) >> imm) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _ADD(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = (r[rs1] + r[rs2]) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _SUB(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = (r[rs1] - r[rs2]) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _SLL(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = (r[rs1] << (r[rs2] & 0x1F)) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _SLT(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = 1 if (r[rs1] ^ 0x80000000) < (r[rs2] ^ 0x80000000) else 0
+        return ops[nxt]
+    return f
+
+def _SLTU(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = 1 if r[rs1] < r[rs2] else 0
+        return ops[nxt]
+    return f
+
+def _XOR(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = r[rs1] ^ r[rs2]
+        return ops[nxt]
+    return f
+
+def _SRL(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = r[rs1] >> (r[rs2] & 0x1F)
+        return ops[nxt]
+    return f
+
+def _SRA(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        v = r[rs1]
+        r[rd] = ((v - ((v & 0x80000000) << 1)) >> (r[rs2] & 0x1F)) & 0xFFFFFFFF
+        return ops[nxt]
+    return f
+
+def _OR(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = r[rs1] | r[rs2]
+        return ops[nxt]
+    return f
+
+def _AND(m, index, rd, rs1, rs2, imm) :
+    r = m.reg; ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        r[rd] = r[rs1] & r[rs2]
+        return ops[nxt]
+    return f
+
+### @brief x0 に書き込むだけの命令(NOP)
+def _NOP(m, index, rd, rs1, rs2, imm) :
+    ops = m.ops; nxt = (index + 1) & 0x3FFF
+    def f() :
+        return ops[nxt]
+    return f
+
+
+### @brief ニーモニックをキーにして命令の関数を作る関数を持つ辞書
+FACTORY = {
+    'LUI'   : _LUI,
+    'AUIPC' : _AUIPC,
+    'JAL'   : _JAL,
+    'JALR'  : _JALR,
+    'BEQ'   : _BEQ,
+    'BNE'   : _BNE,
+    'BLT'   : _BLT,
+    'BGE'   : _BGE,
+    'BLTU'  : _BLTU,
+    'BGEU'  : _BGEU,
+    'LB'    : _LB,
+    'LH'    : _LH,
+    'LW'    : _LW,
+    'LBU'   : _LBU,
+    'LHU'   : _LHU,
+    'SB'    : _SB,
+    'SH'    : _SH,
+    'SW'    : _SW,
+    'ADDI'  : _ADDI,
+    'SLTI'  : _SLTI,
+    'SLTIU' : _SLTIU,
+    'XORI'  : _XORI,
+    'ORI'   : _ORI,
+    'ANDI'  : _ANDI,
+    'SLLI'  : _SLLI,
+    'SRLI'  : _SRLI,
+    'SRAI'  : _SRAI,
+    'ADD'   : _ADD,
+    'SUB'   : _SUB,
+    'SLL'   : _SLL,
+    'SLT'   : _SLT,
+    'SLTU'  : _SLTU,
+    'XOR'   : _XOR,
+    'SRL'   : _SRL,
+    'SRA'   : _SRA,
+    'OR'    : _OR,
+    'AND'   : _AND,
+}
+
+# rd を持たない命令
+_NO_RD = frozenset(('BEQ', 'BNE', 'BLT', 'BGE', 'BLTU', 'BGEU', 'SB', 'SH', 'SW'))
+
+# rd が x0 でも NOP にできない命令(制御の移動と副作用のあるもの)
+_SIDE_EFFECT = frozenset(('JAL', 'JALR', 'LB', 'LH', 'LW', 'LBU', 'LHU'))
+
+
+### @brief KAPPA3-RV32I の命令セットシミュレータ
+class Simulator :
+
+    ### @brief 初期化
+    ### @param[in] program asm() の出力(Inst のリスト)
+    ### @param[in] base プログラムの先頭アドレス
+    def __init__(self, program=None, base=RAM_BASE) :
+        ## @brief レジスタファイル(x0 - x31)
+        ##
+        ## 最後の要素は x0 を書き込み先とする命令の捨て場所として用いる．
+        self.reg = [ 0 ] * 33
+        ## @brief RAM の内容
+        self.mem = bytearray(RAM_SIZE)
+        self.wv = memoryview(self.mem).cast('I')
+        self.hv = memoryview(self.mem).cast('H')
+        ## @brief RAM のページ(1 << PAGE_SHIFT バイト)ごとの書き込みの印
+        ##
+        ## ストア命令と load_words()/load_image() が 1 にする．0 に戻すのは利用者(snapshot.History など)．
+        self.dirty = bytearray(NPAGES)
+        ## @brief MU500 のレジスタ
+        self.io = bytearray(IO_SIZE)
+        ## @brief 7セグ/ドットLED への書き込みで値が変化したものの記録
+        ##
+        ## (オフセット, 値) の deque．最近の SEG7_LOG_SIZE 個だけを残す．
+        ## 長い実行の表示の変化は devices.DeviceBus の Event で記録する．
+        self.seg7_log = deque(maxlen=SEG7_LOG_SIZE)
+        ## @brief 次に実行する命令のアドレス
+        self.pc = base
+        ## @brief 実行した命令数
+        self.steps = 0
+
+        ## @brief RAM のワードごとの未変換の命令の関数
+        self.misses = [ self.__make_miss(i) for i in range(_NWORDS) ]
+        ## @brief RAM のワードごとの命令の関数
+        self.ops = list(self.misses)
+        ## @brief RAM のワードごとの変換済みの印
+        ##
+        ## 0 でないワードへの書き込みがあると invalidate() が呼ばれる．
+        self.code = bytearray(_NWORDS)
+
+        # 実行を停止した時に用いる関数と停止の原因
+        self.__halt = self.__make_halt()
+        self.__trap = None
+        self.__trap_index = 0
+        self.__idle = 0
+        # 命令の関数を包む関数
+        self.__wrap = None
+
+        if program is not None :
+            self.load_words([ inst.gen_code() for inst in program ], base)
+
+    ### @brief 機械語の列を RAM に書き込む．
+    ### @param[in] words 機械語の列
+    ### @param[in] base 先頭のアドレス
+    ###
+    ### 書き込んだ命令はこの時点で関数に変換される．
+    def load_words(self, words, base=RAM_BASE) :
+        index = (base & 0xFFFF) >> 2
+        if index + len(words) > _NWORDS :
+            raise SimulationError('program does not fit in RAM: {} words at {:08x}'.format(len(words), base))
+        for i, code in enumerate(words) :
+            self.wv[index + i] = code
+        first = index >> (PAGE_SHIFT - 2)
+        last = (index + len(words) + (1 << (PAGE_SHIFT - 2)) - 1) >> (PAGE_SHIFT - 2)
+        self.dirty[first:last] = b'\x01' * (last - first)
+        for i in range(index, index + len(words)) :
+            if self.code[i] :
+                self.invalidate(i)
+            self.ops[i] = self.__compile(i)
+            self.code[i] = 1
+
+    ### @brief メモリイメージを RAM に書き込む．
+    ### @param[in] data RAM と同じバイトの並びの内容(image.Image の data など)
+    ### @param[in] base 先頭のアドレス
+    ###
+    ### 命令は実行時に関数に変換される．
+    def load_image(self, data, base=RAM_BASE) :
+        offset = base & 0xFFFF
+        size = len(data)
+        if offset + size > RAM_SIZE :
+            raise SimulationError('image does not fit in RAM: {} bytes at {:08x}'.format(size, base))
+        self.mem[offset:offset + size] = data
+        first = offset >> PAGE_SHIFT
+        last = (offset + size + (1 << PAGE_SHIFT) - 1) >> PAGE_SHIFT
+        self.dirty[first:last] = b'\x01' * (last - first)
+        code = self.code
+        end = (offset + size + 3) >> 2
+        i = code.find(1, offset >> 2, end)
+        while i >= 0 :
+            self.invalidate(i)
+            i = code.find(1, i + 1, end)
+
+    ### @brief RAM のワードの変換結果を破棄する．
+    ### @param[in] index ワード位置
+    ###
+    ### 変換済みのワードに書き込みがあった時に呼ばれる．
+    def invalidate(self, index) :
+        self.ops[index] = self.misses[index]
+        self.code[index] = 0
+
+    ### @brief 命令の関数を包む関数を設定する．
+    ### @param[in] wrap wrap(index, code, f) の形の関数(None で解除)
+    ###
+    ### 以後，ワード位置 index の機械語 code の命令の関数 f は wrap() の返す関数に置き換えられる．
+    ### 返す関数は f() の結果(次の命令の関数)を返さなければならない．
+    ### 実行回数の計測などに用いる．変換済みの命令はすべて変換し直される．
+    def instrument(self, wrap) :
+        self.__wrap = wrap
+        code = self.code
+        i = code.find(1)
+        while i >= 0 :
+            self.invalidate(i)
+            i = code.find(1, i + 1)
+
+    ### @brief MU500 の読み書きを行う関数を設定する．
+    ### @param[in] load_io load_io(addr, size) の形の関数(None で既定に戻す)
+    ### @param[in] store_io store_io(addr, value, size) の形の関数(None で既定に戻す)
+    ###
+    ### devices.DeviceBus などが用いる．変換済みの命令はすべて変換し直される．
+    def set_io(self, load_io=None, store_io=None) :
+        if load_io is None :
+            self.__dict__.pop('load_io', None)
+        else :
+            self.load_io = load_io
+        if store_io is None :
+            self.__dict__.pop('store_io', None)
+        else :
+            self.store_io = store_io
+        code = self.code
+        i = code.find(1)
+        while i >= 0 :
+            self.invalidate(i)
+            i = code.find(1, i + 1)
+
+    ### @brief 入力(スイッチ/ボタン)の値を設定する．
+    ### @param[in] dip_a, dip_b DIPスイッチの値(8ビット)
+    ### @param[in] hex_a, hex_b ロータリースイッチの値(4ビット)
+    ### @param[in] buttons プッシュボタンの値(4バイトのリスト)
+    def set_inputs(self, dip_a=None, dip_b=None, hex_a=None, hex_b=None, buttons=None) :
+        io = self.io
+        if dip_a is not None :
+            io[DIP_OFFSET] = dip_a & 0xFF
+        if dip_b is not None :
+            io[DIP_OFFSET + 1] = dip_b & 0xFF
+        if hex_a is not None :
+            io[HEX_OFFSET] = hex_a & 0x0F
+        if hex_b is not None :
+            io[HEX_OFFSET + 1] = hex_b & 0x0F
+        if buttons is not None :
+            for i, v in enumerate(buttons) :
+                io[BUTTON_OFFSET + i] = v & 0x1F
+
+    ### @brief MU500 からの読み出しを行う．
+    ### @param[in] addr アドレス
+    ### @param[in] size バイト数
+    def load_io(self, addr, size) :
+        offset = addr - IO_BASE
+        return int.from_bytes(self.io[offset:offset + size], 'little')
+
+    ### @brief MU500 への書き込みを行う．
+    ### @param[in] addr アドレス
+    ### @param[in] value 値
+    ### @param[in] size バイト数
+    ###
+    ### 入力用のレジスタ(ボタン，スイッチ)への書き込みは無視される．
+    def store_io(self, addr, value, size) :
+        offset = addr - IO_BASE
+        io = self.io
+        for i in range(size) :
+            o = offset + i
+            if o >= BUTTON_OFFSET :
+                break
+            v = (value >> (i * 8)) & 0xFF
+            if io[o] != v :
+                io[o] = v
+                self.seg7_log.append((o, v))
+
+    ### @brief 7セグ LED の表示内容(64バイト)を返す．
+    def seg7(self) :
+        return bytes(self.io[SEG7_OFFSET:SEG7_OFFSET + 64])
+
+    ### @brief 指定された命令数だけ実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    ###
+    ### 未定義の命令に到達した場合はその命令の直前で停止して
+    ### SimulationError 例外を送出する．
+    ### 入出力の処理で例外が起きた場合の steps は 8命令単位の概数となる．
+    def run(self, max_steps) :
+        halt = self.__halt
+        self.__trap = None
+        self.__idle = 0
+        f = self.ops[(self.pc >> 2) & 0x3FFF]
+        calls = 0
+        try :
+            # 関数呼び出しを 8回ずつ展開してループのオーバーヘッドを減らす．
+            for _ in repeat(None, max_steps >> 3) :
+                f = f(); f = f(); f = f(); f = f()
+                f = f(); f = f(); f = f(); f = f()
+                calls += 8
+                if f is halt :
+                    break
+            else :
+                for _ in repeat(None, max_steps & 7) :
+                    f = f()
+                    calls += 1
+        finally :
+            n = calls - self.__idle
+            self.steps += n
+            if f is halt :
+                self.pc = RAM_BASE + self.__trap_index * 4
+            else :
+                self.pc = RAM_BASE + f.index * 4
+        if self.__trap is not None :
+            raise self.__trap
+        return n
+
+    ### @brief 1命令実行する．
+    def step(self) :
+        return self.run(1)
+
+    ### @brief 指定されたワード位置の命令を関数に変換する．
+    def __compile(self, index) :
+        code = self.wv[index]
+        entry = decode(code)
+        if entry is None :
+            f = self.__make_trap(index, 'unknown instruction {:08x} at {:08x}'.format(code, RAM_BASE + index * 4))
+        else :
+            name, layout = entry
+            rd = (code >> 7) & 0x1F
+            rs1 = (code >> 15) & 0x1F
+            rs2 = (code >> 20) & 0x1F
+            imm = layout.gather(code)
+            factory = FACTORY[name]
+            if rd == 0 and name not in _NO_RD :
+                if name not in _SIDE_EFFECT :
+                    factory = _NOP
+                rd = 32
+            f = factory(self, index, rd, rs1, rs2, imm)
+            if self.__wrap is not None :
+                f = self.__wrap(index, code, f)
+        f.index = index
+        return f
+
+    ### @brief 未変換の命令を変換してから実行する関数を作る．
+    def __make_miss(self, index) :
+        def miss() :
+            f = self.ops[index] = self.__compile(index)
+            self.code[index] = 1
+            return f()
+        miss.index = index
+        return miss
+
+    ### @brief 実行を停止する関数を作る．
+    ###
+    ### 停止後の呼び出しは実行命令数に数えない．
+    def __make_halt(self) :
+        def halt() :
+            self.__idle += 1
+            return halt
+        return halt
+
+    ### @brief 実行を停止して例外を送出させる関数を作る．
+    def __make_trap(self, index, message) :
+        halt = self.__halt
+        def trap() :
+            self.__trap = SimulationError(message)
+            self.__trap_index = index
+            self.__idle += 1
+            return halt
+        return trap
+
+
+if __name__ == '__main__' :
+
+    import time
+    from inst import Inst, asm
+
+    # 1 から 1000 までの和を求めることを繰り返す(演算と分岐のみ)．
+    alu = [
+        'outer',
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 1000),
+        'loop',
+        Inst.ADD(6, 6, 7),
+        Inst.ADDI(7, 7, -1),
+        Inst.XOR(8, 6, 7),
+        Inst.SLLI(9, 8, 3),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+    ]
+    # 同じ計算で途中結果を RAM に書き込んで読み出す．
+    mem = [
+        Inst.LUI(5, 0x10008000),
+        'outer',
+        Inst.ADDI(6, 0, 0),
+        Inst.ADDI(7, 0, 1000),
+        'loop',
+        Inst.ADD(6, 6, 7),
+        Inst.ADDI(7, 7, -1),
+        Inst.SW(5, 6, 0),
+        Inst.LW(8, 5, 0),
+        Inst.LBNE(7, 0, 'loop'),
+        Inst.LJAL(0, 'outer'),
+    ]
+    n = 10000000
+    for name, program in (('alu', alu), ('mem', mem)) :
+        sim = Simulator(asm(program))
+        start = time.perf_counter()
+        sim.run(n)
+        elapsed = time.perf_counter() - start
+        print('{} : {:.2f} M inst/s'.format(name, n / elapsed / 1e6))
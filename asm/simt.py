@@ -0,0 +1,446 @@
+#! /usr/bin/env python3
+
+### @file simt.py
+### @brief 1つのプログラムを多数の入力で同時に実行する NumPy 版シミュレータ
+###
+### LockstepSimulator は N 個のレーン(それぞれ独立した kappa3 の状態)で同じプログラムを
+### SIMT 方式で実行する．各ステップでは実行中のレーンのうち PC が最小のものの命令を
+### 1つ選び，その PC にいるレーンだけ(発散のマスク)でその命令をベクトル演算で実行する．
+### 分岐で PC が分かれたレーンは，PC の小さい方が追いつくと再び一緒に実行される．
+###
+###   dip_a, dip_b = dip_sweep()
+###   m = LockstepSimulator(asm(program), len(dip_a))
+###   m.set_inputs(dip_a=dip_a, dip_b=dip_b)
+###   m.run(100000)
+###   m.seg7()[:, 0]
+###
+### 状態は次の NumPy の配列で持つ．
+###   reg    : N x 32 の uint32 (列ごとに連続するように Fortran 順)
+###   pc     : N の int32 (RAM のワード位置)
+###   io     : N x 256 の uint8 (MU500 のレジスタ，入力も出力もレーンごと)
+###   steps  : N の int64 (実行した命令数)
+###   status : N の uint8 (RUNNING, DONE, LIMIT, ERROR)
+### RAM は全レーンで共有する 64KB を持ち，どれかのレーンが書き込んだ 256バイトの
+### ページだけを N x 256 のレーンごとのページに複写する(コピーオンライト)．
+###
+### sim.Simulator と同じメモリマップと命令の動作で実行する．ただし次の点が異なる．
+###   - 命令は読み込んだ時の内容で実行する(RAM への書き込みは命令に反映しない)．
+###   - 'JAL x0, 0' (その場での無限ループ)に達したレーンはそこで止まる(DONE)．
+###   - PC の小さいレーンが止まらない間は，PC の大きいレーンは実行されない．
+
+import numpy as np
+
+from inst import decode
+from sim import RAM_BASE, RAM_SIZE, IO_BASE, BUTTON_OFFSET, HEX_OFFSET, DIP_OFFSET
+
+### @brief 実行中
+RUNNING = 0
+### @brief JAL x0, 0 に達した
+DONE = 1
+### @brief 命令数の上限に達した
+LIMIT = 2
+### @brief 未定義の命令に達した
+ERROR = 3
+
+# RAM のワード数
+_NWORDS = RAM_SIZE >> 2
+
+# レーンごとの MU500 のレジスタの大きさ(ロード/ストアが MU500 として扱う範囲)
+_IO_WINDOW = 0x100
+
+_U32 = np.uint32
+_I32 = np.int32
+
+# R 形式と I 形式の演算: 名前 -> (符号なしの演算, 符号付きの演算)
+# 値は uint32 の配列，b は配列またはスカラ．
+_ALU = {
+    'ADD'  : lambda a, b : a + b,
+    'SUB'  : lambda a, b : a - b,
+    'XOR'  : lambda a, b : a ^ b,
+    'OR'   : lambda a, b : a | b,
+    'AND'  : lambda a, b : a & b,
+    'SLL'  : lambda a, b : a << (b & _U32(31)),
+    'SRL'  : lambda a, b : a >> (b & _U32(31)),
+    'SRA'  : lambda a, b : (a.view(_I32) >> (b & _U32(31)).astype(_I32)).view(_U32),
+    'SLT'  : lambda a, b : (a.view(_I32) < np.asarray(b).view(_I32)).astype(_U32),
+    'SLTU' : lambda a, b : (a < b).astype(_U32),
+}
+
+# 即値の演算と R 形式の演算の対応
+_ALU_IMM = {
+    'ADDI' : 'ADD', 'XORI' : 'XOR', 'ORI' : 'OR', 'ANDI' : 'AND',
+    'SLLI' : 'SLL', 'SRLI' : 'SRL', 'SRAI' : 'SRA', 'SLTI' : 'SLT', 'SLTIU' : 'SLTU',
+}
+
+# 分岐の条件
+_BRANCH = {
+    'BEQ'  : lambda a, b : a == b,
+    'BNE'  : lambda a, b : a != b,
+    'BLT'  : lambda a, b : a.view(_I32) < b.view(_I32),
+    'BGE'  : lambda a, b : a.view(_I32) >= b.view(_I32),
+    'BLTU' : lambda a, b : a < b,
+    'BGEU' : lambda a, b : a >= b,
+}
+
+# ロード: 名前 -> (バイト数, 符号拡張する型)
+_LOAD = {
+    'LB' : (1, np.int8), 'LH' : (2, np.int16), 'LW' : (4, None),
+    'LBU' : (1, None), 'LHU' : (2, None),
+}
+
+# ストア: 名前 -> バイト数
+_STORE = { 'SB' : 1, 'SH' : 2, 'SW' : 4 }
+
+# バイト数ごとの要素の型
+_DTYPE = { 1 : np.uint8, 2 : np.uint16, 4 : np.uint32 }
+
+# JAL x0, 0
+_SELF_LOOP = 0x0000006F
+
+
+### @brief DIPスイッチ(dip_a, dip_b)のすべての組み合わせを返す．
+### @return (dip_a, dip_b) の 65536 要素の配列の組を返す．レーン k は dip_a = k & 0xFF, dip_b = k >> 8．
+def dip_sweep() :
+    k = np.arange(0x10000, dtype=np.uint32)
+    return (k & 0xFF).astype(np.uint8), (k >> 8).astype(np.uint8)
+
+
+### @brief 1つのプログラムを多数のレーンで同時に実行するシミュレータ
+class LockstepSimulator :
+
+    ### @brief 初期化
+    ### @param[in] program asm() の出力(Inst のリスト)または機械語の列
+    ### @param[in] lanes レーン数
+    ### @param[in] base プログラムの先頭アドレス
+    def __init__(self, program, lanes, base=RAM_BASE) :
+        ## @brief レーン数
+        self.lanes = lanes
+        ## @brief 全レーンで共有する RAM の内容
+        self.mem = np.zeros(RAM_SIZE, dtype=np.uint8)
+        ## @brief レジスタファイル(N x 32, x0 は常に 0)
+        self.reg = np.zeros((lanes, 32), dtype=np.uint32, order='F')
+        ## @brief 次に実行する命令のワード位置
+        self.pc = np.full(lanes, (base & 0xFFFF) >> 2, dtype=np.int32)
+        ## @brief MU500 のレジスタ(N x 256)
+        self.io = np.zeros((lanes, _IO_WINDOW), dtype=np.uint8)
+        ## @brief 実行した命令数
+        self.steps = np.zeros(lanes, dtype=np.int64)
+        ## @brief 状態(RUNNING, DONE, LIMIT, ERROR)
+        self.status = np.zeros(lanes, dtype=np.uint8)
+        ## @brief 命令を実行した回数(レーンをまとめて1回と数える)
+        self.issued = 0
+
+        words = np.array([ x if type(x) is int else x.gen_code() for x in program ], dtype=np.uint32)
+        offset = base & 0xFFFF
+        if offset + words.nbytes > RAM_SIZE :
+            raise ValueError('program does not fit in RAM: {} words at {:08x}'.format(len(words), base))
+        self.mem[offset:offset + words.nbytes] = words.view(np.uint8)
+        # 命令はこの時点の内容で解読する．
+        self.__code = self.mem.view(np.uint32).copy()
+        self.__decoded = {}
+
+        # レーンごとのページ: ページ番号 -> スロット番号(なければ -1)
+        self.__slot = np.full(RAM_SIZE >> 8, -1, dtype=np.int64)
+        self.__pages = np.zeros((0, lanes, 256), dtype=np.uint8)
+        self.__lane_ids = np.arange(lanes)
+
+    ### @brief 入力(スイッチ/ボタン)の値を設定する．
+    ### @param[in] dip_a, dip_b DIPスイッチの値(スカラまたはレーンごとの配列)
+    ### @param[in] hex_a, hex_b ロータリースイッチの値
+    ### @param[in] buttons プッシュボタンの値(4バイト，またはレーンごとの N x 4 の配列)
+    def set_inputs(self, dip_a=None, dip_b=None, hex_a=None, hex_b=None, buttons=None) :
+        io = self.io
+        for offset, value, mask in ((DIP_OFFSET, dip_a, 0xFF), (DIP_OFFSET + 1, dip_b, 0xFF),
+                                    (HEX_OFFSET, hex_a, 0x0F), (HEX_OFFSET + 1, hex_b, 0x0F)) :
+            if value is not None :
+                io[:, offset] = np.asarray(value) & mask
+        if buttons is not None :
+            io[:, BUTTON_OFFSET:BUTTON_OFFSET + 4] = np.asarray(buttons) & 0x1F
+
+    ### @brief 7セグ LED の内容(N x 64)を返す．
+    def seg7(self) :
+        return self.io[:, :64]
+
+    ### @brief レーンの RAM の内容を返す．
+    ### @param[in] lane レーンの番号
+    def lane_memory(self, lane) :
+        mem = self.mem.copy()
+        for page in np.flatnonzero(self.__slot >= 0) :
+            mem[page << 8:(page + 1) << 8] = self.__pages[self.__slot[page], lane]
+        return mem.tobytes()
+
+    ### @brief レーンの PC(アドレス)を返す．
+    def lane_pc(self, lane) :
+        return RAM_BASE + int(self.pc[lane]) * 4
+
+    ### @brief 実行中のレーンの命令数が max_steps になるまで実行する．
+    ### @param[in] max_steps レーンごとの命令数の上限(これまでの steps を含む)
+    ### @return 命令を実行した回数(レーンをまとめて1回と数える)を返す．
+    ###
+    ### すべてのレーンが DONE, LIMIT, ERROR のいずれかになるまで実行する．
+    ### 上限に達したレーンは LIMIT になり，より大きい上限で run() を呼ぶと続きを実行する．
+    def run(self, max_steps) :
+        pc = self.pc
+        steps = self.steps
+        status = self.status
+        lanes = self.lanes
+        issued = self.issued
+        status[(status == LIMIT) & (steps < max_steps)] = RUNNING
+        active = np.flatnonzero(status == RUNNING)
+        while len(active) :
+            # PC が最小のレーンをまとめる．まとめたレーンの PC が分かれず，ほかのレーンの
+            # PC(wait)に届かない間は，pc と steps に書き戻さずに続けて実行する．
+            over = active[steps[active] >= max_steps]
+            if len(over) :
+                status[over] = LIMIT
+                active = np.flatnonzero(status == RUNNING)
+                if not len(active) :
+                    break
+            p = pc[active]
+            cur = int(p.min())
+            if cur == p.max() :
+                sel = slice(None) if len(active) == lanes else active
+                wait = _NWORDS
+            else :
+                same = p == cur
+                sel = active[same]
+                wait = int(p[~same].min())
+            # 1回の実行で steps は 1 しか増えないので，上限までまとめて実行できる．
+            budget = max_steps - int(steps[sel].max())
+            n = 0
+            while n < budget :
+                nxt = self.__execute(cur, sel)
+                if nxt is None :
+                    pc[sel] = cur
+                    status[sel] = DONE if self.__code[cur] == _SELF_LOOP else ERROR
+                    active = np.flatnonzero(status == RUNNING)
+                    break
+                n += 1
+                if nxt < 0 :
+                    break
+                cur = nxt
+                if cur >= wait :
+                    break
+            else :
+                nxt = cur
+            if n :
+                steps[sel] += n
+                self.issued += n
+            if nxt is not None and nxt >= 0 :
+                pc[sel] = nxt
+        return self.issued - issued
+
+    # ワード位置の命令を解読した (名前, rd, rs1, rs2, 即値) を返す．
+    def __decode(self, index) :
+        entry = self.__decoded.get(index)
+        if entry is None :
+            code = int(self.__code[index])
+            decoded = decode(code)
+            if decoded is None or code == _SELF_LOOP :
+                entry = None
+            else :
+                name, layout = decoded
+                entry = (name, (code >> 7) & 0x1F, (code >> 15) & 0x1F, (code >> 20) & 0x1F, layout.gather(code))
+            self.__decoded[index] = entry
+        return entry
+
+    # sel のレーンで index の命令を実行し，次の命令のワード位置を返す(pc には書き込まない)．
+    # レーンによって次の命令が違う時は pc に書き込んで -1 を，実行できない命令の時は None を返す．
+    def __execute(self, index, sel) :
+        entry = self.__decode(index)
+        if entry is None :
+            return None
+        name, rd, rs1, rs2, imm = entry
+        reg = self.reg
+        nxt = (index + 1) & (_NWORDS - 1)
+        # reg は Fortran 順なので，列を取り出してからレーンを選ぶ方が速い．
+        op = _ALU.get(name)
+        if op is not None :
+            if rd :
+                reg[:, rd][sel] = op(reg[:, rs1][sel], reg[:, rs2][sel])
+        elif name in _ALU_IMM :
+            if rd :
+                reg[:, rd][sel] = _ALU[_ALU_IMM[name]](reg[:, rs1][sel], _U32(imm & 0xFFFFFFFF))
+        elif name in _BRANCH :
+            taken = _BRANCH[name](reg[:, rs1][sel], reg[:, rs2][sel])
+            target = (index + (imm >> 2)) & (_NWORDS - 1)
+            if taken.all() :
+                return target
+            if taken.any() :
+                self.pc[sel] = np.where(taken, target, nxt)
+                return -1
+        elif name in _LOAD :
+            size, signed = _LOAD[name]
+            value = self.__load(sel, reg[:, rs1][sel] + _U32(imm & 0xFFFFFFFF), size)
+            if rd :
+                if signed is not None :
+                    value = value.astype(signed).astype(_I32)
+                reg[:, rd][sel] = value.astype(_U32)
+        elif name in _STORE :
+            self.__store(sel, reg[:, rs1][sel] + _U32(imm & 0xFFFFFFFF), reg[:, rs2][sel], _STORE[name])
+        elif name == 'LUI' :
+            if rd :
+                reg[:, rd][sel] = imm & 0xFFFFFFFF
+        elif name == 'AUIPC' :
+            if rd :
+                reg[:, rd][sel] = (RAM_BASE + index * 4 + imm) & 0xFFFFFFFF
+        elif name == 'JAL' :
+            if rd :
+                reg[:, rd][sel] = RAM_BASE + index * 4 + 4
+            return (index + (imm >> 2)) & (_NWORDS - 1)
+        elif name == 'JALR' :
+            target = ((reg[:, rs1][sel] + _U32(imm & 0xFFFFFFFF)) >> _U32(2)) & _U32(_NWORDS - 1)
+            if rd :
+                reg[:, rd][sel] = RAM_BASE + index * 4 + 4
+            first = int(target[0])
+            if (target == first).all() :
+                return first
+            self.pc[sel] = target
+            return -1
+        else :
+            return None
+        return nxt
+
+    # レーンの番号の配列を返す．
+    def __ids(self, sel) :
+        return self.__lane_ids if type(sel) is slice else sel
+
+    # sel のレーンでアドレス a から size バイトを読み出す．
+    def __load(self, sel, a, size) :
+        dtype = _DTYPE[size]
+        shift = size.bit_length() - 1
+        ids = self.__ids(sel)
+        off = (a & _U32(0xFFFF)) >> _U32(shift)
+        value = self.mem.view(dtype)[off]
+        if len(self.__pages) :
+            slot = self.__slot[off >> (8 - shift)]
+            private = slot >= 0
+            if private.any() :
+                pages = self.__pages.view(dtype)
+                value[private] = pages[slot[private], ids[private], off[private] & ((256 >> shift) - 1)]
+        io = (a >> _U32(8)) == _U32(IO_BASE >> 8)
+        if io.any() :
+            value[io] = self.io.view(dtype)[ids[io], (a[io] & _U32(0xFF)) >> _U32(shift)]
+        return value
+
+    # sel のレーンでアドレス a に値 v の下位 size バイトを書き込む．
+    def __store(self, sel, a, v, size) :
+        dtype = _DTYPE[size]
+        shift = size.bit_length() - 1
+        ids = self.__ids(sel)
+        ram = (a >> _U32(16)) == _U32(RAM_BASE >> 16)
+        if ram.any() :
+            off = (a[ram] & _U32(0xFFFF)) >> _U32(shift)
+            page = off >> (8 - shift)
+            self.__allocate(np.unique(page))
+            self.__pages.view(dtype)[self.__slot[page], ids[ram], off & ((256 >> shift) - 1)] = v[ram].astype(dtype)
+        io = ((a >> _U32(8)) == _U32(IO_BASE >> 8)) & ((a & _U32(0xFF)) < BUTTON_OFFSET)
+        if io.any() :
+            self.io.view(dtype)[ids[io], (a[io] & _U32(0xFF)) >> _U32(shift)] = v[io].astype(dtype)
+
+    # ページをレーンごとのページにする．
+    def __allocate(self, pages) :
+        slot = self.__slot
+        new = [ int(p) for p in pages if slot[p] < 0 ]
+        if not new :
+            return
+        n = len(self.__pages)
+        grown = np.empty((n + len(new), self.lanes, 256), dtype=np.uint8)
+        grown[:n] = self.__pages
+        for k, p in enumerate(new) :
+            grown[n + k] = self.mem[p << 8:(p + 1) << 8]
+            slot[p] = n + k
+        self.__pages = grown
+
+
+if __name__ == '__main__' :
+
+    import time
+    from argparse import ArgumentParser
+    from inst import Inst, asm
+    from sim import Simulator
+    from snapshot import History
+
+    parser = ArgumentParser(description='run one program over every dip_a/dip_b setting in lockstep')
+    parser.add_argument('-s', '--samples', type=int, default=200, help='lanes checked against Simulator')
+    args = parser.parse_args()
+
+    # dip_a * dip_b を足し算の繰り返しで求めて RAM と HEX0-HEX3 に書き込み，
+    # dip_a > dip_b なら HEX4 に 1 を書いて止まる．
+    program = asm([
+        Inst.LUI(5, 0x04000000),
+        Inst.LBU(6, 5, DIP_OFFSET),
+        Inst.LBU(7, 5, DIP_OFFSET + 1),
+        Inst.ADDI(8, 0, 0),
+        Inst.ADDI(14, 7, 0),
+        'mul',
+        Inst.LBEQ(7, 0, 'show'),
+        Inst.ADD(8, 8, 6),
+        Inst.ADDI(7, 7, -1),
+        Inst.LJAL(0, 'mul'),
+        'show',
+        Inst.LUI(12, 0x10008000),
+        Inst.SW(12, 8, 0),
+        Inst.SH(12, 6, 4),
+        Inst.LH(15, 12, 4),
+        Inst.ADDI(9, 0, 4),
+        Inst.ADDI(10, 5, 0),
+        'digit',
+        Inst.ANDI(11, 8, 0xF),
+        Inst.SB(10, 11, 0),
+        Inst.SRLI(8, 8, 4),
+        Inst.ADDI(10, 10, 1),
+        Inst.ADDI(9, 9, -1),
+        Inst.LBNE(9, 0, 'digit'),
+        Inst.LBGEU(14, 6, 'end'),
+        Inst.ADDI(11, 0, 1),
+        Inst.SB(5, 11, 4),
+        'end',
+        Inst.LJAL(0, 'end'),
+    ])
+    dip_a, dip_b = dip_sweep()
+    m = LockstepSimulator(program, len(dip_a))
+    m.set_inputs(dip_a=dip_a, dip_b=dip_b)
+    start = time.perf_counter()
+    m.run(100000)
+    elapsed = time.perf_counter() - start
+    print('{} lanes, {} instructions in {} lockstep issues, {:.3f} s'.format(
+        m.lanes, int(m.steps.sum()), m.issued, elapsed))
+    assert (m.status == DONE).all()
+    assert (m.mem.view(np.uint32)[m.pc] == _SELF_LOOP).all()
+    product = (dip_a.astype(np.uint32) * dip_b) & 0xFFFF
+    shown = sum(m.seg7()[:, i].astype(np.uint32) << (4 * i) for i in range(4))
+    assert (shown == product).all()
+    assert (m.seg7()[:, 4] == (dip_a > dip_b)).all()
+
+    # 一部のレーンを Simulator で1つずつ実行して比べる．
+    rnd = np.random.default_rng(1)
+    lanes = rnd.choice(m.lanes, args.samples, replace=False)
+    # Simulator は batchrun と同じように1つを作って使い回し，レーンごとに
+    # 読み込んだ直後の状態に戻す(作るのにかかる時間は比べる時間に含めない)．
+    sim = Simulator(program)
+    hist = History(sim, interval=1 << 62, limit=1)
+    initial = hist.checkpoint()
+    # 命令を変換する時間も含めないよう，一度実行しておく．
+    sim.run(int(m.steps.max()))
+    sequential = 0.0
+    for lane in lanes :
+        hist.restore(initial)
+        start = time.perf_counter()
+        sim.set_inputs(dip_a=int(dip_a[lane]), dip_b=int(dip_b[lane]))
+        sim.run(int(m.steps[lane]))
+        sequential += time.perf_counter() - start
+        assert sim.pc == m.lane_pc(lane), lane
+        assert sim.reg[:32] == m.reg[lane].tolist(), lane
+        assert bytes(sim.mem) == m.lane_memory(lane), lane
+        assert sim.seg7() == m.seg7()[lane].tobytes(), lane
+    sequential = sequential / len(lanes) * m.lanes
+    print('sequential Simulator: about {:.1f} s for all lanes (x{:.1f})'.format(sequential, sequential / elapsed))
+
+    # 命令数の上限
+    m = LockstepSimulator(program, 1000)
+    m.set_inputs(dip_a=7, dip_b=np.arange(1000) & 0xFF)
+    m.run(40)
+    assert ((m.status == LIMIT) == (m.steps >= 40)).all() and (m.steps <= 40).all()
+    m.run(100000)
+    assert (m.status == DONE).all()
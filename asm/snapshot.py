@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+
+### @file snapshot.py
+### @brief シミュレータの状態のスナップショットと逆実行
+###
+### History はシミュレータのレジスタ，PC，RAM と MU500 のレジスタのスナップショットを
+### interval 命令ごとに自動で取り，step_back(n) はその直前のスナップショットに戻してから
+### 残りを実行し直すことで n 命令前の状態を作る．checkpoint(label) で名前を付けた
+### スナップショットは restore(label) でいつでも戻せる．
+###
+###   hist = History(Simulator(asm(program)))
+###   hist.run(1000000)
+###   hist.checkpoint('before')
+###   hist.run(5000)
+###   hist.step_back(3)
+###   hist.restore('before')
+###
+### RAM は 256バイト(1 << sim.PAGE_SHIFT)のページの bytes のタプルとして持つ．
+### 前回のスナップショットから書き込まれたページ(sim.dirty の印のあるページ)だけを
+### 複写し，残りのページは前回と同じ bytes を共有する(コピーオンライト)．
+### スナップショット1つの大きさは，ページへの参照の表と書き込まれたページの数に比例する．
+###
+### RAM への書き込みは sim.dirty で追跡するので，sim.mem を直接書き換えた場合は
+### その前に dirty の印を付けること．DeviceBus の予約した入力などシミュレータの外の状態は戻らない．
+
+from bisect import bisect_right
+from collections import namedtuple
+
+from sim import RAM_BASE, PAGE_SHIFT, NPAGES
+
+### @brief シミュレータの状態
+###
+### steps は実行した命令数，reg は x0 - x31 のタプル，io は MU500 のレジスタ，
+### pages は RAM のページごとの bytes のタプル．
+Snapshot = namedtuple('Snapshot', 'steps pc reg io pages')
+
+# ページの大きさ(バイト)
+_PAGE = 1 << PAGE_SHIFT
+
+
+### @brief スナップショットを用いた逆実行
+class History :
+
+    ### @brief 初期化
+    ### @param[in] sim Simulator または BlockSimulator
+    ### @param[in] interval 自動でスナップショットを取る間隔(命令数)
+    ### @param[in] limit 自動で取ったスナップショットを残す数(None の場合は制限しない)
+    ###
+    ### この時点の状態を最初のスナップショットとする．
+    def __init__(self, sim, interval=10000, limit=1000) :
+        if interval <= 0 :
+            raise ValueError('interval must be positive: {}'.format(interval))
+        ## @brief シミュレータ
+        self.sim = sim
+        ## @brief 自動でスナップショットを取る間隔(命令数)
+        self.interval = interval
+        ## @brief 自動で取ったスナップショットを残す数
+        self.limit = limit
+        ## @brief 名前をキーにしてスナップショットを持つ辞書
+        self.labels = {}
+        # 自動で取ったスナップショット(steps の昇順)とその steps のリスト
+        self.__auto = []
+        self.__steps = []
+        # 最後に取った(または戻した)スナップショットのページ
+        mem = sim.mem
+        self.__pages = [ bytes(mem[i << PAGE_SHIFT:(i + 1) << PAGE_SHIFT]) for i in range(NPAGES) ]
+        sim.dirty[:] = bytes(NPAGES)
+        self.__add(self.__snapshot())
+
+    # 現在の状態のスナップショットを作る．
+    def __snapshot(self) :
+        sim = self.sim
+        pages = self.__pages
+        dirty = sim.dirty
+        mem = sim.mem
+        i = dirty.find(1)
+        while i >= 0 :
+            page = mem[i << PAGE_SHIFT:(i + 1) << PAGE_SHIFT]
+            # 書き込まれても内容が同じなら前の bytes を使い続ける．
+            if page != pages[i] :
+                pages[i] = bytes(page)
+            i = dirty.find(1, i + 1)
+        dirty[:] = bytes(NPAGES)
+        return Snapshot(sim.steps, sim.pc, tuple(sim.reg[:32]), bytes(sim.io), tuple(pages))
+
+    # 自動で取ったスナップショットを加える．
+    def __add(self, snap) :
+        if self.__steps and self.__steps[-1] == snap.steps :
+            self.__auto[-1] = snap
+            return
+        self.__auto.append(snap)
+        self.__steps.append(snap.steps)
+        if self.limit is not None and len(self.__auto) > self.limit :
+            # 最初のものは残して，古い方から間引く．
+            del self.__auto[1]
+            del self.__steps[1]
+
+    ### @brief スナップショットを取る．
+    ### @param[in] label 名前(None の場合は名前を付けない)
+    ### @return Snapshot を返す．
+    def checkpoint(self, label=None) :
+        snap = self.__snapshot()
+        self.__add(snap)
+        if label is not None :
+            self.labels[label] = snap
+        return snap
+
+    ### @brief 指定された命令数だけ実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    ###
+    ### steps が interval の倍数になるたびにスナップショットを取る．
+    def run(self, max_steps) :
+        sim = self.sim
+        interval = self.interval
+        end = sim.steps + max_steps
+        done = 0
+        while sim.steps < end :
+            stop = min(end, (sim.steps // interval + 1) * interval)
+            n = sim.run(stop - sim.steps)
+            done += n
+            if sim.steps % interval == 0 :
+                self.__add(self.__snapshot())
+            if n == 0 :
+                break
+        return done
+
+    ### @brief 1命令実行する．
+    def step(self) :
+        return self.run(1)
+
+    ### @brief スナップショットの状態に戻す．
+    ### @param[in] snap Snapshot または checkpoint() で付けた名前
+    ###
+    ### 戻した時点より後に自動で取ったスナップショットは捨てる(名前付きのものは残す)．
+    def restore(self, snap) :
+        if not isinstance(snap, Snapshot) :
+            snap = self.labels[snap]
+        sim = self.sim
+        mem = sim.mem
+        code = sim.code
+        pages = self.__pages
+        target = snap.pages
+        dirty = sim.dirty
+        for i in range(NPAGES) :
+            if pages[i] is target[i] and not dirty[i] :
+                continue
+            start = i << PAGE_SHIFT
+            if mem[start:start + _PAGE] != target[i] :
+                mem[start:start + _PAGE] = target[i]
+                # 変換済みの命令を変換し直させる．
+                w = code.find(1, start >> 2, (start + _PAGE) >> 2)
+                while w >= 0 :
+                    sim.invalidate(w)
+                    w = code.find(1, w + 1, (start + _PAGE) >> 2)
+        self.__pages = list(target)
+        dirty[:] = bytes(NPAGES)
+        sim.reg[:32] = snap.reg
+        sim.io[:] = snap.io
+        sim.pc = snap.pc
+        sim.steps = snap.steps
+        k = bisect_right(self.__steps, snap.steps)
+        del self.__auto[k:]
+        del self.__steps[k:]
+        if not self.__auto or self.__steps[-1] != snap.steps :
+            self.__auto.append(snap)
+            self.__steps.append(snap.steps)
+
+    ### @brief n 命令前の状態に戻す．
+    ### @param[in] n 戻る命令数
+    ### @return 戻った後の steps を返す．
+    ###
+    ### 直前のスナップショットに戻して残りを実行し直すので，
+    ### 時間は interval 命令の実行以下となる．
+    def step_back(self, n=1) :
+        target = max(self.__steps[0], self.sim.steps - n)
+        snap = self.__auto[bisect_right(self.__steps, target) - 1]
+        self.restore(snap)
+        if target > snap.steps :
+            self.sim.run(target - snap.steps)
+        return self.sim.steps
+
+    ### @brief 指定された時刻(steps)の状態にする．
+    ### @param[in] steps 時刻
+    ###
+    ### 現在より後の時刻の場合は実行を進める．
+    def seek(self, steps) :
+        if steps >= self.sim.steps :
+            self.run(steps - self.sim.steps)
+        else :
+            self.step_back(self.sim.steps - steps)
+        return self.sim.steps
+
+    ### @brief 残している自動のスナップショットの steps のリストを返す．
+    def checkpoints(self) :
+        return list(self.__steps)
+
+    ### @brief スナップショットの RAM の大きさ(バイト)を返す．
+    ###
+    ### 共有しているページは一度だけ数える．ページへの参照の表は含まない．
+    def memory(self) :
+        seen = {}
+        for snap in self.__auto + list(self.labels.values()) :
+            for page in snap.pages :
+                seen[id(page)] = len(page)
+        return sum(seen.values())
+
+
+if __name__ == '__main__' :
+
+    import time
+    from inst import Inst, asm
+    from sim import Simulator
+
+    # RAM の 0x10008000 からの 16ワードを巡回しながら書き込む．
+    program = asm([
+        Inst.LUI(5, 0x10008000),
+        Inst.ADDI(6, 0, 0),
+        'loop',
+        Inst.ANDI(7, 6, 0x3C),
+        Inst.ADD(7, 5, 7),
+        Inst.LW(8, 7, 0),
+        Inst.ADD(8, 8, 6),
+        Inst.SW(7, 8, 0),
+        Inst.ADDI(6, 6, 4),
+        Inst.LJAL(0, 'loop'),
+    ])
+    sim = Simulator(program)
+    hist = History(sim, interval=10000)
+    start = time.perf_counter()
+    hist.run(2000000)
+    elapsed = time.perf_counter() - start
+    print('2000000 steps with {} checkpoints in {:.3f} s, {} bytes of pages'.format(
+        len(hist.checkpoints()), elapsed, hist.memory()))
+
+    # 同じプログラムを最初から実行した結果と比べる．
+    def state_at(steps) :
+        ref = Simulator(program)
+        ref.run(steps)
+        return ref.pc, ref.reg[:32], bytes(ref.mem)
+
+    hist.checkpoint('mark')
+    hist.run(12345)
+    start = time.perf_counter()
+    hist.step_back(7)
+    elapsed = time.perf_counter() - start
+    print('step_back(7) to {} in {:.3f} ms'.format(sim.steps, elapsed * 1000))
+    assert (sim.pc, sim.reg[:32], bytes(sim.mem)) == state_at(sim.steps)
+    hist.step_back(1234567)
+    assert (sim.pc, sim.reg[:32], bytes(sim.mem)) == state_at(sim.steps)
+    hist.restore('mark')
+    assert sim.steps == 2000000 and (sim.pc, sim.reg[:32], bytes(sim.mem)) == state_at(sim.steps)
+    hist.run(5)
+    assert (sim.pc, sim.reg[:32], bytes(sim.mem)) == state_at(sim.steps)
+    print('ok')
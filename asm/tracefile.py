@@ -0,0 +1,475 @@
+#! /usr/bin/env python3
+
+### @file tracefile.py
+### @brief Simulator の実行トレースのバイナリ形式での記録と再生
+###
+### 使い方:
+###   with TraceRecorder(sim, 'run.trc', labels=a.labels) as rec :    # a は Assembler
+###       rec.run(1000000)
+###   tr = TraceReader('run.trc')
+###   print(tr[123456])
+###   for step in tr.filter(label='loop') : ...
+###   print(diff(tr, TraceReader('other.trc')))
+###
+### 1命令ごとに PC, IR(機械語), rd への書き込み値, ロード/ストアのアドレスと値を記録する．
+### debugger.v で1命令ずつ見ることのできる状態と同じもの．
+###
+### ファイルの形式(リトルエンディアン)
+###   ヘッダ  : 'KTRC', 版(H), 予約(H), ラベルの JSON の長さ(I), ラベルの JSON
+###   チャンク: 'CHNK', 命令数 n(I), 最初の命令のワード位置(I), 書き込み数 w(I), アクセス数 m(I),
+###             PC の差分 int16 x n, IR uint32 x n, 書き込み値 uint32 x w, (アドレス, 値) uint32 x 2m
+### PC の差分は直前の命令のワード位置 + 1 からの差(ワード単位, チャンクの最初は 0)で，
+### 分岐しなければ 0 になる．
+### rd への書き込み値とメモリのアクセスは，それがある命令(IR から分かる)の分だけを順に並べる．
+### rd への書き込みは rd が x0 以外で分岐/ストア以外の命令，アクセスはロード/ストア命令．
+### x0 へのロードの値は 0 として記録する．
+
+import json
+import mmap
+import struct
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+from inst import decode, mnemonic
+from sim import RAM_BASE
+
+# ファイルの先頭
+_MAGIC = b'KTRC'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHI')
+
+# チャンクの先頭
+_CHUNK_MAGIC = b'CHNK'
+_CHUNK = struct.Struct('<4sIIII')
+
+### @brief 1チャンクの命令数の既定値
+CHUNK_STEPS = 1 << 16
+
+# ストア命令の値のマスク(funct3 で引く)
+_STORE_MASK = (0xFF, 0xFFFF, 0xFFFFFFFF)
+
+
+### @brief 記録された1命令
+###
+### n: 命令の番号, pc: アドレス, ir: 機械語, rd: 書き込んだレジスタ(なければ None),
+### value: 書き込んだ値, addr: ロード/ストアのアドレス(なければ None), data: ロード/ストアの値
+Step = namedtuple('Step', ('n', 'pc', 'ir', 'rd', 'value', 'addr', 'data'))
+
+
+def _step_str(step) :
+    text = '{:10} {:08x} {:08x} {:32}'.format(step.n, step.pc, step.ir, mnemonic(step.ir) or '<unknown>')
+    if step.rd is not None :
+        text += ' x{:02d}={:08x}'.format(step.rd, step.value)
+    if step.addr is not None :
+        text += ' [{:08x}]={:08x}'.format(step.addr, step.data)
+    return text
+
+Step.__str__ = _step_str
+
+
+# 機械語から (rd への書き込みがあれば 1, ロード/ストアなら 1) を返す．
+def _kind(ir) :
+    opcode = ir & 0x7F
+    writes = 0 if opcode == 0x63 or opcode == 0x23 or (ir >> 7) & 0x1F == 0 else 1
+    return writes, 1 if opcode == 0x03 or opcode == 0x23 else 0
+
+
+### @brief 実行トレースをファイルに記録する．
+###
+### Simulator.instrument() で命令の関数を包み，命令ごとの値を列ごとの array に溜めて
+### チャンク単位で書き出す．BlockSimulator では記録している間は命令ごとの実行となる．
+class TraceRecorder :
+
+    ### @brief 初期化
+    ### @param[in] sim Simulator または BlockSimulator
+    ### @param[in] path 書き出すファイル名
+    ### @param[in] labels ラベルをキーにしてアドレスを持つ辞書(ファイルに記録する)
+    ### @param[in] chunk_steps 1チャンクの命令数
+    def __init__(self, sim, path, labels=None, chunk_steps=CHUNK_STEPS) :
+        self.__sim = sim
+        self.__chunk_steps = chunk_steps
+        self.__f = open(path, 'wb')
+        text = json.dumps(dict(labels or {}), sort_keys=True).encode()
+        self.__f.write(_HEADER.pack(_MAGIC, _VERSION, 0, len(text)) + text)
+        # 命令ごとの列
+        self.__dpc = array('h')
+        self.__ir = array('I')
+        self.__writes = array('I')
+        self.__mem = array('I')
+        # 直前の命令のワード位置
+        self.__last = [ 0 ]
+        self.__new_chunk()
+        ## @brief 記録した命令数
+        self.steps = 0
+        sim.instrument(self.__wrap)
+
+    # 新しいチャンクを始める．最初の命令は次に実行する命令になる．
+    # 命令の関数が列を参照しているので，列は作り直さずに空にする．
+    def __new_chunk(self) :
+        for column in (self.__dpc, self.__ir, self.__writes, self.__mem) :
+            del column[:]
+        self.__start = (self.__sim.pc >> 2) & 0x3FFF
+        self.__last[0] = self.__start - 1
+
+    ### @brief 記録しながら実行する．
+    ### @param[in] max_steps 実行する命令数
+    ### @return 実行した命令数を返す．
+    ###
+    ### チャンクの命令数ごとにファイルに書き出す．
+    def run(self, max_steps) :
+        sim = self.__sim
+        done = 0
+        try :
+            while done < max_steps :
+                want = min(self.__chunk_steps - len(self.__ir), max_steps - done)
+                n = sim.run(want)
+                done += n
+                if len(self.__ir) >= self.__chunk_steps :
+                    self.flush()
+                if n < want :
+                    break
+        finally :
+            self.steps += done
+        return done
+
+    ### @brief 溜まっている命令をチャンクとして書き出す．
+    def flush(self) :
+        ir = self.__ir
+        if not ir :
+            return
+        self.__f.write(_CHUNK.pack(_CHUNK_MAGIC, len(ir), self.__start, len(self.__writes), len(self.__mem) >> 1))
+        self.__f.write(self.__dpc.tobytes())
+        self.__f.write(ir.tobytes())
+        self.__f.write(self.__writes.tobytes())
+        self.__f.write(self.__mem.tobytes())
+        self.__new_chunk()
+
+    ### @brief 書き出してファイルを閉じ，記録をやめる．
+    def close(self) :
+        if self.__f.closed :
+            return
+        self.flush()
+        self.__f.close()
+        self.__sim.instrument(None)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    # 命令の関数を包む．
+    def __wrap(self, index, code, f) :
+        dpc = self.__dpc
+        irs = self.__ir
+        last = self.__last
+        r = self.__sim.reg
+        writes, access = _kind(code)
+        rd = (code >> 7) & 0x1F
+
+        if not access :
+            wv = self.__writes
+            if writes :
+                def g() :
+                    dpc.append(index - last[0] - 1)
+                    last[0] = index
+                    irs.append(code)
+                    h = f()
+                    wv.append(r[rd])
+                    return h
+            else :
+                def g() :
+                    dpc.append(index - last[0] - 1)
+                    last[0] = index
+                    irs.append(code)
+                    return f()
+            return g
+
+        mem = self.__mem
+        wv = self.__writes
+        rs1 = (code >> 15) & 0x1F
+        imm = decode(code)[1].gather(code)
+        if code & 0x7F == 0x23 :
+            rs2 = (code >> 20) & 0x1F
+            mask = _STORE_MASK[(code >> 12) & 3]
+            def g() :
+                dpc.append(index - last[0] - 1)
+                last[0] = index
+                irs.append(code)
+                mem.append((r[rs1] + imm) & 0xFFFFFFFF)
+                mem.append(r[rs2] & mask)
+                return f()
+        elif writes :
+            def g() :
+                dpc.append(index - last[0] - 1)
+                last[0] = index
+                irs.append(code)
+                mem.append((r[rs1] + imm) & 0xFFFFFFFF)
+                h = f()
+                v = r[rd]
+                mem.append(v)
+                wv.append(v)
+                return h
+        else :
+            def g() :
+                dpc.append(index - last[0] - 1)
+                last[0] = index
+                irs.append(code)
+                mem.append((r[rs1] + imm) & 0xFFFFFFFF)
+                mem.append(0)
+                return f()
+        return g
+
+
+### @brief 記録した実行トレースを読む．
+###
+### ファイルは mmap で開き，チャンクは必要になった時に1つずつ展開する．
+class TraceReader :
+
+    ### @brief 初期化
+    ### @param[in] path ファイル名
+    def __init__(self, path) :
+        with open(path, 'rb') as f :
+            self.__map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self.__map
+        magic, version, _, size = _HEADER.unpack_from(buf, 0)
+        if magic != _MAGIC or version != _VERSION :
+            raise ValueError('{}: not a trace file'.format(path))
+        offset = _HEADER.size
+        ## @brief ラベルをキーにしてアドレスを持つ辞書
+        self.labels = json.loads(bytes(buf[offset:offset + size]).decode())
+        offset += size
+        # チャンクごとの (最初の命令の番号, ファイル上の位置, 命令数, 最初のワード位置, 書き込み数, アクセス数)
+        self.__chunks = []
+        n = 0
+        while offset + _CHUNK.size <= len(buf) :
+            magic, nsteps, start, nwrites, nmem = _CHUNK.unpack_from(buf, offset)
+            if magic != _CHUNK_MAGIC :
+                raise ValueError('{}: broken chunk at {}'.format(path, offset))
+            self.__chunks.append((n, offset + _CHUNK.size, nsteps, start, nwrites, nmem))
+            n += nsteps
+            offset += _CHUNK.size + nsteps * 6 + nwrites * 4 + nmem * 8
+        self.__firsts = [ c[0] for c in self.__chunks ]
+        self.__length = n
+        self.__cached = None
+
+    ### @brief 命令数を返す．
+    def __len__(self) :
+        return self.__length
+
+    ### @brief ファイルを閉じる．
+    def close(self) :
+        self.__cached = None
+        self.__map.close()
+
+    ### @brief チャンクの数を返す．
+    def nchunks(self) :
+        return len(self.__chunks)
+
+    # k 番目のチャンクの列(array)を返す．
+    def __columns(self, k) :
+        first, offset, n, start, nwrites, nmem = self.__chunks[k]
+        buf = self.__map
+        dpc = array('h', buf[offset:offset + 2 * n])
+        offset += 2 * n
+        ir = array('I', buf[offset:offset + 4 * n])
+        offset += 4 * n
+        writes = array('I', buf[offset:offset + 4 * nwrites])
+        offset += 4 * nwrites
+        mem = array('I', buf[offset:offset + 8 * nmem])
+        return dpc, ir, writes, mem
+
+    # k 番目のチャンクを展開して (ワード位置, 書き込みの位置, アクセスの位置) の列を返す．
+    def __chunk(self, k) :
+        if self.__cached is not None and self.__cached[0] == k :
+            return self.__cached[1]
+        dpc, ir, writes, mem = self.__columns(k)
+        start = self.__chunks[k][3]
+        index = array('I')
+        wpos = array('i')
+        mpos = array('i')
+        kinds = {}
+        pc = start - 1
+        w = 0
+        m = 0
+        for d, code in zip(dpc, ir) :
+            pc += d + 1
+            index.append(pc)
+            kind = kinds.get(code)
+            if kind is None :
+                kind = kinds[code] = _kind(code)
+            wpos.append(w if kind[0] else -1)
+            mpos.append(m if kind[1] else -1)
+            w += kind[0]
+            m += kind[1]
+        data = (index, ir, writes, mem, wpos, mpos)
+        self.__cached = (k, data)
+        return data
+
+    # チャンクの中の i 番目の命令を Step にする．
+    def __step(self, n, data, i) :
+        index, ir, writes, mem, wpos, mpos = data
+        code = ir[i]
+        w = wpos[i]
+        m = mpos[i]
+        return Step(n, RAM_BASE + index[i] * 4, code,
+                    None if w < 0 else (code >> 7) & 0x1F, None if w < 0 else writes[w],
+                    None if m < 0 else mem[2 * m], None if m < 0 else mem[2 * m + 1])
+
+    ### @brief n 番目の命令を返す．
+    def __getitem__(self, n) :
+        if n < 0 :
+            n += self.__length
+        if not 0 <= n < self.__length :
+            raise IndexError('step {} out of range'.format(n))
+        k = bisect_right(self.__firsts, n) - 1
+        return self.__step(n, self.__chunk(k), n - self.__firsts[k])
+
+    ### @brief 命令を順に返すジェネレータ
+    ### @param[in] start 最初の命令の番号
+    ### @param[in] stop 最後の命令の次の番号(None の場合は最後まで)
+    def steps(self, start=0, stop=None) :
+        stop = self.__length if stop is None else min(stop, self.__length)
+        n = start
+        while n < stop :
+            k = bisect_right(self.__firsts, n) - 1
+            first = self.__firsts[k]
+            data = self.__chunk(k)
+            end = min(stop, first + self.__chunks[k][2])
+            for i in range(n - first, end - first) :
+                yield self.__step(first + i, data, i)
+            n = end
+
+    ### @brief 指定したアドレス(またはラベル)の命令を順に返すジェネレータ
+    ### @param[in] pc アドレス
+    ### @param[in] label ラベル(pc の代わりに与える)
+    def filter(self, pc=None, label=None) :
+        if label is not None :
+            pc = self.labels[label]
+        if pc is None :
+            raise ValueError('pc or label is required')
+        target = (pc - RAM_BASE) >> 2
+        for k, first in enumerate(self.__firsts) :
+            data = self.__chunk(k)
+            index = data[0]
+            i = 0
+            while True :
+                try :
+                    i = index.index(target, i)
+                except ValueError :
+                    break
+                yield self.__step(first + i, data, i)
+                i += 1
+
+    ### @brief k 番目のチャンクの (最初の命令の番号, 命令数, 最初のワード位置, 生のバイト列) を返す(diff() が用いる)．
+    def _raw_chunk(self, k) :
+        first, offset, n, start, nwrites, nmem = self.__chunks[k]
+        return first, n, start, self.__map[offset:offset + n * 6 + nwrites * 4 + nmem * 8]
+
+
+### @brief 2つのトレースの異なる命令を返す．
+### @param[in] a, b TraceReader
+### @param[in] limit 返す数の上限
+### @return (命令の番号, a の Step, b の Step) のリストを返す．
+###         一方が短い場合は，短い方の Step を None とした組を1つ加える．
+###
+### 同じ位置で区切られたチャンクはバイト列のまま比べ，等しければ展開しない．
+def diff(a, b, limit=1) :
+    result = []
+    na = a.nchunks()
+    nb = b.nchunks()
+    k = 0
+    n = 0
+    # チャンクの区切りが揃っている間はまとめて比べる．
+    while k < na and k < nb :
+        fa, sa, pa, raw_a = a._raw_chunk(k)
+        fb, sb, pb, raw_b = b._raw_chunk(k)
+        if fa != fb or sa != sb :
+            break
+        if pa != pb or raw_a != raw_b :
+            for x, y in zip(a.steps(fa, fa + sa), b.steps(fb, fb + sb)) :
+                if x[1:] != y[1:] :
+                    result.append((x.n, x, y))
+                    if len(result) >= limit :
+                        return result
+        n = fa + sa
+        k += 1
+    for x, y in zip(a.steps(n), b.steps(n)) :
+        if x[1:] != y[1:] :
+            result.append((x.n, x, y))
+            if len(result) >= limit :
+                return result
+    la = len(a)
+    lb = len(b)
+    if la != lb :
+        m = min(la, lb)
+        result.append((m, a[m] if m < la else None, b[m] if m < lb else None))
+    return result
+
+
+if __name__ == '__main__' :
+
+    import os
+    import tempfile
+    import time
+    from argparse import ArgumentParser
+    from inst import Inst, Assembler, asm
+    from sim import Simulator
+
+    parser = ArgumentParser(description='record and check a trace of a sample program')
+    parser.add_argument('-n', '--steps', type=int, default=1000000)
+    args = parser.parse_args()
+
+    # 1 から 1000 までの和を RAM に書き込むことを繰り返す．
+    def program(k) :
+        return [
+            Inst.LUI(5, 0x10008000),
+            'outer',
+            Inst.ADDI(6, 0, 0),
+            Inst.ADDI(7, 0, 1000),
+            'loop',
+            Inst.ADD(6, 6, 7),
+            Inst.ADDI(7, 7, -k),
+            Inst.SW(5, 6, 0),
+            Inst.LBU(8, 5, 1),
+            Inst.LBLT(0, 7, 'loop'),
+            Inst.LJAL(0, 'outer'),
+        ]
+
+    tmp = tempfile.mkdtemp()
+    paths = []
+    for k in (1, 1, 3) :
+        path = os.path.join(tmp, 'trace{}.trc'.format(len(paths)))
+        a = Assembler()
+        a.extend(program(k))
+        sim = Simulator(a.assemble())
+        start = time.perf_counter()
+        with TraceRecorder(sim, path, a.labels) as rec :
+            rec.run(args.steps)
+        elapsed = time.perf_counter() - start
+        print('{}: {} steps, {} bytes ({:.2f} bytes/step), {:.2f} M steps/s'.format(
+            path, rec.steps, os.path.getsize(path), os.path.getsize(path) / rec.steps, rec.steps / elapsed / 1e6))
+        paths.append(path)
+
+    tr = TraceReader(paths[0])
+    ref = Simulator(asm(program(1)))
+    for n in range(200) :
+        step = tr[n]
+        assert step.pc == ref.pc
+        ref.step()
+        if step.rd is not None :
+            assert ref.reg[step.rd] == step.value
+    print(tr[len(tr) // 2])
+    print(next(tr.filter(label='outer')))
+
+    start = time.perf_counter()
+    assert diff(tr, TraceReader(paths[1])) == []
+    print('identical traces: {:.3f} s'.format(time.perf_counter() - start))
+    start = time.perf_counter()
+    for n, x, y in diff(tr, TraceReader(paths[2])) :
+        print('first difference at step {}:\n  {}\n  {}'.format(n, x, y))
+    print('diff: {:.3f} s'.format(time.perf_counter() - start))
+    for path in paths :
+        os.remove(path)
+    os.rmdir(tmp)